@@ -1,4 +1,5 @@
-import requests
+import asyncio
+import httpx
 import readline
 import json
 
@@ -8,16 +9,39 @@ class Client:
         self.apikey = {"local": "", "cloud": ""}
         self.current_conv = ""
         self._read_configuration()
+        self.http: httpx.AsyncClient | None = None
+        # Per conversation: what /ls and /seq have already fetched, so the next call asks only for newer items.
+        self.conv_cache: dict[str, dict] = {}
+        self.seq_cache: dict[str, dict] = {}
+        # /dig results by llm_request_id, with their ETag.
+        self.dig_cache: dict[str, tuple[str, dict]] = {}
 
     @property
     def base_url(self) -> str:
         return "http://localhost:4000" if self.local else "https://api.snow-white.org"
-    
+
     @property
     def headers(self):
         apikey = self.apikey["local"] if self.local else self.apikey["cloud"]
         return {"Authorization": f"Bearer {apikey}", "Content-Type": "application/json"}
 
+    async def open(self):
+        """(Re)open the keep-alive session against the configured server."""
+        await self.close()
+        # httpx rejects the trailing space of "Bearer " when no apikey is configured.
+        headers = {name: value.strip() for name, value in self.headers.items()}
+        self.http = httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=httpx.Timeout(300.0, connect=10.0))
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    @property
+    def session(self) -> httpx.AsyncClient:
+        assert self.http is not None, "call open() first"
+        return self.http
+
     def print_menu(self):
         print("/server [local/cloud] [apikey]")
         print("/conv")
@@ -29,7 +53,7 @@ class Client:
         print("or just type stuff to add it to the conversation.")
         print()
         print(f"Server: {'local' if self.local else 'cloud'}, Current conversation: {self.current_conv}")
-    
+
     def _write_configuration(self):
         with open(".client_config", "w") as f:
             json.dump({"local": self.local, "apikey": self.apikey, "current_conv": self.current_conv}, f)
@@ -44,15 +68,18 @@ class Client:
         except FileNotFoundError:
             pass
 
-    def reconfigure(self, local: bool, apikey: str | None):
+    async def reconfigure(self, local: bool, apikey: str | None):
         self.local = local
         if apikey is not None:
             self.apikey["local" if local else "cloud"] = apikey
         self.current_conv = ""
+        self.conv_cache.clear()
+        self.seq_cache.clear()
         self._write_configuration()
+        await self.open()
 
-    def ls_conv(self):
-        response = requests.get(f"{self.base_url}/api/conv", headers=self.headers)
+    async def ls_conv(self):
+        response = await self.session.get("/api/conv")
         print("Available conversations:")
         if response.status_code == 200:
             conversations = response.json()["conversations"]
@@ -62,8 +89,8 @@ class Client:
         else:
             print("Failed to fetch conversations.")
 
-    def switch_to_new_conv(self):
-        response = requests.post(f"{self.base_url}/api/conv", headers=self.headers, json={})
+    async def switch_to_new_conv(self):
+        response = await self.session.post("/api/conv", json={})
         response.raise_for_status()
         if response.status_code == 200:
             conv = response.json()
@@ -76,7 +103,10 @@ class Client:
         print(f"Conversation ID: {conv_data['id']}")
         print(f"Topic: {conv_data['topic']}")
         print("Messages:")
-        for msg in conv_data["messages"]:
+        self._print_messages(conv_data["messages"])
+
+    def _print_messages(self, messages: list[dict]):
+        for msg in messages:
             role = msg["role"]
             for content in msg["content"]:
                 assert content["type"] == "text"
@@ -86,58 +116,109 @@ class Client:
                     print(f"  (LLM Request IDs: {' '.join(req_ids)})")
             print("---")
 
-    def print_current_conv(self):
+    async def _fetch_conv(self, conv_id: str) -> dict | None:
+        """The conversation with its messages, fetching only messages newer than the cached ones."""
+        cached = self.conv_cache.get(conv_id)
+        params = {}
+        headers = {}
+        if cached is not None and len(cached["messages"]) > 0:
+            params["after"] = cached["messages"][-1]["message_id"]
+        if cached is not None and "etag" in cached:
+            headers["If-None-Match"] = cached["etag"]
+        response = await self.session.get(f"/api/conv/{conv_id}", params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached
+        if response.status_code != 200:
+            return None
+        conv_data = response.json()
+        if cached is not None and "after" in params:
+            conv_data["messages"] = cached["messages"] + conv_data["messages"]
+        if "ETag" in response.headers:
+            conv_data["etag"] = response.headers["ETag"]
+        self.conv_cache[conv_id] = conv_data
+        return conv_data
+
+    async def print_current_conv(self):
         if not self.current_conv:
             print("No active conversation. Use /conv [convid/new] to start or switch to a conversation.")
             return
-        response = requests.get(f"{self.base_url}/api/conv/{self.current_conv}", headers=self.headers)
-        if response.status_code == 200:
-            conv_data = response.json()
+        conv_data = await self._fetch_conv(self.current_conv)
+        if conv_data is not None:
             self._print_conv(conv_data)
         else:
             print("Failed to fetch conversation.")
 
-    def say(self, message: str):
+    async def say(self, message: str):
         if not self.current_conv:
             print("No active conversation. Use /conv [convid/new] to start or switch to a conversation.")
             return
         payload = {
             "content": [{"type": "text", "text": message}]
         }
-        response = requests.post(f"{self.base_url}/api/conv/{self.current_conv}", headers=self.headers, json=payload)
+        known = len(self.conv_cache.get(self.current_conv, {}).get("messages", []))
+        response = await self.session.post(f"/api/conv/{self.current_conv}", json=payload)
         if response.status_code == 200:
             reply = response.json()
-            self._print_conv(reply)
+            self.conv_cache[self.current_conv] = reply
+            self._print_messages(reply["messages"][known:])
         else:
             print("Failed to send message.")
 
-    def seqsay(self, message: str):
+    async def seqsay(self, message: str):
         if not self.current_conv:
             print("No active conversation. Use /conv [convid/new] to start or switch to a conversation.")
             return
         payload = {
             "content": [{"type": "text", "text": message}]
         }
-        response = requests.post(f"{self.base_url}/api/seq/{self.current_conv}", headers=self.headers, json=payload)
-        if response.status_code == 200:
-            reply = response.json()
-            self._print_seq(reply)
-        else:
-            print("Failed to send message.")
+        events = []
+        async with self.session.stream("POST", f"/api/seq/{self.current_conv}/stream", json=payload) as response:
+            if response.status_code != 200:
+                print("Failed to send message.")
+                return
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                match event["type"]:
+                    case "done":
+                        cached = self.seq_cache.get(self.current_conv)
+                        if cached is None or len(event["llm_request_ids"]) == 0:
+                            pass
+                        elif cached["last"] == event["after"]:
+                            # The streamed events were diffed against the end of the cached sequence.
+                            cached["events"].extend(events)
+                            cached["last"] = event["llm_request_ids"][-1]
+                        else:
+                            del self.seq_cache[self.current_conv]
+                    case "error":
+                        print(f"Failed to send message: {event['detail']}")
+                    case _:
+                        events.append(event)
+                        self._print_seq([event])
 
-    def delete_conversation(self, conv_id: str):
-        response = requests.delete(f"{self.base_url}/api/conv/{conv_id}", headers=self.headers)
+    async def delete_conversation(self, conv_id: str):
+        response = await self.session.delete(f"/api/conv/{conv_id}")
         if response.status_code == 200:
             print(f"Conversation {conv_id} deleted.")
+            self.conv_cache.pop(conv_id, None)
+            self.seq_cache.pop(conv_id, None)
             if self.current_conv == conv_id:
                 self.current_conv = ""
         else:
             print("Failed to delete conversation.")
 
-    def dig(self, llm_request_id: str):
-        response = requests.get(f"{self.base_url}/api/llm_request/{llm_request_id}", headers=self.headers)
-        if response.status_code == 200:
+    async def dig(self, llm_request_id: str):
+        cached = self.dig_cache.get(llm_request_id)
+        headers = {"If-None-Match": cached[0]} if cached is not None else {}
+        response = await self.session.get(f"/api/llm_request/{llm_request_id}", headers=headers)
+        if response.status_code == 304 and cached is not None:
+            print(f"LLM Request ID: {llm_request_id}")
+            self._print_dig(cached[1])
+        elif response.status_code == 200:
             diff_data = response.json()
+            if "ETag" in response.headers:
+                self.dig_cache[llm_request_id] = (response.headers["ETag"], diff_data)
             print(f"LLM Request ID: {llm_request_id}")
             self._print_dig(diff_data)
         else:
@@ -167,16 +248,29 @@ class Client:
             print("---")
         print("This was from conversation ID:", diff_data["conv_id"])
 
-    def seq(self, conv_id: str):
-        response = requests.get(f"{self.base_url}/api/seq/{conv_id}", headers=self.headers)
-        if response.status_code == 200:
-            seq_data = response.json()
+    async def seq(self, conv_id: str):
+        cached = self.seq_cache.get(conv_id)
+        # Without a last call there is no cursor yet; an empty ?after= is rejected.
+        params = {"after": cached["last"]} if cached is not None and cached["last"] is not None else {}
+        headers = {"If-None-Match": cached["etag"]} if cached is not None and "etag" in cached else {}
+        response = await self.session.get(f"/api/seq/{conv_id}", params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
             print(f"Sequence for conversation ID: {conv_id}")
-            self._print_seq(seq_data)
+            self._print_seq(cached["events"])
+        elif response.status_code == 200:
+            new_events = response.json()
+            if cached is None:
+                cached = self.seq_cache[conv_id] = {"events": [], "last": None}
+            cached["events"].extend(new_events)
+            cached["last"] = response.headers.get("X-Last-LLM-Request-Id", cached["last"])
+            if "ETag" in response.headers:
+                cached["etag"] = response.headers["ETag"]
+            print(f"Sequence for conversation ID: {conv_id}")
+            self._print_seq(cached["events"])
         else:
             print("Failed to fetch sequence data.")
 
-    def _print_seq(self, seq_data: dict):
+    def _print_seq(self, seq_data: list[dict]):
         for item in seq_data:
             if item["type"] == "context_change":
                 for line in item["delta"].splitlines():
@@ -195,62 +289,72 @@ class Client:
             elif item["type"] == "message":
                 for line in item["content"].splitlines():
                     print(f"  {line}")
+            elif item["type"] == "skipped":
+                print(f"  \33[31m(LLM call {item['llm_request_id']} too large to diff, skipped)\33[0m")
 
 
-if __name__ == "__main__":
+async def main():
     client = Client()
+    await client.open()
     try:
         readline.read_history_file(".history")
     except FileNotFoundError:
         pass
     client.print_menu()
 
-    while True:
-        inp = input(">> ").strip()
-        readline.write_history_file(".history")
-        words = inp.split()
-        if len(words) == 0:
-            continue
-        match words[0]:
-            case "/server":
-                if len(words) not in [2,3] or words[1] not in ["local", "cloud"]:
-                    print("Usage: /server [local/cloud] [apikey]")
-                    continue
+    try:
+        while True:
+            inp = (await asyncio.to_thread(input, ">> ")).strip()
+            readline.write_history_file(".history")
+            words = inp.split()
+            if len(words) == 0:
+                continue
+            match words[0]:
+                case "/server":
+                    if len(words) not in [2,3] or words[1] not in ["local", "cloud"]:
+                        print("Usage: /server [local/cloud] [apikey]")
+                        continue
 
-                client.reconfigure(words[1] == "local", words[2] if len(words) == 3 else None)
-                print("Configuration updated.")
-                client.ls_conv()
-            case "/conv":
-                if len(words) == 1:
-                    client.ls_conv()
-                    continue
+                    await client.reconfigure(words[1] == "local", words[2] if len(words) == 3 else None)
+                    print("Configuration updated.")
+                    await client.ls_conv()
+                case "/conv":
+                    if len(words) == 1:
+                        await client.ls_conv()
+                        continue
 
-                if len(words) == 3 and words[1] == "del":
-                    conv_id = words[2]
-                    client.delete_conversation(conv_id)
-                    continue
+                    if len(words) == 3 and words[1] == "del":
+                        conv_id = words[2]
+                        await client.delete_conversation(conv_id)
+                        continue
 
-                if len(words) != 2:
-                    print("Usage: /conv [convid/new]")
-                    continue
-                if words[1] == "new":
-                    client.switch_to_new_conv()
-                else:
-                    client.current_conv = words[1]
-                    print(f"Switched to conversation with ID: {client.current_conv}")
-            case "/ls":
-                client.print_current_conv()
-            case "/dig":
-                if len(words) != 2:
-                    print("Usage: /dig [llm_request_id]")
-                    continue
-                llm_request_id = words[1]
-                client.dig(llm_request_id)
-            case "/seq":
-                client.seq(client.current_conv)
-            case _:
-                if words[0].startswith("/"):
-                    print("Unknown command.")
-                    client.print_menu()
-                    continue
-                client.seqsay(inp)
\ No newline at end of file
+                    if len(words) != 2:
+                        print("Usage: /conv [convid/new]")
+                        continue
+                    if words[1] == "new":
+                        await client.switch_to_new_conv()
+                    else:
+                        client.current_conv = words[1]
+                        print(f"Switched to conversation with ID: {client.current_conv}")
+                case "/ls":
+                    await client.print_current_conv()
+                case "/dig":
+                    if len(words) != 2:
+                        print("Usage: /dig [llm_request_id]")
+                        continue
+                    llm_request_id = words[1]
+                    await client.dig(llm_request_id)
+                case "/seq":
+                    await client.seq(client.current_conv)
+                case _:
+                    if words[0].startswith("/"):
+                        print("Unknown command.")
+                        client.print_menu()
+                        continue
+                    await client.seqsay(inp)
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
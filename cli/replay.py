@@ -0,0 +1,140 @@
+"""Replay a JSONL file of user turns against the mux.
+
+Turns are read lazily and dealt round-robin to --conversations conversations;
+each conversation sends its turns one after another, so per-conversation order
+is kept. Pacing is closed-loop by default (at most --concurrency turns in
+flight) or open-loop with --rate, where turn i is due at i / rate seconds and
+latency is measured from when it was due, so a backed-up server shows up as
+latency instead of a slower send rate. One JSON record per turn goes to --out.
+
+    uv run replay.py ../requests.jsonl --conversations 4 --out replay.jsonl
+    uv run replay.py ../requests.jsonl --conversations 16 --rate 2 --endpoint conv
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import os
+import sys
+from time import perf_counter, time
+from typing import Optional, TextIO
+
+import httpx
+
+from cli2 import Client
+
+# Turn parsing and percentiles are shared with the mux's bench_load.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mux"))
+from corpus import percentile, read_turns
+
+QUEUE_DEPTH = 100
+
+@dataclass
+class Turn:
+    index: int
+    text: str
+    due: Optional[float]
+
+class Replay:
+    def __init__(self, http: httpx.AsyncClient, endpoint: str, concurrency: int, out: Optional[TextIO]):
+        self.http = http
+        self.endpoint = endpoint
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.out = out
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    async def create_conversation(self) -> str:
+        response = await self.http.post("/api/conv", json={})
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def send(self, conv_id: str, turn_in_conv: int, turn: Turn):
+        async with self.semaphore:
+            started = perf_counter()
+            record = {
+                "index": turn.index,
+                "conv_id": conv_id,
+                "turn_in_conv": turn_in_conv,
+                "timestamp": time(),
+                "queued_ms": round((started - turn.due) * 1000, 2) if turn.due is not None else 0.0
+            }
+            try:
+                response = await self.http.post(f"/api/{self.endpoint}/{conv_id}", json={"content": [{"type": "text", "text": turn.text}]})
+                record["status"] = response.status_code
+                if response.status_code == 200:
+                    body = response.json()
+                    record["items"] = len(body) if isinstance(body, list) else len(body.get("messages", []))
+                    record["response_bytes"] = len(response.content)
+                else:
+                    record["error"] = response.text[:500]
+            except httpx.HTTPError as e:
+                record["status"] = None
+                record["error"] = repr(e)
+        finished = perf_counter()
+        record["service_ms"] = round((finished - started) * 1000, 2)
+        # Open loop: latency counts from when the turn was due, not when it got sent.
+        record["latency_ms"] = round((finished - (turn.due if turn.due is not None else started)) * 1000, 2)
+        if record["status"] == 200:
+            self.latencies.append(record["latency_ms"])
+        else:
+            self.errors += 1
+        if self.out is not None:
+            self.out.write(json.dumps(record) + "\n")
+        return record
+
+    async def conversation_worker(self, conv_id: str, queue: asyncio.Queue[Optional[Turn]]):
+        turn_in_conv = 0
+        while (turn := await queue.get()) is not None:
+            await self.send(conv_id, turn_in_conv, turn)
+            turn_in_conv += 1
+
+async def replay(args: argparse.Namespace):
+    client = Client()
+    base_url = args.base_url or client.base_url
+    out = open(args.out, "w") if args.out else None
+    # httpx rejects the trailing space of "Bearer " when no apikey is configured.
+    headers = {name: value.strip() for name, value in client.headers.items()}
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=args.timeout) as http:
+        runner = Replay(http, args.endpoint, args.concurrency or args.conversations, out)
+        conv_ids = await asyncio.gather(*(runner.create_conversation() for _ in range(args.conversations)))
+        print(f"Replaying into {len(conv_ids)} conversations on {base_url}")
+        queues: list[asyncio.Queue[Optional[Turn]]] = [asyncio.Queue(maxsize=QUEUE_DEPTH) for _ in conv_ids]
+        workers = [asyncio.create_task(runner.conversation_worker(conv_id, queue)) for conv_id, queue in zip(conv_ids, queues)]
+        start = perf_counter()
+        for index, text in enumerate(read_turns(args.file, args.limit)):
+            due = None
+            if args.rate:
+                due = start + index / args.rate
+                await asyncio.sleep(max(due - perf_counter(), 0))
+            await queues[index % len(queues)].put(Turn(index, text, due))
+        for queue in queues:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        elapsed = perf_counter() - start
+        if args.delete:
+            for conv_id in conv_ids:
+                await http.delete(f"/api/conv/{conv_id}")
+    if out is not None:
+        out.close()
+
+    latencies = sorted(runner.latencies)
+    total = len(latencies) + runner.errors
+    print(f"{total} turns in {elapsed:.1f}s ({total / elapsed:.2f} turns/s), {runner.errors} errors")
+    for p in (50, 95, 99):
+        value = percentile(latencies, p)
+        print(f"  p{p}: {value:.0f} ms" if value is not None else f"  p{p}: -")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="JSONL of user turns")
+    parser.add_argument("--base-url", help="defaults to the server configured in cli2.py")
+    parser.add_argument("--conversations", type=int, default=4)
+    parser.add_argument("--endpoint", choices=["seq", "conv"], default="seq")
+    parser.add_argument("--concurrency", type=int, help="closed loop: max turns in flight (default: one per conversation)")
+    parser.add_argument("--rate", type=float, help="open loop: turns per second across all conversations")
+    parser.add_argument("--limit", type=int, help="stop after this many turns")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--out", help="write one JSON record per turn here")
+    parser.add_argument("--delete", action="store_true", help="delete the conversations afterwards")
+    asyncio.run(replay(parser.parse_args()))
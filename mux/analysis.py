@@ -0,0 +1,238 @@
+"""Prefix-cache and context-growth analysis over captured LLM calls.
+
+Walks each conversation's chat completions in order and compares every prompt,
+as the upstream cache sees it (tools, then messages, after any prompt
+rewriting), with the one before it: how many leading bytes are identical,
+how much is new, which earlier messages changed (the volatile regions) and how
+many tokens upstream reported as cached. Rows are read in keyset batches and
+only the previous prompt is kept, so memory does not grow with the history.
+
+    uv run analysis.py                              # summary over all conversations
+    uv run analysis.py --conv-id agent-... --steps  # every step of one conversation, then its summary
+"""
+import argparse
+from collections import Counter
+import difflib
+import json
+import re
+from typing import Any, Iterator, Optional
+from pydantic import BaseModel
+
+from db import db_connect, each_shard
+from retention import read_bodies
+from rewrite import BYTES_PER_TOKEN, cacheable_prompt, common_prefix_length
+
+ANALYSIS_BATCH_SIZE = 200
+VOLATILE_LINES_PER_REGION = 5
+VOLATILE_LINE_CHARS = 200
+TOP_VOLATILE_LINES = 20
+
+class VolatileRegion(BaseModel):
+    message: int
+    role: str
+    removed: list[str]
+    added: list[str]
+
+class PrefixStep(BaseModel):
+    llm_request_id: str
+    request_id: Optional[str]
+    timestamp: float
+    prompt_bytes: int
+    prompt_tokens: int
+    prefix_bytes: int
+    prefix_tokens: int
+    new_tokens: int
+    cached_tokens: Optional[int]
+    messages: int
+    evicted_messages: int
+    volatile: list[VolatileRegion]
+
+class PrefixSummary(BaseModel):
+    conversations: int = 0
+    turns: int = 0
+    steps: int = 0
+    prompt_tokens: int = 0
+    prefix_tokens: int = 0
+    cached_tokens: int = 0
+    new_tokens: int = 0
+    prefix_ratio: Optional[float] = None
+    cached_ratio: Optional[float] = None
+    uncached_prefix_tokens: int = 0
+    new_tokens_per_step: Optional[float] = None
+    growth_tokens_per_turn: Optional[float] = None
+    volatile_lines: dict[str, int] = {}
+
+def _message_lines(message: dict[str, Any]) -> list[str]:
+    content = message.get("content")
+    if content is None:
+        lines = []
+    else:
+        lines = content.split("\n") if isinstance(content, str) else [json.dumps(content)]
+    if message.get("tool_calls"):
+        lines.append(json.dumps(message["tool_calls"]))
+    return lines
+
+def _clip(lines: list[str]) -> list[str]:
+    return [line[:VOLATILE_LINE_CHARS] for line in lines[:VOLATILE_LINES_PER_REGION]]
+
+def volatile_regions(previous: dict[str, Any], current: dict[str, Any]) -> list[VolatileRegion]:
+    """Changes to what the previous request already contained; appended messages are not volatile."""
+    regions = []
+    if previous.get("tools") != current.get("tools"):
+        regions.append(VolatileRegion(message=-1, role="tools", removed=[], added=[]))
+    previous_messages = previous.get("messages") or []
+    current_messages = current.get("messages") or []
+    for index, (before, after) in enumerate(zip(previous_messages, current_messages)):
+        if before == after:
+            continue
+        removed = []
+        added = []
+        for line in difflib.ndiff(_message_lines(before), _message_lines(after)):
+            if line.startswith("- "):
+                removed.append(line[2:])
+            elif line.startswith("+ "):
+                added.append(line[2:])
+        regions.append(VolatileRegion(message=index, role=str(after.get("role")), removed=_clip(removed), added=_clip(added)))
+    return regions
+
+def _tokens(length: int, prompt_bytes: int, prompt_tokens: Optional[int]) -> int:
+    # Scale by the reported count when there is one; bytes per token varies a lot with JSON.
+    if prompt_tokens and prompt_bytes:
+        return round(length * prompt_tokens / prompt_bytes)
+    return length // BYTES_PER_TOKEN
+
+def _conversation_rows(conv_id: str) -> Iterator[tuple[str, Optional[str], float, Optional[int], Optional[int], Optional[str], Optional[str]]]:
+    """(id, request_id, timestamp, prompt_tokens, cached_tokens, upstream body, request body) in order, a batch at a time."""
+    after = (-1.0, -1)
+    while True:
+        with db_connect(conv_id) as conn:
+            cursor = conn.execute("""
+                SELECT llm_requests.rowid, llm_requests.id, llm_requests.correlated_request_id, llm_requests.timestamp,
+                    llm_requests.prompt_tokens, llm_requests.cached_tokens, llm_requests.upstream_request_body
+                FROM llm_requests JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+                WHERE user_requests.conv_id = :conv_id AND llm_requests.response_status = 200
+                    AND llm_requests.path LIKE '%chat/completions'
+                    AND (llm_requests.timestamp, llm_requests.rowid) > (:timestamp, :rowid)
+                ORDER BY llm_requests.timestamp, llm_requests.rowid
+                LIMIT :limit
+            """, {"conv_id": conv_id, "timestamp": after[0], "rowid": after[1], "limit": ANALYSIS_BATCH_SIZE})
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                return
+            bodies = read_bodies(conn, [row[1] for row in rows if row[6] is None])
+        for row in rows:
+            yield row[1], row[2], row[3], row[4], row[5], row[6], bodies.get(row[1], (None, None))[0]
+        after = (rows[-1][3], rows[-1][0])
+
+def analyze_conversation(conv_id: str) -> Iterator[PrefixStep]:
+    previous_prompt = b""
+    previous_request: dict[str, Any] = {}
+    for llm_request_id, request_id, timestamp, prompt_tokens, cached_tokens, upstream_body, request_body in _conversation_rows(conv_id):
+        body = upstream_body if upstream_body is not None else request_body
+        if body is None:
+            continue
+        prompt = cacheable_prompt(body.encode("utf-8"))
+        if prompt is None:
+            continue
+        request = json.loads(body)
+        prefix_bytes = common_prefix_length(prompt, previous_prompt)
+        estimated_tokens = prompt_tokens or len(prompt) // BYTES_PER_TOKEN
+        yield PrefixStep(
+            llm_request_id=llm_request_id,
+            request_id=request_id,
+            timestamp=timestamp,
+            prompt_bytes=len(prompt),
+            prompt_tokens=estimated_tokens,
+            prefix_bytes=prefix_bytes,
+            prefix_tokens=_tokens(prefix_bytes, len(prompt), prompt_tokens),
+            new_tokens=_tokens(len(prompt) - prefix_bytes, len(prompt), prompt_tokens),
+            cached_tokens=cached_tokens,
+            messages=len(request.get("messages") or []),
+            evicted_messages=max(len(previous_request.get("messages") or []) - len(request.get("messages") or []), 0),
+            volatile=volatile_regions(previous_request, request) if previous_request else []
+        )
+        previous_prompt = prompt
+        previous_request = request
+
+def _volatile_pattern(line: str) -> str:
+    return re.sub(r"\d+", "#", line)[:VOLATILE_LINE_CHARS]
+
+class PrefixAggregator:
+    def __init__(self):
+        self.summary = PrefixSummary()
+        self.growth: list[int] = []
+        self.volatile = Counter()
+        self.turn_start_tokens: Optional[int] = None
+        self.request_id: Optional[str] = None
+
+    def start_conversation(self):
+        self.summary.conversations += 1
+        self.turn_start_tokens = None
+        self.request_id = None
+
+    def add(self, step: PrefixStep):
+        summary = self.summary
+        summary.steps += 1
+        summary.prompt_tokens += step.prompt_tokens
+        summary.cached_tokens += step.cached_tokens or 0
+        if step.request_id != self.request_id:
+            summary.turns += 1
+            self.request_id = step.request_id
+            if self.turn_start_tokens is not None:
+                self.growth.append(step.prompt_tokens - self.turn_start_tokens)
+            self.turn_start_tokens = step.prompt_tokens
+        summary.new_tokens += step.new_tokens
+        summary.prefix_tokens += step.prefix_tokens
+        summary.uncached_prefix_tokens += max(step.prefix_tokens - (step.cached_tokens or 0), 0)
+        for region in step.volatile:
+            for line in region.added:
+                self.volatile[f"{region.role}: {_volatile_pattern(line)}"] += 1
+
+    def result(self) -> PrefixSummary:
+        summary = self.summary
+        if summary.prompt_tokens > 0:
+            summary.prefix_ratio = round(summary.prefix_tokens / summary.prompt_tokens, 4)
+            summary.cached_ratio = round(summary.cached_tokens / summary.prompt_tokens, 4)
+        if summary.steps > 0:
+            summary.new_tokens_per_step = round(summary.new_tokens / summary.steps, 1)
+        if len(self.growth) > 0:
+            summary.growth_tokens_per_turn = round(sum(self.growth) / len(self.growth), 1)
+        summary.volatile_lines = dict(self.volatile.most_common(TOP_VOLATILE_LINES))
+        return summary
+
+def analyzed_conversations(conv_ids: Optional[list[str]] = None) -> list[str]:
+    if conv_ids:
+        return conv_ids
+    conv_ids = set()
+    for conn in each_shard():
+        conv_ids.update(row[0] for row in conn.execute("SELECT DISTINCT conv_id FROM user_requests WHERE conv_id IS NOT NULL"))
+    return sorted(conv_ids)
+
+def conversation_lines(conv_id: str) -> Iterator[str]:
+    """NDJSON for the streaming endpoint: each step, then the conversation's summary."""
+    aggregator = PrefixAggregator()
+    aggregator.start_conversation()
+    for step in analyze_conversation(conv_id):
+        aggregator.add(step)
+        yield json.dumps({"type": "step", **step.model_dump()}) + "\n"
+    yield json.dumps({"type": "summary", **aggregator.result().model_dump()}) + "\n"
+
+def summarize(conv_ids: Optional[list[str]] = None) -> PrefixSummary:
+    aggregator = PrefixAggregator()
+    for conv_id in analyzed_conversations(conv_ids):
+        aggregator.start_conversation()
+        for step in analyze_conversation(conv_id):
+            aggregator.add(step)
+    return aggregator.result()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conv-id", action="append", help="limit to these conversations (repeatable)")
+    parser.add_argument("--steps", action="store_true", help="print every step as JSONL before the summary")
+    args = parser.parse_args()
+
+    if args.steps:
+        for conv_id in analyzed_conversations(args.conv_id):
+            for step in analyze_conversation(conv_id):
+                print(json.dumps({"conv_id": conv_id, **step.model_dump()}))
+    print(summarize(args.conv_id).model_dump_json(indent=2))
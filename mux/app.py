@@ -1,71 +1,221 @@
 import asyncio
 from contextlib import asynccontextmanager
-import json
+import importlib
 import os
-from time import time
-from typing import Optional
+from sqlite3 import Connection
+from time import perf_counter, time, time_ns
+from typing import AsyncIterator, Literal, Optional
 import uuid
-from fastapi import FastAPI, Request
-from sqlite3 import connect
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
-from client_letta import LettaClient
-from client_interface import ClientInterface, Content, Message
-from proxy import ProxyOpenAI
-from differ import diff_llm_request, diff_sequence
+from analysis import conversation_lines as prefix_analysis_lines, summarize as summarize_prefixes
+from capture import capture_writer
+from client_interface import ClientInterface, Content, Conversation, Message
+from db import db_connect, each_shard, init_schema, llm_request_shard, register_request, shard_connect
+from export import export_stream, import_stream
+from http_cache import CompressionMiddleware, conversation_version, etag_matches, llm_request_version, make_etag, not_modified, set_etag
+from jsoncodec import FastJSONResponse, dumps, dumps_text
+from precompute import parsed_fields, read_parsed, store_parsed, unparsed_llm_request_ids
+from proxy import ProxyOpenAI, close_upstream_client, upstream_client
+from disconnect import CANCELLED_STATUS, ClientDisconnected, TurnCalls, until_disconnected
+from differ import LLMContext, diff_llm_request
+from metrics import CONTENT_TYPE, DB_SECONDS, PROXY_IN_FLIGHT, REGISTRY, TURN_SECONDS, TURNS_IN_FLIGHT, timed_lock
+from profiling import ProfileMiddleware, profiled, read_profile
+from rewrite import rewrite_request
+from retention import RETENTION_INTERVAL_SECONDS, RETENTION_PURGE_ON_DELETE, purge_conversation, read_bodies, retention_enabled, run_retention
+from search import rebuild as rebuild_search, search
+from sequences import SEQUENCE_MEMORY_BYTES, SequenceReader, body_sizes, sequence_pipeline
+from tracing import SpanContext, render_waterfall, tracer, waterfall
+from usage import UsageGroupBy, aggregate_usage, backfill_usage, extract_usage, request_model
+from workers import CORRELATOR_LOCK_PATH, WORKERS, SharedLock, read_correlation, write_correlation
+
+STREAM_POLL_SECONDS = 0.5
+# "letta" talks to the Letta server, "dummy" to client_dummy's in-memory stand-in.
+CLIENT_BACKEND = os.environ.get("MUX_CLIENT", "letta")
+CLIENT_MODULES = {"letta": "client_letta", "dummy": "client_dummy"}
+BATCH_CONCURRENCY = int(os.environ.get("MUX_BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONVERSATIONS = 200
 
 class ProxyCorrelator:
     def __init__(self):
         self.current_request_id = None
-        self.lock = asyncio.Lock()
+        self.current_span_context = None
+        self.lock = SharedLock(CORRELATOR_LOCK_PATH)
     
     @asynccontextmanager
     async def correlation_context(self, request_id: str):
-        """Ensure only one client call happens at a time"""
-        async with self.lock:
+        """Ensure only one client call happens at a time, across all workers"""
+        wait_start = time_ns()
+        async with timed_lock(self.lock):
+            tracer.record("correlator.wait", wait_start, time_ns())
             self.current_request_id = request_id
+            self.current_span_context = tracer.current_context()
+            await asyncio.to_thread(write_correlation, request_id, self.current_span_context)
             try:
                 yield
             finally:
                 self.current_conv_id = None
                 self.current_request_id = None
+                self.current_span_context = None
+                await asyncio.to_thread(write_correlation, None, None)
     
+    def holds(self, request_id: Optional[str]) -> bool:
+        return request_id is not None and request_id == self.current_request_id
+
+    def get_current(self) -> tuple[Optional[str], Optional[SpanContext]]:
+        if self.current_request_id is not None:
+            return self.current_request_id, self.current_span_context
+        # Another worker may be running the turn.
+        return read_correlation()
+
+async def _retention_loop():
+    while True:
+        try:
+            result = await asyncio.to_thread(run_retention)
+            print(f"Retention pass: {result}")
+        except Exception as e:
+            print(f"Retention pass failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+async def _precompute(conv_id: str):
+    try:
+        llm_request_ids = await asyncio.to_thread(unparsed_llm_request_ids, conv_id)
+        if len(llm_request_ids) == 0:
+            return
+        visible_parts = await _retrieve(conv_id)
+        await store_parsed(conv_id, llm_request_ids, visible_parts["messages"])
+    except Exception as e:
+        print(f"Precomputing LLM requests of {conv_id} failed: {e}")
+
+def _schedule_precompute(conv_id: str):
+    task = asyncio.create_task(_precompute(conv_id))
+    precompute_tasks.add(task)
+    task.add_done_callback(precompute_tasks.discard)
+
+class TurnStreams:
+    """Hands each LLM call captured by /proxy to the streaming endpoint waiting on its turn."""
+    def __init__(self):
+        self.queues: dict[str, asyncio.Queue[tuple[str, str, str]]] = {}
+
+    def subscribe(self, request_id: str) -> asyncio.Queue[tuple[str, str, str]]:
+        queue: asyncio.Queue[tuple[str, str, str]] = asyncio.Queue()
+        self.queues[request_id] = queue
+        return queue
+
+    def unsubscribe(self, request_id: str):
+        self.queues.pop(request_id, None)
 
-    def get_current_request_id(self) -> Optional[str]:
-        return self.current_request_id
-
-def db_connect():
-    conn = connect('storage/conversations.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_requests (
-            id TEXT PRIMARY KEY,
-            conv_id TEXT,
-            user_message_id TEXT,
-            assistant_message_id TEXT
-        );
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS llm_requests (
-            id TEXT PRIMARY KEY,
-            timestamp DATETIME,
-            path TEXT,
-            method TEXT,
-            request_body TEXT,
-            response_status INTEGER,
-            response_body TEXT,
-            duration_ms INTEGER,
-            correlated_request_id TEXT
-        );
-    ''')
-    conn.commit()
-    return conn
-
-app = FastAPI()
+    def publish(self, request_id: Optional[str], llm_request_id: str, request_body: bytes, response_body: bytes):
+        if request_id is None:
+            return
+        queue = self.queues.get(request_id)
+        if queue is not None:
+            queue.put_nowait((llm_request_id, request_body.decode("utf-8"), response_body.decode("utf-8")))
+
+class Readiness:
+    """What /ready waits for. /ping, answered by nginx, only says the container is up."""
+    CHECKS = ("schema", "capture_writer", "upstream", "client")
+
+    def __init__(self):
+        self.started_at = perf_counter()
+        self.warm: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+
+    def mark(self, check: str):
+        self.warm[check] = round(perf_counter() - self.started_at, 4)
+
+    @property
+    def ready(self) -> bool:
+        return all(check in self.warm for check in self.CHECKS)
+
+async def _warm_client():
+    try:
+        # The SDKs take most of the import time, so import off the event loop.
+        await asyncio.to_thread(importlib.import_module, CLIENT_MODULES[CLIENT_BACKEND])
+        get_client()
+        readiness.mark("client")
+    except Exception as e:
+        readiness.errors["client"] = str(e)
+        print(f"Warming the {CLIENT_BACKEND} client failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global readiness
+    readiness = Readiness()
+    with db_connect() as conn:
+        init_schema(conn)
+    readiness.mark("schema")
+    await capture_writer.start()
+    sequence_pipeline.start()
+    readiness.mark("capture_writer")
+    upstream_client()
+    readiness.mark("upstream")
+    warm_task = asyncio.create_task(_warm_client())
+    retention_task = asyncio.create_task(_retention_loop()) if retention_enabled() else None
+    yield
+    warm_task.cancel()
+    if retention_task is not None:
+        retention_task.cancel()
+    await asyncio.gather(*precompute_tasks, return_exceptions=True)
+    await sequence_pipeline.stop()
+    await capture_writer.stop()
+    await close_upstream_client()
+    await close_client()
+    tracer.shutdown()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(ProfileMiddleware)
+app.add_middleware(CompressionMiddleware)
 correlator = ProxyCorrelator()
+turn_streams = TurnStreams()
+turn_calls = TurnCalls()
+precompute_tasks: set[asyncio.Task] = set()
+readiness = Readiness()
+_client: Optional[ClientInterface] = None
 
 def get_client() -> ClientInterface:
-    return LettaClient()
+    """The process's one client of the MUX_CLIENT backend, so turns reuse its connections and state."""
+    global _client
+    if _client is None:
+        match CLIENT_BACKEND:
+            case "dummy":
+                from client_dummy import DummyClient
+                # Its completions come back in through this app's /proxy.
+                _client = DummyClient(app)
+            case "letta":
+                from client_letta import LettaClient
+                _client = LettaClient()
+            case other:
+                raise Exception(f"Unknown MUX_CLIENT {other!r}")
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    # Nobody reads this; it only ends up in the access log.
+    return Response(status_code=CANCELLED_STATUS)
+
+@app.get('/ready')
+async def ready(response: Response):
+    if not readiness.ready:
+        response.status_code = 503
+    return {
+        "ready": readiness.ready,
+        "client": CLIENT_BACKEND,
+        "warm": readiness.warm,
+        "errors": readiness.errors
+    }
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
 
 @app.get('/api/conv')
 async def conv_list():
@@ -83,33 +233,87 @@ async def conv_create():
 async def conv_delete(conv_id: str):
     async with get_client() as client:
         if await client.delete_conversation(conv_id):
+            if RETENTION_PURGE_ON_DELETE:
+                await asyncio.to_thread(purge_conversation, conv_id)
             return {"status": f"Conversation deleted: {conv_id}"}
         else:
             raise Exception("Conversation not found")
 
-def _get_correlated_llm_requests(message_id_list: list[str]) -> dict[str, list[str]]:
+def _get_correlated_llm_requests(message_id_list: list[str], conv_ids: list[str]) -> dict[str, list[str]]:
+    if len(message_id_list) == 0:
+        return {}
+    # One query per database for every message, however many conversations they come from.
     query = """
-        SELECT llm_requests.id FROM llm_requests INNER JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id WHERE user_requests.user_message_id = ? OR user_requests.assistant_message_id = ?
+        SELECT message_ids.value, llm_requests.id
+        FROM json_each(?) AS message_ids
+        INNER JOIN user_requests ON user_requests.user_message_id = message_ids.value OR user_requests.assistant_message_id = message_ids.value
+        INNER JOIN llm_requests ON llm_requests.correlated_request_id = user_requests.id
+        ORDER BY message_ids.key, llm_requests.timestamp
     """
     correlated_requests:dict[str,list[str]] = {}
-    with db_connect() as conn:
-        cursor = conn.cursor()
-        for message_id in message_id_list:
-            cursor.execute(query, (message_id, message_id))
-            rows = list(cursor.fetchall())
-            if len(rows) >= 1:
-                correlated_requests[message_id] = [row[0] for row in rows]
+    for conn in each_shard(conv_ids):
+        for message_id, llm_request_id in conn.execute(query, (dumps_text(message_id_list),)):
+            correlated_requests.setdefault(message_id, []).append(llm_request_id)
     return correlated_requests
 
+class ConvBatchGetRequest(BaseModel):
+    conv_ids: list[str]
+    # Only the last `tail` messages of each conversation.
+    tail: Optional[int] = Field(None, ge=1)
+    # Per conversation, only the messages after this one, like ?after= on GET /api/conv/{conv_id}.
+    after: dict[str, str] = {}
+
+async def _batch_get_messages(conv_id: str, request: ConvBatchGetRequest, semaphore: asyncio.Semaphore) -> tuple[Conversation, list[Message]] | Exception:
+    async with semaphore:
+        try:
+            async with get_client() as client:
+                if request.tail is not None and conv_id not in request.after:
+                    return await client.get_recent_messages(conv_id, request.tail)
+                conversation, messages = await client.get_messages(conv_id, after=request.after.get(conv_id))
+                return conversation, messages[-request.tail:] if request.tail is not None else messages
+        except Exception as e:
+            return e
+
+@app.post('/api/conv/batch_get')
+async def conv_batch_get(request: ConvBatchGetRequest):
+    """Several conversations in one response. Letta is called for at most MUX_BATCH_CONCURRENCY of them at a time."""
+    if len(request.conv_ids) > BATCH_MAX_CONVERSATIONS:
+        raise HTTPException(422, f"At most {BATCH_MAX_CONVERSATIONS} conversations per batch")
+    conv_ids = list(dict.fromkeys(request.conv_ids))
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = await asyncio.gather(*(_batch_get_messages(conv_id, request, semaphore) for conv_id in conv_ids))
+    message_ids = [m.message_id for result in results if not isinstance(result, Exception) for m in result[1]]
+    correlated = await asyncio.to_thread(_get_correlated_llm_requests, message_ids, conv_ids)
+    conversations = []
+    for conv_id, result in zip(conv_ids, results):
+        if isinstance(result, Exception):
+            conversations.append({"id": conv_id, "error": str(result)})
+            continue
+        conversation, messages = result
+        for message in messages:
+            message.llm_request_ids = correlated.get(message.message_id, [])
+        conversations.append({
+            "id": conversation.id,
+            "created_at": conversation.created_at,
+            "topic": conversation.topic,
+            "messages": messages
+        })
+    return FastJSONResponse({"conversations": conversations})
+
 
 @app.get('/api/conv/{conv_id}')
-async def conv_retrieve(conv_id: str):
-    return await _retrieve(conv_id)
+async def conv_retrieve(conv_id: str, request: Request, response: Response, after: str | None = None):
+    with db_connect(conv_id) as conn:
+        etag = make_etag("conv", conv_id, conversation_version(conn, conv_id), after)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    return _json(await _retrieve(conv_id, after), response)
 
-async def _retrieve(conv_id: str):
+async def _retrieve(conv_id: str, after: str | None = None):
     async with get_client() as client:
-        conversation, messages = await client.get_messages(conv_id)
-        correlated = _get_correlated_llm_requests([m.message_id for m in messages])
+        conversation, messages = await client.get_messages(conv_id, after=after)
+        correlated = _get_correlated_llm_requests([m.message_id for m in messages], [conv_id])
         for message in messages:
             message.llm_request_ids = correlated.get(message.message_id, [])
     return {
@@ -124,7 +328,7 @@ async def _retrieve1(conv_id: str, request_id: str):
         SELECT id FROM llm_requests WHERE correlated_request_id = ?
     """
     correlated_requests:list[str] = []
-    with db_connect() as conn:
+    with db_connect(conv_id) as conn:
         cursor = conn.cursor()
         cursor.execute(query, (request_id,))
         rows = list(cursor.fetchall())
@@ -134,24 +338,119 @@ class ConvPostRequest(BaseModel):
     content: list[Content]
 
 @app.post('/api/conv/{conv_id}')
-async def conv_post(conv_id: str, request: ConvPostRequest):
-    await _do_post(conv_id, request.content)
-    return await _retrieve(conv_id)
+async def conv_post(conv_id: str, request: ConvPostRequest, http_request: Request):
+    await until_disconnected(http_request, _do_post(conv_id, request.content))
+    return FastJSONResponse(await _retrieve(conv_id))
 
 @app.post('/api/seq/{conv_id}')
-async def seq_post(conv_id: str, request: ConvPostRequest):
+async def seq_post(conv_id: str, request: ConvPostRequest, http_request: Request):
     all_prev_request_ids = await _get_all_llm_request_ids(conv_id)
     if len(all_prev_request_ids) == 0:
         initial = None
     else:
         initial = all_prev_request_ids[-1]
-    request_id = await _do_post(conv_id, request.content)
+    request_id = await until_disconnected(http_request, _do_post(conv_id, request.content))
+    # The turn's events were diffed while Letta worked; wait for the last call's and commit them.
+    await sequence_pipeline.wait(request_id)
+    await capture_writer.flush()
     llm_request_ids = await _retrieve1(conv_id, request_id)
-    return await _seq_retrieve_llm_request_ids(conv_id, llm_request_ids, initial=initial)
+    return StreamingResponse(_seq_retrieve_llm_request_ids(conv_id, llm_request_ids, initial=initial), media_type="application/json")
 
-async def _do_post(conv_id: str, content: list[Content]):
+@app.post('/api/seq/{conv_id}/stream')
+async def seq_post_stream(conv_id: str, request: ConvPostRequest):
+    """Like POST /api/seq, but streams the events as NDJSON while Letta is still working."""
+    all_prev_request_ids = await _get_all_llm_request_ids(conv_id)
+    context = LLMContext()
+    if len(all_prev_request_ids) > 0:
+        with db_connect(conv_id) as conn:
+            initial_request_body, initial_response_body = read_bodies(conn, all_prev_request_ids[-1:]).get(all_prev_request_ids[-1], (None, None))
+        if initial_request_body is not None and initial_response_body is not None:
+            context.update_and_push_response(initial_request_body, initial_response_body)
     request_id = str(uuid.uuid4())
-    with db_connect() as conn:
+    queue = turn_streams.subscribe(request_id)
+    turn = asyncio.create_task(_do_post(conv_id, request.content, request_id=request_id))
+
+    def lines(llm_request_id: str, request_body: str, response_body: str):
+        return b"".join(
+            dumps({**event.model_dump(), "llm_request_id": llm_request_id}) + b"\n"
+            for event in context.update_and_push_response(request_body, response_body)
+        )
+
+    async def stream():
+        llm_request_ids = []
+        try:
+            while not turn.done() or not queue.empty():
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait([get, turn], timeout=STREAM_POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                if get.done():
+                    captured = [get.result()]
+                else:
+                    get.cancel()
+                    # /proxy calls served by another worker only show up in the database.
+                    captured = await asyncio.to_thread(_committed_llm_requests, conv_id, request_id, llm_request_ids)
+                for llm_request_id, request_body, response_body in captured:
+                    if llm_request_id not in llm_request_ids:
+                        llm_request_ids.append(llm_request_id)
+                        yield lines(llm_request_id, request_body, response_body)
+            if turn.exception() is None:
+                for llm_request_id, request_body, response_body in await asyncio.to_thread(_committed_llm_requests, conv_id, request_id, llm_request_ids):
+                    llm_request_ids.append(llm_request_id)
+                    yield lines(llm_request_id, request_body, response_body)
+            if turn.exception() is not None:
+                yield dumps({"type": "error", "detail": str(turn.exception())}) + b"\n"
+            else:
+                yield dumps({
+                    "type": "done",
+                    "request_id": request_id,
+                    "after": all_prev_request_ids[-1] if len(all_prev_request_ids) > 0 else None,
+                    "llm_request_ids": llm_request_ids
+                }) + b"\n"
+        finally:
+            # Starlette closes the stream when the client disconnects; the turn goes with it.
+            if not turn.done():
+                turn.cancel()
+            turn_streams.unsubscribe(request_id)
+    # nginx buffers proxied responses unless told not to, which would hold the lines back until the turn ends.
+    return StreamingResponse(stream(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+def _json(content, response: Response) -> FastJSONResponse:
+    # A returned response skips FastAPI's jsonable_encoder walk; keep the headers set on the injected one.
+    return FastJSONResponse(content, headers=response.headers)
+
+def _committed_llm_requests(conv_id: str, request_id: str, seen: list[str]) -> list[tuple[str, str, str]]:
+    with db_connect(conv_id) as conn:
+        cursor = conn.execute("""
+            SELECT id FROM llm_requests WHERE correlated_request_id = ? AND response_status = 200 ORDER BY timestamp
+        """, (request_id,))
+        llm_request_ids = [row[0] for row in cursor.fetchall() if row[0] not in seen]
+        bodies = read_bodies(conn, llm_request_ids)
+    return [
+        (llm_request_id, *bodies[llm_request_id]) for llm_request_id in llm_request_ids
+        if bodies.get(llm_request_id, (None, None))[0] is not None and bodies[llm_request_id][1] is not None
+    ]
+
+async def _do_post(conv_id: str, content: list[Content], request_id: str | None = None):
+    start_time = perf_counter()
+    outcome = "error"
+    request_id = request_id or str(uuid.uuid4())
+    with TURNS_IN_FLIGHT.track(), tracer.span("turn", **{"mux.request_id": request_id, "mux.conv_id": conv_id}):
+        try:
+            await _do_post_correlated(conv_id, content, request_id)
+            outcome = "ok"
+            _schedule_precompute(conv_id)
+            return request_id
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            # Letta's /proxy calls for this turn would otherwise keep waiting on upstream.
+            turn_calls.cancel(request_id)
+            raise
+        finally:
+            TURN_SECONDS.observe(perf_counter() - start_time, outcome=outcome)
+
+async def _do_post_correlated(conv_id: str, content: list[Content], request_id: str):
+    # Before Letta calls /proxy, so its calls are captured into the conversation's shard.
+    register_request(request_id, conv_id)
+    with DB_SECONDS.time(op="user_request_insert"), tracer.span("db.user_request_insert"), db_connect(conv_id) as conn:
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO user_requests (id, conv_id)
@@ -167,7 +466,7 @@ async def _do_post(conv_id: str, content: list[Content]):
             if resp is None:
                 raise Exception("Conversation not found")
             user_message_id, assistant_message_id = resp
-            with db_connect() as conn:
+            with DB_SECONDS.time(op="user_request_update"), tracer.span("db.user_request_update"), db_connect(conv_id) as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     UPDATE user_requests
@@ -180,113 +479,272 @@ async def _do_post(conv_id: str, content: list[Content]):
                     request_id
                 ))
                 conn.commit()
-    return request_id
+    # Everything /proxy captured during the turn is readable once the turn returns.
+    await capture_writer.flush()
 
 @app.get("/api/llm_request")
 async def llm_request_list():
-    with db_connect() as conn:
+    rows = []
+    for conn in each_shard():
         cursor = conn.cursor()
         cursor.execute("SELECT llm_requests.id, conv_id, user_message_id, assistant_message_id FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id")
-        rows = cursor.fetchall()
-        return [{
-            "id": row[0],
-            "correlated_conversation_id": row[1],
-            "user_message_id": row[2],
-            "assistant_message_id": row[3]
-        } for row in rows]
+        rows.extend(cursor.fetchall())
+    return [{
+        "id": row[0],
+        "correlated_conversation_id": row[1],
+        "user_message_id": row[2],
+        "assistant_message_id": row[3]
+    } for row in rows]
 
 @app.get("/api/llm_request/{llm_request_id}")
-async def llm_request_retrieve(llm_request_id: str):
-    with db_connect() as conn:
+async def llm_request_retrieve(llm_request_id: str, request: Request, response: Response):
+    with shard_connect(llm_request_shard(llm_request_id)) as conn:
+        version = llm_request_version(conn, llm_request_id)
+        if version is not None:
+            etag = make_etag("llm_request", llm_request_id, version)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            set_etag(response, etag)
+        parsed = read_parsed(conn, llm_request_id)
+        if parsed is not None:
+            return _json(parsed, response)
+        # Not precomputed yet, or archived: classify against the conversation as it is now.
         cursor = conn.cursor()
-        cursor.execute("SELECT llm_requests.request_body, llm_requests.response_body, user_requests.conv_id FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id WHERE llm_requests.id = ?", (llm_request_id,))
+        cursor.execute("SELECT user_requests.conv_id, llm_requests.archived FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id WHERE llm_requests.id = ?", (llm_request_id,))
         row = cursor.fetchone()
         if row is None:
             raise Exception("LLM Request not found")
-        llm_request_body = row[0]
-        llm_response_body = row[1]
-        conv_id = row[2]
+        conv_id, archived = row
+        if body_sizes(conn, [llm_request_id]).get(llm_request_id, 0) > SEQUENCE_MEMORY_BYTES:
+            raise Exception("LLM Request body is larger than MUX_SEQUENCE_MEMORY_BYTES")
+        llm_request_body, llm_response_body = read_bodies(conn, [llm_request_id])[llm_request_id]
+        if llm_request_body is None or llm_response_body is None:
+            raise Exception("LLM Request body not found")
         visible_parts = await _retrieve(conv_id)
         diff, available_tools = diff_llm_request(llm_request_body, llm_response_body, visible_parts["messages"])
-        return {
+        if conv_id is not None and not archived:
+            await capture_writer.submit("llm_request_parsed", llm_request_id, parsed_fields(conv_id, diff, available_tools))
+        return _json({
             "id": llm_request_id,
             "conv_id": conv_id,
             "messages": diff,
             "available_tools": available_tools
-        }
+        }, response)
+
+@app.get("/api/usage")
+async def usage_aggregate(group_by: UsageGroupBy = "model", since: float | None = None, until: float | None = None, bucket_seconds: int = Query(3600, ge=1), conv_id: str | None = None):
+    groups = await asyncio.to_thread(aggregate_usage, group_by, since, until, bucket_seconds, conv_id)
+    return {"group_by": group_by, "groups": groups}
+
+@app.post("/api/usage/backfill")
+async def usage_backfill():
+    updated = await asyncio.to_thread(backfill_usage)
+    return {"updated": updated}
+
+@app.get("/api/search")
+async def search_llm_requests(q: str, conv_id: str | None = None, syntax: Literal["plain", "fts"] = "plain", limit: int = Query(20, ge=1, le=200)):
+    hits = await asyncio.to_thread(search, q, syntax, conv_id, limit)
+    return {"query": q, "hits": hits}
+
+@app.post("/api/search/rebuild")
+async def search_rebuild():
+    indexed = await asyncio.to_thread(rebuild_search)
+    return {"indexed": indexed}
+
+@app.get("/api/analysis/prefix")
+async def prefix_analysis(conv_id: list[str] | None = Query(None)):
+    return await asyncio.to_thread(summarize_prefixes, conv_id)
+
+@app.get("/api/analysis/prefix/{conv_id}")
+async def prefix_analysis_conversation(conv_id: str):
+    # A sync generator; Starlette iterates it on a worker thread.
+    return StreamingResponse(prefix_analysis_lines(conv_id), media_type="application/x-ndjson")
+
+@app.get("/api/export")
+async def export(conv_id: list[str] | None = Query(None), since: float | None = None, until: float | None = None, compress: str | None = None):
+    gzip = compress == "gzip"
+    return StreamingResponse(
+        export_stream(conv_id, since, until, compress=gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename=mux-export.jsonl{'.gz' if gzip else ''}"}
+    )
+
+@app.post("/api/import")
+async def import_(request: Request):
+    counts = await import_stream(request.stream())
+    return {"imported": counts}
+
+@app.get("/api/trace/{request_id}")
+async def trace_retrieve(request_id: str, format: str = "json"):
+    spans = await asyncio.to_thread(tracer.read_trace, request_id)
+    if len(spans) == 0:
+        raise Exception("Trace not found")
+    rows = waterfall(spans)
+    if format == "text":
+        return PlainTextResponse(render_waterfall(rows))
+    return {
+        "request_id": request_id,
+        "trace_id": spans[0].trace_id,
+        "spans": rows
+    }
+
+@app.get("/api/profile/{profile_id}")
+async def profile_retrieve(profile_id: str):
+    report = read_profile(profile_id)
+    if report is None:
+        raise Exception("Profile not found")
+    return PlainTextResponse(report)
 
 @app.get('/api/seq/{conv_id}')
-async def seq_retrieve(conv_id: str):
-    llm_request_ids = await _get_all_llm_request_ids(conv_id)
-    return await _seq_retrieve_llm_request_ids(conv_id, llm_request_ids)
+async def seq_retrieve(conv_id: str, request: Request, response: Response, after: str | None = None):
+    """With ?after=<llm_request_id>, only the events of later LLM calls, diffed against that one."""
+    with db_connect(conv_id) as conn:
+        if after is not None and not _is_conversation_llm_request(conn, conv_id, after):
+            # An empty or foreign cursor would otherwise read as "nothing new" forever.
+            raise HTTPException(400, f"after is not an LLM request of conversation {conv_id}")
+        etag = make_etag("seq", conv_id, conversation_version(conn, conv_id), after)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    if after is None:
+        llm_request_ids = await _get_all_llm_request_ids(conv_id)
+    else:
+        llm_request_ids = _get_llm_request_ids_after(conv_id, after)
+    # Clients pass this back as ?after= to fetch only what is new.
+    if len(llm_request_ids) > 0:
+        response.headers["X-Last-LLM-Request-Id"] = llm_request_ids[-1]
+    elif after is not None:
+        response.headers["X-Last-LLM-Request-Id"] = after
+    return StreamingResponse(_seq_retrieve_llm_request_ids(conv_id, llm_request_ids, initial=after), media_type="application/json", headers=response.headers)
+
+def _is_conversation_llm_request(conn: Connection, conv_id: str, llm_request_id: str) -> bool:
+    cursor = conn.execute("""
+        SELECT 1 FROM llm_requests INNER JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+        WHERE llm_requests.id = ? AND user_requests.conv_id = ?
+    """, (llm_request_id, conv_id))
+    return cursor.fetchone() is not None
+
+def _get_llm_request_ids_after(conv_id: str, after: str) -> list[str]:
+    with db_connect(conv_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT llm_requests.id FROM llm_requests INNER JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE user_requests.conv_id = ? AND llm_requests.timestamp > (SELECT timestamp FROM llm_requests WHERE id = ?)
+            ORDER BY llm_requests.timestamp
+        """, (conv_id, after))
+        return [row[0] for row in cursor.fetchall()]
 
 async def _get_all_llm_request_ids(conv_id: str) -> list[str]:
     messages = (await _retrieve(conv_id))["messages"]
-    llm_request_ids = []
+    # A turn's requests are correlated with both its user and its assistant message.
+    llm_request_ids: dict[str, None] = {}
     for msg in messages:
         if msg.llm_request_ids is not None:
-            llm_request_ids.extend(msg.llm_request_ids)
-    return llm_request_ids
+            llm_request_ids.update(dict.fromkeys(msg.llm_request_ids))
+    return list(llm_request_ids)
 
-async def _seq_retrieve_llm_request_ids(conv_id: str, llm_request_ids: list[str], initial: str|None=None):
-    sequence:list[tuple[str,str]] = []
-    initial_body:Optional[tuple[str,str]] = None
-    with db_connect() as conn:
-        cursor = conn.cursor()
-        for llm_request_id in llm_request_ids:
-            cursor.execute("SELECT request_body, response_body FROM llm_requests WHERE id = ?", (llm_request_id,))
-            row = cursor.fetchone()
-            if row is not None:
-                sequence.append((row[0], row[1]))
-        if initial is not None:
-            cursor.execute("SELECT request_body, response_body FROM llm_requests WHERE id = ?", (initial,))
-            row = cursor.fetchone()
-            if row is not None:
-                initial_body = (row[0], row[1])
-    return diff_sequence(sequence, initial_body)
+async def _seq_retrieve_llm_request_ids(conv_id: str, llm_request_ids: list[str], initial: str|None=None) -> AsyncIterator[bytes]:
+    """The events as a JSON array, streamed a batch of calls at a time, from llm_request_events where the pipeline already stored them."""
+    reader = SequenceReader(conv_id, llm_request_ids, initial)
+    separator = b"["
+    while not reader.done():
+        fragments, computed = await asyncio.to_thread(profiled, reader.next_batch)
+        for llm_request_id, fields in computed.items():
+            await capture_writer.submit("llm_request_events", llm_request_id, fields)
+        for fragment in fragments:
+            yield separator + fragment
+            separator = b","
+    yield b"[]" if separator == b"[" else b"]"
 
 @app.api_route("/proxy/{path:path}", methods=["GET", "POST"])
 async def proxy(request: Request, path: str):
+    with PROXY_IN_FLIGHT.track():
+        return await _proxy(request, path)
+
+async def _proxy(request: Request, path: str):
     body = await request.body()
     llm_request_id = str(uuid.uuid4())
+    model = request_model(body)
+    correlated_request_id, span_context = correlator.get_current()
+    with tracer.span("proxy", parent=span_context, **{
+        "mux.llm_request_id": llm_request_id,
+        "http.route": path,
+        "gen_ai.request.model": model
+    }) as span:
+        response = await _proxy_captured(request, path, body, llm_request_id, model, correlated_request_id)
+        span.set_attribute("http.status_code", response.status_code)
+        return response
 
-    with db_connect() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO llm_requests (id, timestamp, path, method, request_body, correlated_request_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            llm_request_id,
-            time(),
-            path.removeprefix("proxy/"),
-            "POST",
-            body.decode('utf-8'),
-            correlator.get_current_request_id()
-        ))
-        conn.commit()
+async def _proxy_captured(request: Request, path: str, body: bytes, llm_request_id: str, model: str, correlated_request_id: Optional[str]):
+    timestamp = time()
+    await capture_writer.submit("llm_requests", llm_request_id, {
+        "timestamp": timestamp,
+        "path": path.removeprefix("proxy/"),
+        "method": "POST",
+        "request_body": body,
+        "correlated_request_id": correlated_request_id,
+        "model": model or None
+    })
+    upstream_body = None
+    rewritten = rewrite_request(path.removeprefix("proxy/"), body)
+    if rewritten is not None:
+        upstream_body, moved_lines = rewritten
+        await capture_writer.submit("llm_requests", llm_request_id, {
+            "correlated_request_id": correlated_request_id,
+            "upstream_request_body": upstream_body,
+            "prompt_rewrites": moved_lines
+        })
 
     # Forward to actual LLM API
     start_time = time()
-    response = await ProxyOpenAI().handle(request, path.removeprefix("proxy/"))
+    forward = asyncio.create_task(ProxyOpenAI().handle(request, path.removeprefix("proxy/"), model=model, body=upstream_body))
+    turn_calls.add(correlated_request_id, forward)
+    try:
+        response = await until_disconnected(request, forward)
+    except (ClientDisconnected, asyncio.CancelledError):
+        cancelled = {
+            "correlated_request_id": correlated_request_id,
+            "response_status": CANCELLED_STATUS,
+            "duration_ms": int((time() - start_time) * 1000)
+        }
+        current = asyncio.current_task()
+        if current is not None and current.cancelling():
+            # This task is being cancelled itself, on shutdown or with the turn that runs it in-process:
+            # record the call without awaiting, then let the cancellation through.
+            forward.cancel()
+            capture_writer.submit_nowait("llm_requests", llm_request_id, cancelled)
+            raise
+        # Letta hung up, or the turn this call belongs to was cancelled.
+        await capture_writer.submit("llm_requests", llm_request_id, cancelled)
+        return Response(status_code=CANCELLED_STATUS)
     response_body = response.body
     assert isinstance(response_body, bytes)
-    with db_connect() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE llm_requests
-            SET response_status = ?,
-            response_body = ?,
-            duration_ms = ?
-            WHERE id = ?
-        """, (
-            response.status_code,
-            response_body.decode('utf-8'),
-            int((time() - start_time) * 1000),
-            llm_request_id
-        ))
-        conn.commit()
+    if response.status_code == 200:
+        turn_streams.publish(correlated_request_id, llm_request_id, body, response_body)
+        if correlated_request_id is not None and path.endswith("chat/completions"):
+            sequence_pipeline.submit(correlated_request_id, llm_request_id, timestamp, body, response_body)
+    usage = extract_usage(response_body, model)
+    await capture_writer.submit("llm_requests", llm_request_id, {
+        # Repeated in every half of the row so each is routed to the conversation's shard on its own.
+        "correlated_request_id": correlated_request_id,
+        "response_status": response.status_code,
+        "response_body": response_body,
+        "duration_ms": int((time() - start_time) * 1000),
+        "model": usage.model,
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": usage.cached_tokens,
+        "finish_reason": usage.finish_reason,
+        "usage_extracted": 1
+    })
+    if correlated_request_id is not None and not correlator.holds(correlated_request_id):
+        # The turn runs on another worker and reads this row once Letta returns, so commit it first.
+        await capture_writer.flush()
     return response
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    if WORKERS > 1:
+        uvicorn.run("app:app", host="0.0.0.0", port=5000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
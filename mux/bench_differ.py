@@ -0,0 +1,103 @@
+"""Micro-benchmarks for the differ pipeline.
+
+Generates synthetic Letta-shaped request/response sequences and times each
+stage that /api/seq and /api/llm_request/{id} run: parse_llm_request,
+LLMContext.update, LLMContext.push_response, the whole diff_sequence and
+diff_llm_request. Save a run with --json and pass it back with --baseline to
+compare an optimization against it.
+
+    uv run bench_differ.py --steps 50 --history 30 --tools 12 --json before.json
+    uv run bench_differ.py --steps 50 --history 30 --tools 12 --baseline before.json
+"""
+import argparse
+import json
+import statistics
+from time import perf_counter
+from typing import Callable
+
+from client_interface import Content, Message
+from differ import LLMContext, diff_llm_request, diff_sequence, parse_llm_request
+from synthetic import letta_sequence
+
+def _time(fn: Callable[[], object], repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        timings.append(perf_counter() - start)
+    return timings
+
+def _stage_timings(sequence: list[tuple[str, str]], repeat: int) -> dict[str, list[float]]:
+    stages: dict[str, list[float]] = {"parse_llm_request": [], "LLMContext.update": [], "LLMContext.push_response": []}
+    for _ in range(repeat):
+        context = LLMContext()
+        for request_body, response_body in sequence:
+            start = perf_counter()
+            parsed, tools = parse_llm_request(request_body, response_body, "letta")
+            tools = json.dumps(json.loads(tools), indent=2)
+            stages["parse_llm_request"].append(perf_counter() - start)
+            llm_request = [msg for msg in parsed if msg.part == "request"]
+            llm_response = [msg for msg in parsed if msg.part == "response"]
+            start = perf_counter()
+            context.update(llm_request, tools)
+            stages["LLMContext.update"].append(perf_counter() - start)
+            start = perf_counter()
+            context.push_response(llm_response)
+            stages["LLMContext.push_response"].append(perf_counter() - start)
+    return stages
+
+def run(steps: int, history: int, tools: int, message_chars: int, repeat: int) -> dict:
+    sequence = letta_sequence(steps, history_size=history, tool_count=tools, message_chars=message_chars)
+    last_request, last_response = sequence[-1]
+    visible = [Message(message_id=f"m{i}", role="user", content=[Content(type="text", text=f"Turn {i}")]) for i in range(steps)]
+
+    timings = _stage_timings(sequence, repeat)
+    timings["diff_sequence"] = _time(lambda: diff_sequence(sequence), repeat)
+    timings["diff_llm_request"] = _time(lambda: diff_llm_request(last_request, last_response, visible), repeat)
+    return {
+        "params": {"steps": steps, "history": history, "tools": tools, "message_chars": message_chars, "repeat": repeat},
+        "request_bytes": sum(len(r) for r, _ in sequence),
+        "stages": {
+            name: {
+                "calls": len(values),
+                "median_ms": round(statistics.median(values) * 1000, 4),
+                "min_ms": round(min(values) * 1000, 4),
+                "total_ms": round(sum(values) * 1000 / repeat, 4)
+            } for name, values in timings.items()
+        }
+    }
+
+def _print_report(report: dict, baseline: dict | None):
+    params = report["params"]
+    print(f"{params['steps']} steps, {params['history']} history messages, {params['tools']} tools, "
+          f"{report['request_bytes']} request bytes, {params['repeat']} repeats")
+    header = f"{'stage':<26} {'median ms':>10} {'min ms':>10} {'per run ms':>11}"
+    print(header + (f" {'baseline':>10} {'speedup':>8}" if baseline else ""))
+    for name, stats in report["stages"].items():
+        line = f"{name:<26} {stats['median_ms']:>10} {stats['min_ms']:>10} {stats['total_ms']:>11}"
+        if baseline and name in baseline["stages"]:
+            before = baseline["stages"][name]["total_ms"]
+            speedup = f"{before / stats['total_ms']:.2f}x" if stats["total_ms"] > 0 else "-"
+            line += f" {before:>10} {speedup:>8}"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=20, help="LLM calls in the sequence")
+    parser.add_argument("--history", type=int, default=30, help="messages of history before the first step")
+    parser.add_argument("--tools", type=int, default=8, help="tools in each request")
+    parser.add_argument("--message-chars", type=int, default=200, help="size of each synthetic message")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    parser.add_argument("--baseline", default=None, help="report written by an earlier --json run to compare against")
+    args = parser.parse_args()
+
+    report = run(args.steps, args.history, args.tools, args.message_chars, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
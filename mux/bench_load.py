@@ -0,0 +1,203 @@
+"""Load test for the mux with no Letta and no OpenAI.
+
+The app runs in-process with MUX_CLIENT=dummy, whose in-memory client sends
+Letta-shaped completions through the app's own `/proxy`, and MUX_UPSTREAM=dummy,
+so `/proxy` is answered by an in-process DummyOpenAI. The load is driven over
+HTTP to uvicorn, or with --in-process straight into the app with no sockets at
+all. Concurrent conversations replay user turns from a JSONL file and the run
+reports throughput, per-endpoint latency percentiles, database growth and
+event-loop lag.
+
+    uv run bench_load.py --conversations 8 --turns 10 --turns-file ../requests.jsonl
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import json
+import os
+import socket
+import tempfile
+from time import perf_counter
+from typing import Iterator
+
+import httpx
+
+from corpus import percentile, read_turns
+
+def load_turns(path: str | None) -> Iterator[str]:
+    """Yields user turns from a JSONL file, cycling forever; synthetic turns if there is no file."""
+    if path is None or not os.path.exists(path):
+        i = 0
+        while True:
+            yield f"Synthetic turn {i}: tell me something new about yourself."
+            i += 1
+    while True:
+        produced = False
+        for text in read_turns(path):
+            produced = True
+            yield text
+        if not produced:
+            raise ValueError(f"No turns found in {path}")
+
+@dataclass
+class BenchResults:
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    errors: dict[str, int] = field(default_factory=dict)
+    loop_lag: list[float] = field(default_factory=list)
+    turns: int = 0
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+async def _timed(results: BenchResults, http: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+    start = perf_counter()
+    ok = False
+    try:
+        response = await http.request(method, url, **kwargs)
+        ok = response.status_code < 400
+        return response
+    finally:
+        results.record(endpoint, perf_counter() - start, ok)
+
+async def _run_conversation(results: BenchResults, http: httpx.AsyncClient, base_url: str, turns: Iterator[str], turn_count: int, endpoint: str):
+    response = await _timed(results, http, "POST /api/conv", "POST", f"{base_url}/api/conv")
+    conv_id = response.json()["id"]
+    for _ in range(turn_count):
+        payload = {"content": [{"type": "text", "text": next(turns)}]}
+        await _timed(results, http, f"POST /api/{endpoint}/{{conv_id}}", "POST", f"{base_url}/api/{endpoint}/{conv_id}", json=payload)
+        results.turns += 1
+    await _timed(results, http, "GET /api/conv/{conv_id}", "GET", f"{base_url}/api/conv/{conv_id}")
+    await _timed(results, http, "GET /api/seq/{conv_id}", "GET", f"{base_url}/api/seq/{conv_id}")
+
+async def _monitor_loop_lag(results: BenchResults, interval: float = 0.01):
+    while True:
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        results.loop_lag.append(max(perf_counter() - start - interval, 0.0))
+
+def _db_size() -> int:
+    total = 0
+    if not os.path.isdir("storage"):
+        return 0
+    # Shards and segments live in subdirectories.
+    for directory, _, names in os.walk("storage"):
+        for name in names:
+            total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def _drive(results: BenchResults, http: httpx.AsyncClient, base_url: str, conversations: int, turn_count: int, turns: Iterator[str], endpoint: str) -> tuple[float, int]:
+    db_size_before = _db_size()
+    monitor = asyncio.create_task(_monitor_loop_lag(results))
+    start = perf_counter()
+    await asyncio.gather(*[
+        _run_conversation(results, http, base_url, turns, turn_count, endpoint)
+        for _ in range(conversations)
+    ])
+    elapsed = perf_counter() - start
+    monitor.cancel()
+    return elapsed, db_size_before
+
+async def run_bench(conversations: int, turn_count: int, turns: Iterator[str], endpoint: str, in_process: bool = False) -> dict:
+    import uvicorn
+    import app as mux_app
+
+    results = BenchResults()
+    timeout = httpx.Timeout(300.0)
+    if in_process:
+        base_url = "http://mux"
+        async with mux_app.lifespan(mux_app.app), httpx.AsyncClient(transport=httpx.ASGITransport(app=mux_app.app), timeout=timeout) as driver_http:
+            elapsed, db_size_before = await _drive(results, driver_http, base_url, conversations, turn_count, turns, endpoint)
+    else:
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        limits = httpx.Limits(max_connections=conversations * 2 + 8, max_keepalive_connections=conversations * 2 + 8)
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as driver_http:
+            server = uvicorn.Server(uvicorn.Config(mux_app.app, host="127.0.0.1", port=port, log_level="warning"))
+            server_task = asyncio.create_task(server.serve())
+            while not server.started:
+                await asyncio.sleep(0.01)
+            elapsed, db_size_before = await _drive(results, driver_http, base_url, conversations, turn_count, turns, endpoint)
+            server.should_exit = True
+            await server_task
+    db_size_after = _db_size()
+
+    lag = sorted(results.loop_lag)
+    return {
+        "conversations": conversations,
+        "turns": results.turns,
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(results.turns / elapsed, 2) if elapsed > 0 else None,
+        "requests_per_s": round(sum(len(v) for v in results.latencies.values()) / elapsed, 2) if elapsed > 0 else None,
+        "endpoints": {
+            name: {
+                "count": len(values),
+                "errors": results.errors.get(name, 0),
+                **{f"p{p}_ms": round(percentile(sorted(values), p) * 1000, 2) for p in (50, 95, 99)}
+            } for name, values in results.latencies.items()
+        },
+        "db_bytes_before": db_size_before,
+        "db_bytes_after": db_size_after,
+        "db_bytes_per_turn": round((db_size_after - db_size_before) / results.turns) if results.turns else None,
+        "loop_lag_ms": {
+            "p50": round((percentile(lag, 50) or 0) * 1000, 2),
+            "p99": round((percentile(lag, 99) or 0) * 1000, 2),
+            "max": round((lag[-1] if lag else 0) * 1000, 2)
+        }
+    }
+
+def _print_report(report: dict):
+    print(f"{report['turns']} turns over {report['conversations']} conversations in {report['elapsed_s']}s "
+          f"({report['turns_per_s']} turns/s, {report['requests_per_s']} API requests/s)")
+    print(f"{'endpoint':<32} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in report["endpoints"].items():
+        print(f"{name:<32} {stats['count']:>6} {stats['errors']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    print(f"DB size: {report['db_bytes_before']} -> {report['db_bytes_after']} bytes ({report['db_bytes_per_turn']} bytes/turn)")
+    lag = report["loop_lag_ms"]
+    print(f"Event loop lag: p50 {lag['p50']}ms, p99 {lag['p99']}ms, max {lag['max']}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=5, help="turns per conversation")
+    parser.add_argument("--turns-file", default="../requests.jsonl", help="JSONL of user turns; synthetic turns if missing")
+    parser.add_argument("--endpoint", choices=["seq", "conv"], default="seq", help="post turns to /api/seq or /api/conv")
+    parser.add_argument("--steps", type=int, default=2, help="LLM calls per turn made by the dummy client")
+    parser.add_argument("--tools", type=int, default=8, help="tools in each synthetic Letta request")
+    parser.add_argument("--latency-ms", type=float, default=0, help="DummyOpenAI time to first token")
+    parser.add_argument("--token-latency-ms", type=float, default=0, help="DummyOpenAI time per completion token")
+    parser.add_argument("--completion-tokens", type=int, default=10)
+    parser.add_argument("--stream", action="store_true", help="DummyOpenAI answers with server-sent events")
+    parser.add_argument("--in-process", action="store_true", help="call the app through an ASGI transport instead of over HTTP")
+    parser.add_argument("--workdir", default=None, help="directory for storage/ (default: a fresh temporary directory)")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    turns = load_turns(os.path.abspath(args.turns_file) if args.turns_file else None)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mux-bench-")
+    os.makedirs(os.path.join(workdir, "storage"), exist_ok=True)
+    os.chdir(workdir)
+    # Read by app.py, proxy.py and client_dummy.py at import, so set before run_bench imports the app.
+    os.environ["MUX_CLIENT"] = "dummy"
+    os.environ["MUX_DUMMY_CLIENT_VIA"] = "proxy"
+    os.environ["MUX_DUMMY_CLIENT_STEPS"] = str(args.steps)
+    os.environ["MUX_DUMMY_CLIENT_TOOLS"] = str(args.tools)
+    os.environ["MUX_UPSTREAM"] = "dummy"
+    os.environ.setdefault("OPENAI_API_KEY", "dummy-key")
+    os.environ["MUX_DUMMY_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["MUX_DUMMY_TOKEN_LATENCY_MS"] = str(args.token_latency_ms)
+    os.environ["MUX_DUMMY_COMPLETION_TOKENS"] = str(args.completion_tokens)
+    os.environ["MUX_DUMMY_STREAM"] = "1" if args.stream else "0"
+
+    report = asyncio.run(run_bench(args.conversations, args.turns, turns, args.endpoint, args.in_process))
+    _print_report(report)
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
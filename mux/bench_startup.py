@@ -0,0 +1,105 @@
+"""Cold-start benchmark for the mux.
+
+Starts the app under uvicorn in a fresh process --repeat times and measures,
+from process spawn, when it first answers HTTP (/ready with any status) and
+when /ready says it is warm. Runs in a scratch directory with its own
+storage/, or against a copy of an existing one with --storage, so the schema
+upgrade and spill replay of a real database are part of the measurement.
+
+    uv run bench_startup.py --repeat 5
+    uv run bench_startup.py --storage ../storage/mux --client dummy --json startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import Optional
+import urllib.error
+import urllib.request
+
+MUX_DIR = os.path.dirname(os.path.abspath(__file__))
+POLL_SECONDS = 0.005
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _ready_status(port: int) -> Optional[int]:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
+
+def import_seconds() -> float:
+    start = perf_counter()
+    subprocess.run([sys.executable, "-c", "import app"], cwd=MUX_DIR, check=True)
+    return perf_counter() - start
+
+def start_once(storage: Optional[str], client: str, timeout: float) -> dict[str, Optional[float]]:
+    with tempfile.TemporaryDirectory() as workdir:
+        if storage is not None:
+            shutil.copytree(storage, os.path.join(workdir, "storage"))
+        else:
+            os.makedirs(os.path.join(workdir, "storage"))
+        port = _free_port()
+        env = {**os.environ, "PYTHONPATH": MUX_DIR, "MUX_CLIENT": client, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "bench")}
+        start = perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        result: dict[str, Optional[float]] = {"listening": None, "ready": None}
+        try:
+            while perf_counter() - start < timeout and process.poll() is None:
+                status = _ready_status(port)
+                if status is not None and result["listening"] is None:
+                    result["listening"] = perf_counter() - start
+                if status == 200:
+                    result["ready"] = perf_counter() - start
+                    break
+                sleep(POLL_SECONDS)
+        finally:
+            process.terminate()
+            process.wait()
+        return result
+
+def _summary(values: list[float]) -> dict[str, float]:
+    return {"p50": statistics.median(values), "min": min(values), "max": max(values)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--client", choices=["letta", "dummy"], default="letta", help="MUX_CLIENT for the started app")
+    parser.add_argument("--storage", default=None, help="copy this storage directory in for every start")
+    parser.add_argument("--timeout", type=float, default=30.0, help="give up on a start after this many seconds")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    report: dict[str, object] = {"import_app": _summary([import_seconds() for _ in range(args.repeat)])}
+    runs = [start_once(args.storage, args.client, args.timeout) for _ in range(args.repeat)]
+    for stage in ("listening", "ready"):
+        values = [run[stage] for run in runs if run[stage] is not None]
+        report[stage] = _summary(values) if values else None
+    report["failed"] = sum(1 for run in runs if run["ready"] is None)
+
+    for stage in ("import_app", "listening", "ready"):
+        summary = report[stage]
+        if isinstance(summary, dict):
+            print(f"{stage:>12}: p50 {summary['p50'] * 1000:7.1f} ms  min {summary['min'] * 1000:7.1f} ms  max {summary['max'] * 1000:7.1f} ms")
+        else:
+            print(f"{stage:>12}: -")
+    if report["failed"]:
+        print(f"{report['failed']} of {args.repeat} starts did not become ready within {args.timeout}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,317 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import os
+from sqlite3 import Connection
+from typing import Any, Literal, Optional
+from pydantic import BaseModel
+
+from db import catalog_llm_requests, conversation_shard, llm_request_shard, register_request, remember_llm_request_shard, request_conversation, shard_connect, sharded
+from metrics import CAPTURE_BATCH_SIZE, CAPTURE_QUEUE_DEPTH, CAPTURE_SPILLED, DB_SECONDS
+from search import index_llm_request
+from segments import externalize_bodies, segment_store
+from workers import process_alive
+
+# Write-behind capture for /proxy. Each record is an upsert of some columns of
+# one row. Records do not commute (both halves of an llm_requests row write model
+# and correlated_request_id), so they are committed in submission order: once
+# anything is spilled, later records are spilled behind it, and the queue is
+# drained before the spill file is replayed.
+
+CAPTURE_QUEUE_SIZE = int(os.environ.get("MUX_CAPTURE_QUEUE_SIZE", "10000"))
+CAPTURE_BATCH_MAX = int(os.environ.get("MUX_CAPTURE_BATCH_MAX", "500"))
+CAPTURE_OVERFLOW: Literal["spill", "block"] = "block" if os.environ.get("MUX_CAPTURE_OVERFLOW") == "block" else "spill"
+CAPTURE_SPILL_DIR = "storage"
+# One spill file per worker process; see orphaned_spill_files.
+CAPTURE_SPILL_PATH = os.path.join(CAPTURE_SPILL_DIR, f"capture_spill.{os.getpid()}.jsonl")
+CAPTURE_RETRY_SECONDS = 1.0
+
+CaptureTable = Literal["llm_requests", "user_requests", "llm_request_parsed", "llm_request_events"]
+
+class CaptureRecord(BaseModel):
+    table: CaptureTable
+    id: str
+    fields: dict[str, Any]
+    # Submission order within this process, for flush; meaningless in another process's spill file.
+    seq: int = 0
+
+def _upsert(conn: Connection, record: CaptureRecord):
+    fields = externalize_bodies(conn, record.fields)
+    # /proxy hands bodies over as bytes; whatever is stored inline is TEXT.
+    fields = {column: value.decode("utf-8") if isinstance(value, bytes) else value for column, value in fields.items()}
+    columns = list(fields)
+    placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns)
+    conn.execute(f"""
+        INSERT INTO {record.table} (id, {", ".join(columns)}) VALUES ({placeholders})
+        ON CONFLICT(id) DO UPDATE SET {updates}
+    """, [record.id, *fields.values()])
+
+def _record_shard(record: CaptureRecord) -> Optional[str]:
+    """The database a record goes to: its conversation's shard, or the main one for LLM calls no turn claimed."""
+    if not sharded():
+        return None
+    conv_id = record.fields.get("conv_id")
+    if conv_id is None:
+        if record.table == "user_requests":
+            conv_id = request_conversation(record.id)
+        elif record.table == "llm_requests" and "correlated_request_id" in record.fields:
+            correlated_request_id = record.fields["correlated_request_id"]
+            conv_id = request_conversation(correlated_request_id) if correlated_request_id is not None else None
+        else:
+            return llm_request_shard(record.id)
+    if conv_id is None:
+        return None
+    if record.table == "user_requests":
+        register_request(record.id, conv_id)
+    shard = conversation_shard(conv_id, create=True)
+    if record.table == "llm_requests":
+        remember_llm_request_shard(record.id, shard)
+    return shard
+
+def orphaned_spill_files(own_path: str) -> list[str]:
+    """Spill files of processes that are gone, including the unnumbered one from before workers."""
+    directory = os.path.dirname(own_path) or "."
+    if not os.path.isdir(directory):
+        return []
+    orphaned = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith("capture_spill") or not name.endswith(".jsonl") or os.path.join(directory, name) == own_path:
+            continue
+        pid = name.removeprefix("capture_spill.").split(".")[0]
+        if not pid.isdigit() or not process_alive(int(pid)):
+            orphaned.append(os.path.join(directory, name))
+    return orphaned
+
+class CaptureWriter:
+    def __init__(self, queue_size: int = CAPTURE_QUEUE_SIZE, batch_max: int = CAPTURE_BATCH_MAX, overflow: Literal["spill", "block"] = CAPTURE_OVERFLOW, spill_path: str = CAPTURE_SPILL_PATH):
+        self.queue_size = queue_size
+        self.batch_max = batch_max
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.queue: Optional[asyncio.Queue[CaptureRecord]] = None
+        self.task: Optional[asyncio.Task] = None
+        # A single writer thread owns the SQLite connections, one per shard written to.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture-writer")
+        self.conns: dict[Optional[str], Connection] = {}
+        self.spilled = 0
+        # Sequence numbers of spilled records not yet replayed, in the spill file's order.
+        self.spilled_seqs: list[int] = []
+        # The last sequence number handed out, the uncommitted ones (a heap, with committed
+        # entries removed lazily), and the flushes waiting for a sequence number to commit.
+        self.sequence = 0
+        self.uncommitted: list[int] = []
+        self.committed: set[int] = set()
+        self.waiters: list[tuple[int, asyncio.Future]] = []
+
+    async def start(self):
+        if self.task is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        # Records spilled by previous processes that did not get to drain them.
+        for path in orphaned_spill_files(self.spill_path):
+            claimed = f"{self.spill_path}.{os.path.basename(path)}"
+            try:
+                # Another worker starting at the same time may claim it first.
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue
+            await self._run_in_writer(self._replay_spill_file, claimed)
+        self.task = asyncio.create_task(self._drain())
+
+    async def submit(self, table: CaptureTable, id: str, fields: dict[str, Any]):
+        """Queue an upsert."""
+        if self.task is None:
+            await self.start()
+        assert self.queue is not None
+        record = self._record(table, id, fields)
+        if self.spilled > 0 or (self.queue.full() and self.overflow == "spill"):
+            self._spill(record)
+            return
+        await self.queue.put(record)
+        CAPTURE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def submit_nowait(self, table: CaptureTable, id: str, fields: dict[str, Any]):
+        """Queue an upsert without awaiting anything, for a task that is being cancelled. A full
+        queue spills whatever MUX_CAPTURE_OVERFLOW says, and after stop() the record is left in
+        the spill file for the next start to replay."""
+        record = self._record(table, id, fields)
+        if self.task is None or self.queue is None or self.spilled > 0 or self.queue.full():
+            self._spill(record)
+            return
+        self.queue.put_nowait(record)
+        CAPTURE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def _record(self, table: CaptureTable, id: str, fields: dict[str, Any]) -> CaptureRecord:
+        self.sequence += 1
+        record = CaptureRecord(table=table, id=id, fields=fields, seq=self.sequence)
+        heapq.heappush(self.uncommitted, record.seq)
+        return record
+
+    def _spill(self, record: CaptureRecord):
+        with open(self.spill_path, "a") as f:
+            f.write(record.model_dump_json() + "\n")
+        self.spilled += 1
+        self.spilled_seqs.append(record.seq)
+        CAPTURE_SPILLED.inc()
+
+    async def flush(self):
+        """Wait until everything submitted before this call is committed; later submissions are not waited for."""
+        target = self.sequence
+        if self._watermark() >= target:
+            return
+        done = asyncio.get_running_loop().create_future()
+        self.waiters.append((target, done))
+        await done
+
+    def _watermark(self) -> int:
+        """The highest sequence number up to which every record is committed."""
+        while self.uncommitted and self.uncommitted[0] in self.committed:
+            self.committed.discard(heapq.heappop(self.uncommitted))
+        return self.uncommitted[0] - 1 if self.uncommitted else self.sequence
+
+    def _mark_committed(self, seqs: list[int]):
+        self.committed.update(seqs)
+        watermark = self._watermark()
+        waiting = []
+        for target, done in self.waiters:
+            if target <= watermark:
+                if not done.done():
+                    done.set_result(None)
+            else:
+                waiting.append((target, done))
+        self.waiters = waiting
+
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.flush()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self._run_in_writer(self._close)
+
+    async def write(self, records: list[CaptureRecord]):
+        """Commit records as one batch now, bypassing the queue. For bulk writers with a CaptureWriter of their own,
+        so they hold their own thread and connections instead of stalling the live queue."""
+        await self._run_in_writer(self._write_batch, records)
+
+    async def close(self):
+        await self._run_in_writer(self._close)
+        self.executor.shutdown()
+
+    async def _run_in_writer(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _drain(self):
+        assert self.queue is not None
+        while True:
+            if self.spilled > 0 and self.queue.empty():
+                await self._replay_spilled()
+                continue
+            first = await self.queue.get()
+            batch = [first]
+            while len(batch) < self.batch_max and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            CAPTURE_QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                await self._run_in_writer(self._write_batch, batch)
+            except Exception as e:
+                # Keep the rows rather than dropping them; they are retried on the next replay.
+                print(f"Capture batch of {len(batch)} failed, spilling: {e}")
+                # What is still queued was submitted later, so it goes behind the batch.
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                with open(self.spill_path, "a") as f:
+                    for record in batch:
+                        f.write(record.model_dump_json() + "\n")
+                self.spilled += len(batch)
+                self.spilled_seqs.extend(record.seq for record in batch)
+                CAPTURE_SPILLED.inc(len(batch))
+            else:
+                self._mark_committed([record.seq for record in batch])
+
+    async def _replay_spilled(self):
+        replaying = f"{self.spill_path}.replaying"
+        # Rotate on the event loop, where spills are appended, so new spills go to a fresh file.
+        os.replace(self.spill_path, replaying)
+        count, seqs = self.spilled, self.spilled_seqs
+        self.spilled, self.spilled_seqs = 0, []
+        try:
+            await self._run_in_writer(self._replay_spill_file, replaying)
+            self._mark_committed(seqs)
+        except Exception as e:
+            print(f"Replaying {count} spilled capture records failed, will retry: {e}")
+            # Put the records back ahead of those spilled since; replaying them again from the start is idempotent.
+            if os.path.exists(self.spill_path):
+                with open(self.spill_path) as src, open(replaying, "a") as dst:
+                    dst.write(src.read())
+            os.replace(replaying, self.spill_path)
+            self.spilled += count
+            self.spilled_seqs = seqs + self.spilled_seqs
+            await asyncio.sleep(CAPTURE_RETRY_SECONDS)
+
+    def _connection(self, shard: Optional[str] = None) -> Connection:
+        if shard not in self.conns:
+            conn = shard_connect(shard)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.conns[shard] = conn
+        return self.conns[shard]
+
+    def _write_batch(self, batch: list[CaptureRecord]):
+        by_shard: dict[Optional[str], list[CaptureRecord]] = {}
+        routed: list[tuple[str, str]] = []
+        for record in batch:
+            shard = _record_shard(record)
+            by_shard.setdefault(shard, []).append(record)
+            if shard is not None and record.table == "llm_requests" and "correlated_request_id" in record.fields:
+                routed.append((record.id, shard))
+        with DB_SECONDS.time(op="capture_batch"):
+            # Catalogued before the rows land, so a call found in a shard is always found through the catalog.
+            if len(routed) > 0:
+                with self._connection(None) as conn:
+                    catalog_llm_requests(conn, routed)
+            # Each shard commits on its own, holding only its own write lock.
+            for shard, records in by_shard.items():
+                conn = self._connection(shard)
+                with conn:
+                    for record in records:
+                        _upsert(conn, record)
+                    segment_store.flush(conn)
+                    for record in records:
+                        if record.table == "llm_requests" and ("request_body" in record.fields or "response_body" in record.fields):
+                            index_llm_request(conn, record.id)
+        CAPTURE_BATCH_SIZE.observe(len(batch))
+
+    def _replay_spill_file(self, path: str):
+        if not os.path.exists(path):
+            return
+        batch: list[CaptureRecord] = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(CaptureRecord.model_validate_json(line))
+                except ValueError:
+                    # A torn last line from a crash mid-append.
+                    print(f"Skipping unreadable spilled capture record in {path}")
+                    continue
+                if len(batch) >= self.batch_max:
+                    self._write_batch(batch)
+                    batch = []
+        if batch:
+            self._write_batch(batch)
+        os.remove(path)
+
+    def _close(self):
+        for conn in self.conns.values():
+            with conn:
+                segment_store.seal(conn)
+            conn.close()
+        self.conns = {}
+
+capture_writer = CaptureWriter()
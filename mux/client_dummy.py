@@ -1,168 +1,215 @@
-from sqlite3 import connect
+"""A stand-in for Letta that keeps conversations in memory.
+
+Each user message becomes MUX_DUMMY_CLIENT_STEPS Letta-shaped chat completions
+(memory-block system prompt, send_message tool calls), sent without the network:
+
+- MUX_DUMMY_CLIENT_VIA=proxy (default) through the mux's own /proxy, in-process,
+  so they are captured and correlated like Letta's; /proxy answers them from
+  DummyOpenAI with MUX_UPSTREAM=dummy
+- MUX_DUMMY_CLIENT_VIA=direct straight to an in-process DummyOpenAI, skipping
+  capture
+
+With MUX_DUMMY_CLIENT_DB set, conversations and messages are also written
+through to that SQLite file and loaded from it once, on first use.
+"""
+from datetime import datetime, timezone
+import os
+from sqlite3 import Connection, connect
 from typing import Optional, Self
-from client_interface import ClientInterface, Content, Conversation, Message
 import uuid
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+import httpx
+from starlette.types import ASGIApp
+
+from client_interface import ClientInterface, Content, Conversation, Message, messages_after
+from dummy_openai import DummyOpenAI
+from jsoncodec import dumps, loads
+from synthetic import default_memory, letta_request, letta_send_message_call, letta_tools, letta_user_message
+
+DUMMY_CLIENT_VIA = os.environ.get("MUX_DUMMY_CLIENT_VIA", "proxy")
+DUMMY_CLIENT_DB = os.environ.get("MUX_DUMMY_CLIENT_DB", "")
+DUMMY_CLIENT_STEPS = int(os.environ.get("MUX_DUMMY_CLIENT_STEPS", "2"))
+DUMMY_CLIENT_TOOLS = int(os.environ.get("MUX_DUMMY_CLIENT_TOOLS", "8"))
+DUMMY_CLIENT_MODEL = "dummy-model"
+
+class _DummyConversation:
+    def __init__(self, conv_id: str, created_at: str, topic: str = ""):
+        self.conversation = Conversation(id=conv_id, created_at=created_at, topic=topic)
+        self.messages: list[Message] = []
+        # What the next completion is built from, kept as Letta would keep it.
+        self.memory = default_memory()
+        self.history: list[dict] = []
+
+    def restore(self, message: Message):
+        """Append a message loaded from SQLite, rebuilding the history from it."""
+        self.messages.append(message)
+        text = "\n".join(c.text for c in message.content)
+        match message.role:
+            case "user":
+                self.history.append(letta_user_message(text))
+            case "assistant":
+                self.history.extend(letta_send_message_call(text, "Replying to the user."))
+
+class DummyStore:
+    """Conversations in memory, written through to SQLite when `path` is set."""
+    def __init__(self, path: str = DUMMY_CLIENT_DB):
+        self.conversations: dict[str, _DummyConversation] = {}
+        self.conn: Optional[Connection] = None
+        if path:
+            self.conn = connect(path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS dummy_conversations (
+                    conv_id TEXT PRIMARY KEY,
+                    created_at TEXT,
+                    topic TEXT
+                );
+                CREATE TABLE IF NOT EXISTS dummy_messages (
+                    message_id TEXT PRIMARY KEY,
+                    conv_id TEXT,
+                    role TEXT,
+                    content TEXT
+                );
+                CREATE INDEX IF NOT EXISTS dummy_messages_conv_id ON dummy_messages(conv_id);
+            ''')
+            self._load()
+
+    def _load(self):
+        assert self.conn is not None
+        for conv_id, created_at, topic in self.conn.execute("SELECT conv_id, created_at, topic FROM dummy_conversations"):
+            self.conversations[conv_id] = _DummyConversation(conv_id, created_at, topic or "")
+        for message_id, conv_id, role, content in self.conn.execute("SELECT message_id, conv_id, role, content FROM dummy_messages ORDER BY rowid"):
+            conv = self.conversations.get(conv_id)
+            if conv is not None:
+                conv.restore(Message(message_id=message_id, role=role, content=[Content(type="text", text=content)]))
+
+    def create(self) -> _DummyConversation:
+        conv = _DummyConversation(f"agent-{uuid.uuid4()}", str(datetime.now(timezone.utc)))
+        self.conversations[conv.conversation.id] = conv
+        if self.conn is not None:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO dummy_conversations (conv_id, created_at, topic) VALUES (?, ?, ?)",
+                    (conv.conversation.id, conv.conversation.created_at, conv.conversation.topic)
+                )
+        return conv
+
+    def delete(self, conv_id: str) -> bool:
+        if self.conversations.pop(conv_id, None) is None:
+            return False
+        if self.conn is not None:
+            with self.conn:
+                self.conn.execute("DELETE FROM dummy_messages WHERE conv_id = ?", (conv_id,))
+                self.conn.execute("DELETE FROM dummy_conversations WHERE conv_id = ?", (conv_id,))
+        return True
+
+    def append(self, conv: _DummyConversation, messages: list[Message]):
+        conv.messages.extend(messages)
+        if self.conn is not None:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO dummy_messages (message_id, conv_id, role, content) VALUES (?, ?, ?, ?)",
+                    [(m.message_id, conv.conversation.id, m.role, "\n".join(c.text for c in m.content)) for m in messages]
+                )
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
 class DummyClient(ClientInterface):
-    def __init__(self):
-        self.conn = None
-        self.client = AsyncOpenAI(
-            api_key="dummy-key",
-            base_url="http://dummy_litellm:4000/v1",
-        )
+    def __init__(self, proxy_app: Optional[ASGIApp] = None, store: Optional[DummyStore] = None,
+                 steps: int = DUMMY_CLIENT_STEPS, tool_count: int = DUMMY_CLIENT_TOOLS):
+        """`proxy_app` is the mux app, whose /proxy the completions go through unless MUX_DUMMY_CLIENT_VIA=direct."""
+        match DUMMY_CLIENT_VIA:
+            case "proxy":
+                if proxy_app is None:
+                    raise Exception("MUX_DUMMY_CLIENT_VIA=proxy needs the mux app")
+                self.completions_url = "http://mux/proxy/api/v0/chat/completions"
+                transport = httpx.ASGITransport(app=proxy_app)
+            case "direct":
+                self.completions_url = "http://dummy/v1/chat/completions"
+                transport = httpx.ASGITransport(app=DummyOpenAI.from_env())
+            case other:
+                raise Exception(f"Unknown MUX_DUMMY_CLIENT_VIA {other!r}")
+        self.http = httpx.AsyncClient(transport=transport, timeout=None)
+        self.store = store if store is not None else DummyStore()
+        self.steps = steps
+        self.tools = letta_tools(tool_count)
 
     async def __aenter__(self) -> Self:
-        self.conn = connect('storage/dummy.db')
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS dummy_conversations (
-                conv_id TEXT PRIMARY KEY,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                topic TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS dummy_messages (
-                message_id TEXT PRIMARY KEY,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                conv_id TEXT,
-                role TEXT,
-                content TEXT
-            )
-        ''')
-        cursor.execute('''
-            INSERT OR REPLACE INTO dummy_conversations (conv_id, topic)
-            VALUES ('tc', 'Test Conversation 1')
-        ''')
-        self.conn.commit()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        if self.conn:
-            self.conn.close()
+        pass
+
+    async def close(self):
+        await self.http.aclose()
+        self.store.close()
 
     async def create_conversation(self) -> str:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        conv_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO dummy_conversations (conv_id, topic) VALUES (?, ?)", (conv_id, ""))
-        self.conn.commit()
-        return conv_id
+        return self.store.create().conversation.id
 
     async def delete_conversation(self, conv_id: str) -> bool:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        cursor = self.conn.cursor()
-        response = cursor.execute("DELETE FROM dummy_conversations WHERE conv_id = ?", (conv_id,))
-        self.conn.commit()
-        return response.rowcount != 0
-    
+        return self.store.delete(conv_id)
+
     async def list_conversations(self) -> list[Conversation]:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT conv_id, created_at, topic FROM dummy_conversations")
-        return [
-            Conversation(id=row[0], created_at=row[1], topic=row[2]) for row in cursor.fetchall()
-        ]
-
-    async def get_messages(self, conv_id: str) -> tuple[Conversation, list[Message]]:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT conv_id, created_at, topic FROM dummy_conversations WHERE conv_id = ?", (conv_id,))
-        conv_row = cursor.fetchone()
-        if not conv_row:
+        return [conv.conversation for conv in self.store.conversations.values()]
+
+    async def get_messages(self, conv_id: str, after: Optional[str] = None) -> tuple[Conversation, list[Message]]:
+        conv = self.store.conversations.get(conv_id)
+        if conv is None:
+            raise Exception("Conversation not found.")
+        return conv.conversation, messages_after(list(conv.messages), after)
+
+    async def get_recent_messages(self, conv_id: str, tail: int) -> tuple[Conversation, list[Message]]:
+        conv = self.store.conversations.get(conv_id)
+        if conv is None:
             raise Exception("Conversation not found.")
-        conversation = Conversation(id=conv_row[0], created_at=conv_row[1], topic=conv_row[2])
-        messages = await self._get_messages(conv_id)
-        return conversation, messages
-        
-    async def _get_messages(self, conv_id: str) -> list[Message]:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT message_id, role, content FROM dummy_messages WHERE conv_id = ? ORDER BY created_at", (conv_id,))
-        messages = [
-            Message(
-                message_id=row[0],
-                role=row[1],
-                content=[Content(type="text", text=row[2])]
-            ) for row in cursor.fetchall()
-        ]
-        
-        return messages
-    
-    async def _complete(self, messages: list[Message]) -> tuple[str, list[Content]]:
-        oai_messages:list[ChatCompletionMessageParam] = []
-        for msg in messages:
-            match msg.role:
-                case "system":
-                    oai_messages.append(
-                        {
-                            "role": msg.role,
-                            "content": [{"type": c.type, "text": c.text} for c in msg.content]
-                        }
-                    )
-                case "user":
-                    oai_messages.append(
-                        {
-                            "role": msg.role,
-                            "content": [{"type": c.type, "text": c.text} for c in msg.content]
-                        }
-                    
-                    )
-                case "assistant":
-                    oai_messages.append({
-                        "role": msg.role,
-                        "content": [{"type": c.type, "text": c.text} for c in msg.content]
-                    })
-        response = await self.client.chat.completions.create(
-            model="dummy-model",
-            messages=oai_messages
-        )
-
-        if not isinstance(response.choices[0].message.content, str):
-            raise Exception("Unsupported content type in response.")
-        return response.id, [Content(type="text", text=response.choices[0].message.content)]
+        return conv.conversation, conv.messages[-tail:] if tail > 0 else []
 
     async def post_user_message(self, conv_id: str, content: list[Content]) -> Optional[tuple[str, str]]:
-        if not self.conn:
-            raise Exception("Database connection is not established.")
-        if len(content) != 1:
-            raise Exception("Only single content messages are supported in DummyClient.")
-        cursor = self.conn.cursor()
-
-        cursor.execute("SELECT conv_id FROM dummy_conversations WHERE conv_id = ?", (conv_id,))
-        conv_row = cursor.fetchone()
-        if not conv_row:
+        conv = self.store.conversations.get(conv_id)
+        if conv is None:
             return None
+        text = "\n".join(c.text for c in content)
+        user_message = Message(message_id=f"message-{uuid.uuid4()}", role="user", content=content)
+        history = conv.history + [letta_user_message(text)]
+        memory = dict(conv.memory)
+        reply = ""
+        for step in range(self.steps):
+            reply = await self._complete(memory, history)
+            if step < self.steps - 1:
+                # Intermediate steps edit memory, like Letta's heartbeat tool calls.
+                memory["human"] += f"\n{text[:80]}"
+                assistant, tool = letta_send_message_call(reply, f"Updating memory, step {step}")
+                assistant["tool_calls"][0]["function"]["name"] = "core_memory_append"
+                history.extend([assistant, tool])
+        history.extend(letta_send_message_call(reply, "Replying to the user."))
+        assistant_message = Message(message_id=f"message-{uuid.uuid4()}", role="assistant", content=[Content(type="text", text=reply)])
+        # Only a finished turn is kept, so a cancelled one leaves the conversation as it was.
+        conv.memory, conv.history = memory, history
+        self.store.append(conv, [user_message, assistant_message])
+        return user_message.message_id, assistant_message.message_id
 
-        message_id = str(uuid.uuid4())
-        cursor.execute(
-            "INSERT INTO dummy_messages (conv_id, message_id, role, content) VALUES (?, ?, ?, ?)",
-            (conv_id, message_id, "user", content[0].text)
-        )
-        self.conn.commit()
-
-        messages = await self._get_messages(conv_id)
-        response_id, response = await self._complete(
-            messages + [
-                Message(
-                    message_id=message_id,
-                    role="user",
-                    content=content
-                )
-            ]
-        )
-
-        cursor.execute(
-            "INSERT INTO dummy_messages (conv_id, message_id, role, content) VALUES (?, ?, ?, ?)",
-            (conv_id, response_id, "assistant", response[0].text)
-        )
+    async def _complete(self, memory: dict[str, str], history: list[dict]) -> str:
+        body = dumps(letta_request(DUMMY_CLIENT_MODEL, memory, history, self.tools))
+        response = await self.http.post(self.completions_url, content=body, headers={"content-type": "application/json"})
+        response.raise_for_status()
+        return _completion_text(response)
 
-        self.conn.commit()
-        return message_id, response_id
\ No newline at end of file
+def _completion_text(response: httpx.Response) -> str:
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        parts = []
+        for line in response.text.splitlines():
+            payload = line.removeprefix("data:").strip()
+            if line.startswith("data:") and payload != "[DONE]":
+                parts.append(loads(payload)["choices"][0]["delta"].get("content") or "")
+        return "".join(parts)
+    message = loads(response.content)["choices"][0]["message"]
+    if message.get("content"):
+        return message["content"]
+    for call in message.get("tool_calls") or []:
+        if call["function"]["name"] == "send_message":
+            return loads(call["function"]["arguments"]).get("message", "")
+    return ""
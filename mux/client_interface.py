@@ -39,9 +39,27 @@ class ClientInterface(ABC):
         ...
 
     @abstractmethod
-    async def get_messages(self, conv_id: str) -> tuple[Conversation, list[Message]]:
+    async def get_messages(self, conv_id: str, after: Optional[str] = None) -> tuple[Conversation, list[Message]]:
+        """Messages of the conversation, or only those after the message with id `after`."""
         ...
 
     @abstractmethod
     async def post_user_message(self, conv_id: str, content: list[Content]) -> Optional[tuple[str, str]]:
-        ...
\ No newline at end of file
+        ...
+
+    async def get_recent_messages(self, conv_id: str, tail: int) -> tuple[Conversation, list[Message]]:
+        """The last `tail` messages; backends that can page from the end override this."""
+        conversation, messages = await self.get_messages(conv_id)
+        return conversation, messages[-tail:] if tail > 0 else []
+
+    async def close(self):
+        """Release pooled connections of a long-lived client; called at shutdown."""
+        pass
+
+def messages_after(messages: list[Message], after: Optional[str]) -> list[Message]:
+    if after is None:
+        return messages
+    for i, message in enumerate(messages):
+        if message.message_id == after:
+            return messages[i + 1:]
+    return messages
@@ -1,4 +1,5 @@
-from typing import Optional, Self, Sequence
+import asyncio
+from typing import Literal, Optional, Self, Sequence
 from letta_client import AsyncLetta
 from letta_client.types.agents.text_content import TextContent
 from letta_client.types.agents.text_content_param import TextContentParam
@@ -8,11 +9,14 @@ from letta_client.types.agents.assistant_message import AssistantMessage
 from letta_client.types.agents.message_create_params import Message as LettaMessage
 
 from client_interface import ClientInterface, Content, Conversation, Message
+from metrics import timed_letta_call
+from tracing import traced
 
 # MODEL="openai/gpt-5.1"
 # MODEL="openai/dummy-model"
 MODEL="lmstudio_openai/gpt-4o-mini"
 EMBEDDING_MODEL="openai/text-embedding-3-small"
+LETTA_CANCEL_TIMEOUT_SECONDS = 5
 
 class LettaClient(ClientInterface):
     def __init__(self):
@@ -27,6 +31,11 @@ class LettaClient(ClientInterface):
     async def __aexit__(self, exc_type, exc_value, traceback):
         pass
 
+    async def close(self):
+        await self.client.close()
+
+    @timed_letta_call("create_conversation")
+    @traced("letta.create_conversation")
     async def create_conversation(self) -> str:
         agent_state = await self.client.agents.create(
             model=MODEL,
@@ -45,10 +54,14 @@ class LettaClient(ClientInterface):
         )
         return agent_state.id
     
+    @timed_letta_call("delete_conversation")
+    @traced("letta.delete_conversation")
     async def delete_conversation(self, conv_id: str) -> bool:
         response = await self.client.agents.delete(agent_id=conv_id)
         return True
 
+    @timed_letta_call("list_conversations")
+    @traced("letta.list_conversations")
     async def list_conversations(self) -> list[Conversation]:
         agents = await self.client.agents.list()
         conversations = []
@@ -62,43 +75,39 @@ class LettaClient(ClientInterface):
             )
         return conversations
 
-    async def get_messages(self, conv_id: str) -> tuple[Conversation, list[Message]]:
-        agent_state = await self.client.agents.retrieve(agent_id=conv_id)
-        messages = await self.client.agents.messages.list(agent_id=conv_id)
-        conversation = Conversation(
-            id=agent_state.id,
-            created_at=str(agent_state.created_at),
-            topic=agent_state.description or ""
-        )
+    @timed_letta_call("get_messages")
+    @traced("letta.get_messages")
+    async def get_messages(self, conv_id: str, after: Optional[str] = None) -> tuple[Conversation, list[Message]]:
+        if after is None:
+            messages = self.client.agents.messages.list(agent_id=conv_id)
+        else:
+            messages = self.client.agents.messages.list(agent_id=conv_id, after=after)
+        agent_state, pages = await asyncio.gather(self.client.agents.retrieve(agent_id=conv_id), messages)
+        message_list = []
+        async for msg in pages:
+            message = _translate_message(msg)
+            if message is not None:
+                message_list.append(message)
+        return _conversation(agent_state), message_list
+
+    @timed_letta_call("get_recent_messages")
+    @traced("letta.get_recent_messages")
+    async def get_recent_messages(self, conv_id: str, tail: int) -> tuple[Conversation, list[Message]]:
+        # Newest first, so only the pages holding the tail are fetched.
+        messages = self.client.agents.messages.list(agent_id=conv_id, order="desc")
+        agent_state, pages = await asyncio.gather(self.client.agents.retrieve(agent_id=conv_id), messages)
         message_list = []
-        async for msg in messages:
-            match msg.message_type:
-                case "system_message":
-                    message_list.append(
-                        Message(
-                            message_id=msg.id,
-                            role="system",
-                            content=_translate_content(msg.content)
-                        )
-                    )
-                case "assistant_message":
-                    message_list.append(
-                        Message(
-                            message_id=msg.id,
-                            role="assistant",
-                            content=_translate_content(msg.content)
-                        )
-                    )
-                case "user_message":
-                    message_list.append(
-                        Message(
-                            message_id=msg.id,
-                            role="user",
-                            content=_translate_content(msg.content)
-                        )
-                    )
-        return conversation, message_list
+        async for msg in pages:
+            if len(message_list) >= tail:
+                break
+            message = _translate_message(msg)
+            if message is not None:
+                message_list.append(message)
+        message_list.reverse()
+        return _conversation(agent_state), message_list
     
+    @timed_letta_call("post_user_message")
+    @traced("letta.post_user_message")
     async def post_user_message(self, conv_id: str, content: list[Content]) -> Optional[tuple[str, str]]:
         letta_content: list[TextContentParam] = []
         for c in content:
@@ -109,10 +118,14 @@ class LettaClient(ClientInterface):
                 "role": "user",
                 "content": letta_content
             }
-        response = await self.client.agents.messages.create(
-            agent_id=conv_id,
-            messages=[letta_message]
-        )
+        try:
+            response = await self.client.agents.messages.create(
+                agent_id=conv_id,
+                messages=[letta_message]
+            )
+        except asyncio.CancelledError:
+            await self._cancel_runs(conv_id)
+            raise
         print("THE RESPONSE WAS:")
         print(response)
 
@@ -121,6 +134,13 @@ class LettaClient(ClientInterface):
             raise Exception("No AssistantMessage in response")
         return f"{msgs[0].id}:request", msgs[0].id
 
+    async def _cancel_runs(self, conv_id: str):
+        """Closing the connection does not stop the agent's run; ask Letta to (needs Redis on the Letta side)."""
+        try:
+            await asyncio.wait_for(self.client.agents.messages.cancel(agent_id=conv_id), LETTA_CANCEL_TIMEOUT_SECONDS)
+        except Exception as e:
+            print(f"Cancelling the runs of {conv_id} failed: {e!r}")
+
     # async def _complete(self, conv_id: str, messages: list[Message]) -> tuple[str, list[Content]]:
     #     letta_messages: list[LettaMessage] = []
     #     for msg in messages:
@@ -138,6 +158,29 @@ class LettaClient(ClientInterface):
     #         raise Exception("Expected an AssistantMessage response")
     #     return response.id, _translate_content(response.content)
 
+MESSAGE_ROLES: dict[str, Literal["system", "assistant", "user"]] = {
+    "system_message": "system",
+    "assistant_message": "assistant",
+    "user_message": "user"
+}
+
+def _translate_message(msg) -> Optional[Message]:
+    role = MESSAGE_ROLES.get(msg.message_type)
+    if role is None:
+        return None
+    return Message(
+        message_id=msg.id,
+        role=role,
+        content=_translate_content(msg.content)
+    )
+
+def _conversation(agent_state) -> Conversation:
+    return Conversation(
+        id=agent_state.id,
+        created_at=str(agent_state.created_at),
+        topic=agent_state.description or ""
+    )
+
 def _translate_content(content: Sequence[TextContent | ImageContent | LettaAssistantMessageContentUnion] | str) -> list[Content]:
     if isinstance(content, str):
         return [Content(type="text", text=content)]
@@ -163,8 +206,6 @@ def _translate_content(content: Sequence[TextContent | ImageContent | LettaAssis
 # print(response)
 
 if __name__ == "__main__":
-    import asyncio
-
     async def main():
         async with LettaClient() as client:
             conv_id = await client.create_conversation()
@@ -0,0 +1,48 @@
+"""Turn corpora and latency percentiles shared by bench_load.py, cli/replay.py and usage.py.
+
+Standard library only: cli/replay.py imports this file from outside the mux project.
+"""
+import json
+import math
+from typing import Iterator, Optional
+
+def turn_text(line: str) -> str:
+    """The user turn in one JSONL line: a string, or the first `text`, `content`, `message`, `body` or `title` field."""
+    line = line.strip()
+    if not line:
+        return ""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return line
+    if isinstance(data, str):
+        return data
+    for key in ("text", "content", "message", "body", "title"):
+        value = data.get(key)
+        if isinstance(value, str) and value:
+            return value
+        if isinstance(value, list):
+            return "\n".join(c.get("text", "") for c in value if isinstance(c, dict))
+    return ""
+
+def read_turns(path: str, limit: Optional[int] = None) -> Iterator[str]:
+    """The non-empty turns of a JSONL file, read lazily, at most `limit` of them."""
+    count = 0
+    with open(path) as f:
+        for line in f:
+            if limit is not None and count >= limit:
+                return
+            text = turn_text(line)
+            if text:
+                count += 1
+                yield text
+
+def percentile_rank(count: int, p: float) -> int:
+    """The 0-based position of the nearest-rank p-th percentile among `count` sorted values."""
+    return max(math.ceil(p / 100 * count) - 1, 0)
+
+def percentile(sorted_values: list, p: float):
+    """The nearest-rank p-th percentile of already sorted values; None when there are none."""
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[percentile_rank(len(sorted_values), p)]
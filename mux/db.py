@@ -0,0 +1,390 @@
+"""The SQLite layout of captured traffic.
+
+By default everything lives in storage/conversations.db. With MUX_DB_SHARDS
+each conversation's traffic (its user_requests, llm_requests and the tables
+derived from them) lives in a database under storage/shards instead: one of N
+hashed shards (MUX_DB_SHARDS=N) or one per conversation
+(MUX_DB_SHARDS=conversation). conversations.db then holds the catalog, which
+maps conversations to shards and turns to conversations, plus the correlator
+state and LLM calls no turn claimed. Writes to different shards do not wait on
+each other's lock, and anything scoped to one conversation opens only its shard.
+"""
+from collections import OrderedDict
+import os
+import re
+from sqlite3 import Connection, Cursor, connect
+import threading
+from typing import Iterator, Optional
+import zlib
+
+DB_PATH = 'storage/conversations.db'
+DB_SHARDS = os.environ.get("MUX_DB_SHARDS", "")
+SHARD_DIR = 'storage/shards'
+SHARD_LOOKUP_CACHE_SIZE = 10000
+
+_schema_lock = threading.Lock()
+# Databases whose schema this process has created or upgraded; None is DB_PATH.
+_schema_ready: set[Optional[str]] = set()
+
+def sharded() -> bool:
+    return DB_SHARDS != ""
+
+def db_connect(conv_id: Optional[str] = None) -> Connection:
+    """The main database, or the one holding `conv_id`'s traffic (the same file unless sharded)."""
+    return shard_connect(conversation_shard(conv_id) if conv_id is not None else None)
+
+def shard_path(shard: Optional[str]) -> str:
+    return DB_PATH if shard is None else os.path.join(SHARD_DIR, f"{shard}.db")
+
+def shard_connect(shard: Optional[str]) -> Connection:
+    if shard is not None:
+        os.makedirs(SHARD_DIR, exist_ok=True)
+    conn = connect(shard_path(shard))
+    if shard not in _schema_ready:
+        with _schema_lock:
+            if shard not in _schema_ready:
+                if shard is None:
+                    _create_main_schema(conn)
+                _create_schema(conn)
+                _schema_ready.add(shard)
+    return conn
+
+def init_schema(conn: Connection):
+    """Create or upgrade the main schema; runs once per process, normally from the app's lifespan."""
+    with _schema_lock:
+        if None in _schema_ready:
+            return
+        _create_main_schema(conn)
+        _create_schema(conn)
+        _schema_ready.add(None)
+
+def _new_shard(conv_id: str) -> str:
+    if DB_SHARDS == "conversation":
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", conv_id)
+    if not DB_SHARDS.isdigit() or int(DB_SHARDS) < 1:
+        raise Exception(f"MUX_DB_SHARDS must be a positive number or 'conversation', not {DB_SHARDS!r}")
+    return f"{zlib.crc32(conv_id.encode('utf-8')) % int(DB_SHARDS):03d}"
+
+class _LookupCache:
+    def __init__(self, size: int = SHARD_LOOKUP_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, Optional[str]] = OrderedDict()
+
+    def get(self, key: str) -> tuple[bool, Optional[str]]:
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+
+    def put(self, key: str, value: Optional[str]):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+_conversation_shards = _LookupCache()
+_request_conversations = _LookupCache()
+_llm_request_shards = _LookupCache()
+
+def conversation_shard(conv_id: str, create: bool = False) -> Optional[str]:
+    """The shard of a conversation. None, the main database, when unsharded, or (unless `create`)
+    when the conversation has nothing captured yet, so there is nothing to read anywhere."""
+    if not sharded():
+        return None
+    found, shard = _conversation_shards.get(conv_id)
+    if found:
+        return shard
+    with shard_connect(None) as conn:
+        row = conn.execute("SELECT shard FROM conversation_shards WHERE conv_id = ?", (conv_id,)).fetchone()
+        if row is None and create:
+            conn.execute("INSERT OR IGNORE INTO conversation_shards (conv_id, shard) VALUES (?, ?)", (conv_id, _new_shard(conv_id)))
+            conn.commit()
+            row = conn.execute("SELECT shard FROM conversation_shards WHERE conv_id = ?", (conv_id,)).fetchone()
+    if row is None:
+        return None
+    _conversation_shards.put(conv_id, row[0])
+    return row[0]
+
+def register_request(request_id: str, conv_id: str):
+    """Record which conversation a turn belongs to, so its LLM calls are routed to that conversation's shard."""
+    _request_conversations.put(request_id, conv_id)
+    if not sharded():
+        return
+    conversation_shard(conv_id, create=True)
+    with shard_connect(None) as conn:
+        conn.execute("INSERT OR REPLACE INTO request_conversations (id, conv_id) VALUES (?, ?)", (request_id, conv_id))
+        conn.commit()
+
+def request_conversation(request_id: str) -> Optional[str]:
+    found, conv_id = _request_conversations.get(request_id)
+    if found:
+        return conv_id
+    table = "request_conversations" if sharded() else "user_requests"
+    with shard_connect(None) as conn:
+        row = conn.execute(f"SELECT conv_id FROM {table} WHERE id = ?", (request_id,)).fetchone()
+    if row is None:
+        return None
+    _request_conversations.put(request_id, row[0])
+    return row[0]
+
+def llm_request_shard(llm_request_id: str) -> Optional[str]:
+    """The shard holding an LLM call, from the catalog the capture writer keeps; None, the main
+    database, for calls no turn claimed."""
+    if not sharded():
+        return None
+    found, shard = _llm_request_shards.get(llm_request_id)
+    if found:
+        return shard
+    with shard_connect(None) as conn:
+        row = conn.execute("SELECT shard FROM llm_request_shards WHERE id = ?", (llm_request_id,)).fetchone()
+    if row is None:
+        return None
+    _llm_request_shards.put(llm_request_id, row[0])
+    return row[0]
+
+def remember_llm_request_shard(llm_request_id: str, shard: Optional[str]):
+    _llm_request_shards.put(llm_request_id, shard)
+
+def catalog_llm_requests(conn: Connection, llm_request_shards: list[tuple[str, str]]):
+    """Record the shard of each (llm_request_id, shard) in the catalog on `conn`, the main database."""
+    conn.executemany("INSERT OR REPLACE INTO llm_request_shards (id, shard) VALUES (?, ?)", llm_request_shards)
+
+def forget_llm_requests(llm_request_ids: list[str]):
+    """Drop deleted LLM calls from the catalog."""
+    for llm_request_id in llm_request_ids:
+        _llm_request_shards.discard(llm_request_id)
+    if not sharded() or len(llm_request_ids) == 0:
+        return
+    with shard_connect(None) as conn:
+        conn.executemany("DELETE FROM llm_request_shards WHERE id = ?", [(llm_request_id,) for llm_request_id in llm_request_ids])
+        conn.commit()
+
+def shards(conv_ids: Optional[list[str]] = None) -> list[Optional[str]]:
+    """Every database holding traffic (the main one, then each shard in the catalog), or those holding `conv_ids`."""
+    if not sharded():
+        return [None]
+    if conv_ids is not None:
+        return list(dict.fromkeys(conversation_shard(conv_id) for conv_id in conv_ids))
+    with shard_connect(None) as conn:
+        return [None, *(row[0] for row in conn.execute("SELECT DISTINCT shard FROM conversation_shards ORDER BY shard"))]
+
+def each_shard(conv_ids: Optional[list[str]] = None) -> Iterator[Connection]:
+    """A connection to every database, or only to those holding `conv_ids`, for queries that fan out."""
+    for shard in shards(conv_ids):
+        conn = shard_connect(shard)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+def forget_conversation(conv_id: str):
+    """Drop a purged conversation from the catalog; a hashed shard file stays for its other conversations."""
+    _conversation_shards.discard(conv_id)
+    if not sharded():
+        return
+    with shard_connect(None) as conn:
+        conn.execute("DELETE FROM request_conversations WHERE conv_id = ?", (conv_id,))
+        conn.execute("DELETE FROM conversation_shards WHERE conv_id = ?", (conv_id,))
+        conn.commit()
+
+def _create_main_schema(conn: Connection):
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS body_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL,
+            last_write_at REAL,
+            bytes INTEGER,
+            sealed INTEGER
+        );
+    ''')
+    # The turn holding the correlator, for /proxy calls landing on another worker; see workers.py.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS correlator_state (
+            id INTEGER PRIMARY KEY,
+            request_id TEXT,
+            trace_id TEXT,
+            span_id TEXT,
+            pid INTEGER,
+            acquired_at REAL
+        );
+    ''')
+    # The catalog of the sharded layout; empty otherwise.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_shards (
+            conv_id TEXT PRIMARY KEY,
+            shard TEXT
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request_conversations (
+            id TEXT PRIMARY KEY,
+            conv_id TEXT
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS request_conversations_conv_id ON request_conversations (conv_id);
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_request_shards (
+            id TEXT PRIMARY KEY,
+            shard TEXT
+        );
+    ''')
+    conn.commit()
+
+def _create_schema(conn: Connection):
+    cursor = conn.cursor()
+    # Only takes effect on a new database; retention converts older ones with a VACUUM.
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets API reads proceed while the capture writer commits.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_requests (
+            id TEXT PRIMARY KEY,
+            conv_id TEXT,
+            user_message_id TEXT,
+            assistant_message_id TEXT
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_requests (
+            id TEXT PRIMARY KEY,
+            timestamp DATETIME,
+            path TEXT,
+            method TEXT,
+            request_body TEXT,
+            response_status INTEGER,
+            response_body TEXT,
+            duration_ms INTEGER,
+            correlated_request_id TEXT
+        );
+    ''')
+    _add_missing_columns(cursor, "llm_requests", {
+        "model": "TEXT",
+        "prompt_tokens": "INTEGER",
+        "completion_tokens": "INTEGER",
+        "cached_tokens": "INTEGER",
+        "finish_reason": "TEXT",
+        "usage_extracted": "INTEGER",
+        "request_segment": "INTEGER",
+        "request_offset": "INTEGER",
+        "request_length": "INTEGER",
+        "response_segment": "INTEGER",
+        "response_offset": "INTEGER",
+        "response_length": "INTEGER",
+        "archived": "INTEGER",
+        "archive_offset": "INTEGER",
+        "archive_length": "INTEGER",
+        "archive_bytes": "INTEGER",
+        "search_indexed": "INTEGER",
+        "upstream_request_body": "TEXT",
+        "prompt_rewrites": "INTEGER",
+    })
+    # Derived from llm_requests by precompute.py; safe to drop.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_request_parsed (
+            id TEXT PRIMARY KEY,
+            conv_id TEXT,
+            messages TEXT,
+            available_tools TEXT,
+            computed_at REAL
+        );
+    ''')
+    # Derived from llm_requests by sequences.py; safe to drop.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_request_events (
+            id TEXT PRIMARY KEY,
+            conv_id TEXT,
+            previous_id TEXT,
+            events TEXT,
+            computed_at REAL
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS user_requests_conv_id ON user_requests (conv_id);
+    ''')
+    # Correlating Letta messages with their turns; see _get_correlated_llm_requests.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS user_requests_user_message_id ON user_requests (user_message_id);
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS user_requests_assistant_message_id ON user_requests (assistant_message_id);
+    ''')
+    # Covering indexes: the usage aggregates only ever touch the index b-trees,
+    # never the rows holding the request/response bodies.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_usage_by_correlation ON llm_requests (
+            correlated_request_id, model, timestamp, prompt_tokens, completion_tokens, cached_tokens, duration_ms
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_usage_by_model ON llm_requests (
+            model, timestamp, prompt_tokens, completion_tokens, cached_tokens, duration_ms
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_usage_by_time ON llm_requests (
+            timestamp, model, prompt_tokens, completion_tokens, cached_tokens, duration_ms
+        );
+    ''')
+    # Latency percentiles are read at an offset along duration_ms, per model or across all rows.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_latency_by_model ON llm_requests (model, duration_ms, timestamp);
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_latency ON llm_requests (duration_ms, timestamp, prompt_rewrites);
+    ''')
+    # Same predicate as backfill_usage, so bodies held in segments are found through it too.
+    cursor.execute('''
+        DROP INDEX IF EXISTS llm_requests_usage_pending;
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_usage_pending_bodies ON llm_requests (id)
+        WHERE usage_extracted IS NULL AND (response_body IS NOT NULL OR response_segment IS NOT NULL);
+    ''')
+    # Compaction and retention look up the rows that point into a segment.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_request_segment ON llm_requests (request_segment)
+        WHERE request_segment IS NOT NULL;
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS llm_requests_response_segment ON llm_requests (response_segment)
+        WHERE response_segment IS NOT NULL;
+    ''')
+    # Full-text index over what each LLM call added; see search.py. rowid is llm_requests.rowid.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS llm_request_search USING fts5 (
+            text, tool_names, tool_arguments, roles
+        );
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS llm_requests_search_delete AFTER DELETE ON llm_requests BEGIN
+            DELETE FROM llm_request_search WHERE rowid = old.rowid;
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS llm_requests_parsed_delete AFTER DELETE ON llm_requests BEGIN
+            DELETE FROM llm_request_parsed WHERE id = old.id;
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS llm_requests_events_delete AFTER DELETE ON llm_requests BEGIN
+            DELETE FROM llm_request_events WHERE id = old.id;
+        END;
+    ''')
+    conn.commit()
+
+def _add_missing_columns(cursor: Cursor, table: str, columns: dict[str, str]):
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
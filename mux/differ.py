@@ -1,9 +1,11 @@
 import difflib
 from typing import Literal
+from typing import Any
 from pydantic import BaseModel
-import json
 
 from client_interface import Content, Message
+from jsoncodec import dumps_text, loads
+from metrics import DIFFER_CPU_SECONDS
 
 class LLMRequestToolFunctionCall(BaseModel):
     name: str
@@ -53,7 +55,7 @@ def _parse_tool_calls(tool_calls_data: list | None) -> list[LLMRequestToolCall]
             function_data = tc.get("function", {})
             function_call = LLMRequestToolFunctionCall(
                 name=function_data.get("name", ""),
-                arguments=json.loads(function_data.get("arguments", "{}"))
+                arguments=loads(function_data.get("arguments", "{}"))
             )
             tool_call = LLMRequestToolCall(
                 id=tc.get("id", ""),
@@ -78,9 +80,41 @@ def _post_process(msg: LLMRequestMessage, source: Literal["letta"]) -> LLMReques
                 msg.tool_calls = None
     return msg
 
+def _assemble_streamed_response(llm_response_body: str) -> dict:
+    """Fold server-sent chat.completion.chunk events into one chat.completion."""
+    completion_id = None
+    role = "assistant"
+    content_parts: list[str] = []
+    tool_calls: dict[int, dict] = {}
+    for line in llm_response_body.splitlines():
+        payload = line.removeprefix("data:").strip()
+        if not line.startswith("data:") or payload == "[DONE]":
+            continue
+        chunk = loads(payload)
+        completion_id = completion_id or chunk.get("id")
+        for choice in chunk.get("choices") or []:
+            delta = choice.get("delta") or {}
+            role = delta.get("role") or role
+            if delta.get("content"):
+                content_parts.append(delta["content"])
+            for tc in delta.get("tool_calls") or []:
+                call = tool_calls.setdefault(tc.get("index", 0), {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                call["id"] = tc.get("id") or call["id"]
+                function = tc.get("function") or {}
+                call["function"]["name"] += function.get("name") or ""
+                call["function"]["arguments"] += function.get("arguments") or ""
+    message: dict = {"role": role, "content": "".join(content_parts) if content_parts else None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return {"id": completion_id, "choices": [{"message": message}]}
+
 def parse_llm_request(llm_request_body: str, llm_response_body: str | None, source: Literal["letta"]) -> tuple[list[LLMRequestMessage], str]:
-    data = json.loads(llm_request_body)
-    # print(json.dumps(data, indent=2))
+    messages, tools = _parse_llm_request(llm_request_body, llm_response_body, source)
+    return messages, dumps_text(tools)
+
+def _parse_llm_request(llm_request_body: str, llm_response_body: str | None, source: Literal["letta"]) -> tuple[list[LLMRequestMessage], Any]:
+    """Like parse_llm_request, with the tools still decoded."""
+    data = loads(llm_request_body)
     result = [LLMRequestMessage(
         part="request",
         message_id=m.get("id"),
@@ -90,7 +124,10 @@ def parse_llm_request(llm_request_body: str, llm_response_body: str | None, sour
         injected=False
     ) for m in data["messages"]]
     if llm_response_body is not None:
-        response_data = json.loads(llm_response_body)
+        if llm_response_body.lstrip().startswith("data:"):
+            response_data = _assemble_streamed_response(llm_response_body)
+        else:
+            response_data = loads(llm_response_body)
         result.extend([LLMRequestMessage(
             part="response",
             message_id=response_data["id"],
@@ -99,14 +136,15 @@ def parse_llm_request(llm_request_body: str, llm_response_body: str | None, sour
             tool_calls=_parse_tool_calls(response_data["choices"][0]["message"].get("tool_calls")),
             injected=False
         )])
-    return [_post_process(msg, source) for msg in result], json.dumps(data.get("tools", []))
+    return [_post_process(msg, source) for msg in result], data.get("tools", [])
 
 def diff_llm_request(llm_request_body: str, llm_response_body: str, visible_parts: list[Message]) -> tuple[list[LLMRequestMessage], str]:
-    llm_request, available_tools = parse_llm_request(llm_request_body, llm_response_body, "letta")
-    visible_message_texts = {c.text for msg in visible_parts if msg.content for c in msg.content}
-    for msg in llm_request:
-        if all(c.text not in visible_message_texts for c in msg.content):
-            msg.injected = True
+    with DIFFER_CPU_SECONDS.time_cpu(function="diff_llm_request"):
+        llm_request, available_tools = parse_llm_request(llm_request_body, llm_response_body, "letta")
+        visible_message_texts = {c.text for msg in visible_parts if msg.content for c in msg.content}
+        for msg in llm_request:
+            if all(c.text not in visible_message_texts for c in msg.content):
+                msg.injected = True
     return llm_request, available_tools
 
 
@@ -117,11 +155,17 @@ class LLMEvent(BaseModel):
 
 class LLMContext:
     tools: str
-    messages: list[LLMRequestMessage]
+    # The previous step's messages as they are diffed, rather than the messages themselves.
+    text: str
+    message_count: int
 
     def __init__(self):
         self.tools = ""
-        self.messages = []
+        self.text = ""
+        self.message_count = 0
+
+    def size(self) -> int:
+        return len(self.tools) + len(self.text)
 
     def update(self, llm_request: list[LLMRequestMessage], available_tools: str) -> list[LLMEvent]:
         differ = difflib.Differ()
@@ -131,22 +175,26 @@ class LLMContext:
             diff = "\n".join(l for l in differ.compare(self.tools.splitlines(), available_tools.splitlines()) if l.startswith("+ ") or l.startswith("- "))
             events.append(LLMEvent(type="context_change", delta=diff))
 
-        old_message_str = "\n".join(str(msg) for msg in self.messages)
+        old_message_str = self.text
         new_message_str = "\n".join(str(msg) for msg in llm_request)
         diff = "\n".join(l for l in differ.compare(old_message_str.splitlines(), new_message_str.splitlines()) if l.startswith("+ ") or l.startswith("- "))
         if old_message_str != new_message_str:
             events.append(LLMEvent(type="context_change", delta=diff))
-        self.messages = llm_request
+        self.text = new_message_str
+        self.message_count = len(llm_request)
         return events
     
     def push_response(self, llm_response: list[LLMRequestMessage]) -> list[LLMEvent]:
-        self.messages.extend(llm_response)
-        return [LLMEvent(type="message", content=str(resp)) for resp in llm_response]
+        responses = [str(resp) for resp in llm_response]
+        if len(responses) > 0:
+            self.text = "\n".join([self.text, *responses] if self.message_count > 0 else responses)
+            self.message_count += len(responses)
+        return [LLMEvent(type="message", content=text) for text in responses]
     
     def update_and_push_response(self, request_body: str, response_body: str) -> list[LLMEvent]:
         events = []
-        llm_request_and_response, tools = parse_llm_request(request_body, response_body, "letta")
-        tools = json.dumps(json.loads(tools), indent=2)
+        llm_request_and_response, tools_data = _parse_llm_request(request_body, response_body, "letta")
+        tools = dumps_text(tools_data, indent=True)
         llm_request = [msg for msg in llm_request_and_response if msg.part == "request"]
         llm_response = [msg for msg in llm_request_and_response if msg.part == "response"]
         events.extend(self.update(llm_request, tools))
@@ -154,16 +202,17 @@ class LLMContext:
         return events
 
 def diff_sequence(sequence: list[tuple[str, str]], initial: tuple[str,str]|None = None) -> list[LLMEvent]:
-    context = LLMContext()
-    if initial is not None:
-        context.update_and_push_response(initial[0], initial[1])
-    events = []
-    for request_body, response_body in sequence:
-        # llm_request_and_response, tools = parse_llm_request(request_body, response_body, "letta")
-        # tools = json.dumps(json.loads(tools), indent=2)
-        # llm_request = [msg for msg in llm_request_and_response if msg.part == "request"]
-        # llm_response = [msg for msg in llm_request_and_response if msg.part == "response"]
-        # events.extend(context.update(llm_request, tools))
-        # events.extend(context.push_response(llm_response))
-        events.extend(context.update_and_push_response(request_body, response_body))
+    with DIFFER_CPU_SECONDS.time_cpu(function="diff_sequence"):
+        context = LLMContext()
+        if initial is not None:
+            context.update_and_push_response(initial[0], initial[1])
+        events = []
+        for request_body, response_body in sequence:
+            # llm_request_and_response, tools = parse_llm_request(request_body, response_body, "letta")
+            # tools = json.dumps(json.loads(tools), indent=2)
+            # llm_request = [msg for msg in llm_request_and_response if msg.part == "request"]
+            # llm_response = [msg for msg in llm_request_and_response if msg.part == "response"]
+            # events.extend(context.update(llm_request, tools))
+            # events.extend(context.push_response(llm_response))
+            events.extend(context.update_and_push_response(request_body, response_body))
     return events
\ No newline at end of file
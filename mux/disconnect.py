@@ -0,0 +1,64 @@
+"""Cancelling work whose HTTP client has gone away.
+
+A turn keeps the correlator lock and every upstream completion costs tokens,
+so when the caller of /api/conv, /api/seq or /proxy disconnects, the work done
+on its behalf is cancelled instead of being finished for nobody.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Awaitable, Optional, TypeVar
+from fastapi import Request
+
+# nginx's "client closed request"; stored as the response_status of cancelled LLM calls.
+CANCELLED_STATUS = 499
+
+T = TypeVar("T")
+
+class ClientDisconnected(Exception):
+    pass
+
+async def wait_for_disconnect(request: Request):
+    # Once the body has been read, the next ASGI message is the disconnect.
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def until_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """Await `awaitable`, cancelling it and raising ClientDisconnected if the client goes away first."""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise ClientDisconnected()
+    return task.result()
+
+class TurnCalls:
+    """Upstream calls in flight for each turn in this worker, so a cancelled turn can cancel them."""
+    def __init__(self):
+        self.tasks: defaultdict[str, set[asyncio.Task]] = defaultdict(set)
+
+    def add(self, request_id: Optional[str], task: asyncio.Task):
+        if request_id is None:
+            return
+        self.tasks[request_id].add(task)
+        task.add_done_callback(lambda _: self._discard(request_id, task))
+
+    def _discard(self, request_id: str, task: asyncio.Task):
+        self.tasks[request_id].discard(task)
+        if len(self.tasks[request_id]) == 0:
+            del self.tasks[request_id]
+
+    def cancel(self, request_id: str) -> int:
+        tasks = list(self.tasks.get(request_id, ()))
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
@@ -1,19 +1,64 @@
+import asyncio
+from collections import Counter, deque
+import hashlib
 import json
+import os
 from time import time
 import uuid
 
 from fastapi import Response
+from fastapi.responses import StreamingResponse
 
+from jsoncodec import dumps, loads
+from rewrite import BYTES_PER_TOKEN, request_prompt
+
+DUMMY_TEXT = "This is a dummy response, not from an actual LLM."
+# OpenAI caches prompts of at least 1024 tokens, in 128-token steps of shared prefix.
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK_TOKENS = 128
+PROMPT_CACHE_ENTRIES = 64
+PROMPT_CACHE_BLOCK_BYTES = PROMPT_CACHE_BLOCK_TOKENS * BYTES_PER_TOKEN
 
 class DummyOpenAI:
-    def handle(self, path: str) -> Response:
+    """Canned OpenAI responder. Also an ASGI app, so it can sit behind an
+    httpx.ASGITransport in place of api.openai.com."""
+    def __init__(self, latency_ms: float = 0, token_latency_ms: float = 0, completion_tokens: int = 10, stream: bool = False):
+        self.latency_ms = latency_ms
+        self.token_latency_ms = token_latency_ms
+        self.completion_tokens = completion_tokens
+        self.stream = stream
+        # Prefix digests of the recent prompts, and how many of them hold each digest.
+        self.recent_prompts: deque[list[bytes]] = deque()
+        self.cached_prefixes: Counter[bytes] = Counter()
+
+    @classmethod
+    def from_env(cls) -> "DummyOpenAI":
+        return cls(
+            latency_ms=float(os.environ.get("MUX_DUMMY_LATENCY_MS", "0")),
+            token_latency_ms=float(os.environ.get("MUX_DUMMY_TOKEN_LATENCY_MS", "0")),
+            completion_tokens=int(os.environ.get("MUX_DUMMY_COMPLETION_TOKENS", "10")),
+            stream=os.environ.get("MUX_DUMMY_STREAM", "0") == "1",
+        )
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+        response = await self.handle(scope["path"].lstrip("/"), body)
+        await response(scope, receive, send)
+
+    async def handle(self, path: str, body: bytes = b"") -> Response:
         match path:
             case "v1/chat/completions" | "api/v0/chat/completions":
-                return self.create_completion()
+                return await self.create_completion(body)
             case "v1/models" | "api/v0/models":
                 return self.list_models()
             # case "api/tags":
-            #     return Response(json.dumps([]), 200) 
+            #     return Response(json.dumps([]), 200)
             case _:
                 return Response(json.dumps({
                     "error": {
@@ -23,7 +68,7 @@ class DummyOpenAI:
                         "code": None
                     }
                 }), 404)
-            
+
     def list_models(self) -> Response:
         return Response(json.dumps({
             "object": "list",
@@ -45,20 +90,73 @@ class DummyOpenAI:
                 #     "compatibility_type": "gguf", # no idea
                 # }
             ]
-        }), 200)
+        }), 200, media_type="application/json")
 
-    def create_completion(self) -> Response:
-        return Response(json.dumps({
+    def _completion_words(self) -> list[str]:
+        words = DUMMY_TEXT.split()
+        return [words[i % len(words)] for i in range(max(self.completion_tokens, 1))]
+
+    def _cached_tokens(self, request: dict) -> int:
+        """Emulates OpenAI's prefix cache over the recent prompts, tools first as upstream renders them."""
+        prefixes = _prefix_digests(request_prompt(request))
+        # Block by block rather than byte by byte, which is all the 128-token steps need.
+        shared = 0
+        while shared < len(prefixes) and prefixes[shared] in self.cached_prefixes:
+            shared += 1
+        if len(self.recent_prompts) == PROMPT_CACHE_ENTRIES:
+            for prefix in self.recent_prompts.popleft():
+                self.cached_prefixes[prefix] -= 1
+                if self.cached_prefixes[prefix] == 0:
+                    del self.cached_prefixes[prefix]
+        self.recent_prompts.append(prefixes)
+        self.cached_prefixes.update(prefixes)
+        tokens = shared * PROMPT_CACHE_BLOCK_TOKENS
+        if tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return tokens
+
+    def _usage(self, body: bytes, request: dict) -> dict:
+        # Roughly four bytes per token is close enough for load shaping.
+        prompt_tokens = max(len(body) // BYTES_PER_TOKEN, 1)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": prompt_tokens + self.completion_tokens,
+            "prompt_tokens_details": {
+            "cached_tokens": min(self._cached_tokens(request), prompt_tokens),
+            "audio_tokens": 0
+            },
+            "completion_tokens_details": {
+            "reasoning_tokens": 0,
+            "audio_tokens": 0,
+            "accepted_prediction_tokens": 0,
+            "rejected_prediction_tokens": 0
+            }
+        }
+
+    async def create_completion(self, body: bytes = b"") -> Response:
+        try:
+            request = loads(body) if body else {}
+        except ValueError:
+            request = {}
+        model = request.get("model", "dummy-model")
+        if self.latency_ms > 0:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if self.stream or request.get("stream"):
+            return StreamingResponse(self._stream_completion(model, body, request), media_type="text/event-stream")
+        if self.token_latency_ms > 0:
+            await asyncio.sleep(self.token_latency_ms * self.completion_tokens / 1000)
+        return Response(dumps({
             "id": str(uuid.uuid4()),
             "object": "chat.completion",
             "created": time(),
-            "model": "dummy-model",
+            "model": model,
             "choices": [
                 {
                 "index": 0,
                 "message": {
                     "role": "assistant",
-                    "content": "This is a dummy response, not from an actual LLM.",
+                    "content": " ".join(self._completion_words()),
                     "refusal": None,
                     "annotations": []
                 },
@@ -66,20 +164,38 @@ class DummyOpenAI:
                 "finish_reason": "stop"
                 }
             ],
-            "usage": {
-                "prompt_tokens": 19,
-                "completion_tokens": 10,
-                "total_tokens": 29,
-                "prompt_tokens_details": {
-                "cached_tokens": 0,
-                "audio_tokens": 0
-                },
-                "completion_tokens_details": {
-                "reasoning_tokens": 0,
-                "audio_tokens": 0,
-                "accepted_prediction_tokens": 0,
-                "rejected_prediction_tokens": 0
-                }
-            },
+            "usage": self._usage(body, request),
             "service_tier": "default"
-        }), 200)
\ No newline at end of file
+        }), 200, media_type="application/json")
+
+    async def _stream_completion(self, model: str, body: bytes, request: dict):
+        completion_id = str(uuid.uuid4())
+        created = time()
+
+        def chunk(delta: dict, finish_reason: str | None, usage: dict | None = None) -> bytes:
+            data = json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+                "usage": usage
+            })
+            return f"data: {data}\n\n".encode("utf-8")
+
+        yield chunk({"role": "assistant", "content": ""}, None)
+        for i, word in enumerate(self._completion_words()):
+            if self.token_latency_ms > 0:
+                await asyncio.sleep(self.token_latency_ms / 1000)
+            yield chunk({"content": word if i == 0 else f" {word}"}, None)
+        yield chunk({}, "stop", self._usage(body, request))
+        yield b"data: [DONE]\n\n"
+
+def _prefix_digests(prompt: bytes) -> list[bytes]:
+    """A digest of each whole-block prefix of the prompt, shortest first."""
+    digest = hashlib.blake2b(digest_size=16)
+    digests = []
+    for start in range(0, len(prompt) - PROMPT_CACHE_BLOCK_BYTES + 1, PROMPT_CACHE_BLOCK_BYTES):
+        digest.update(prompt[start:start + PROMPT_CACHE_BLOCK_BYTES])
+        digests.append(digest.copy().digest())
+    return digests
@@ -0,0 +1,189 @@
+"""Streaming JSONL export and import of captured traffic.
+
+An export is one JSON object per line: a header, then every user_requests row,
+then every llm_requests row with its bodies inline, whether they live in the
+database, a segment or the archive. Rows are read in keyset-paginated batches
+and imported rows are committed a batch per transaction by a capture writer of
+the import's own, off the /proxy queue, so neither side holds more than a
+batch in memory and live turns do not wait for an import. Conversations themselves live in Letta and are not
+part of the export; user_requests rows carry their conv_id.
+"""
+import asyncio
+import json
+from time import time
+from typing import Any, AsyncIterator, Optional
+import zlib
+
+from capture import CaptureRecord, CaptureWriter
+from db import shard_connect, shards
+from jsoncodec import dumps, loads
+from retention import archived_bodies
+from segments import BODY_COLUMNS, bodies_from_row
+
+EXPORT_VERSION = 1
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+USER_REQUEST_COLUMNS = ["conv_id", "user_message_id", "assistant_message_id"]
+LLM_REQUEST_COLUMNS = [
+    "timestamp", "path", "method", "response_status", "duration_ms", "correlated_request_id",
+    "model", "prompt_tokens", "completion_tokens", "cached_tokens", "finish_reason", "usage_extracted",
+    "upstream_request_body", "prompt_rewrites"
+]
+
+def _filters(conv_ids: Optional[list[str]], since: Optional[float], until: Optional[float]) -> tuple[str, str, dict[str, Any]]:
+    """WHERE clauses for user_requests and llm_requests, and their parameters."""
+    params: dict[str, Any] = {"since": since, "until": until, "conv_ids": json.dumps(conv_ids) if conv_ids else None}
+    in_conversations = "(:conv_ids IS NULL OR user_requests.conv_id IN (SELECT value FROM json_each(:conv_ids)))"
+    in_window = "(:since IS NULL OR llm_requests.timestamp >= :since) AND (:until IS NULL OR llm_requests.timestamp < :until)"
+    user_requests_where = f"""{in_conversations} AND (
+        (:since IS NULL AND :until IS NULL)
+        OR EXISTS (SELECT 1 FROM llm_requests WHERE llm_requests.correlated_request_id = user_requests.id AND {in_window})
+    )"""
+    llm_requests_where = f"{in_window} AND (:conv_ids IS NULL OR {in_conversations})"
+    return user_requests_where, llm_requests_where, params
+
+def _user_requests_batch(shard: Optional[str], where: str, params: dict[str, Any], after: int) -> list[tuple]:
+    with shard_connect(shard) as conn:
+        cursor = conn.execute(f"""
+            SELECT user_requests.rowid, user_requests.id, {", ".join(f"user_requests.{c}" for c in USER_REQUEST_COLUMNS)}
+            FROM user_requests
+            WHERE user_requests.rowid > :after AND {where}
+            ORDER BY user_requests.rowid
+            LIMIT :limit
+        """, {**params, "after": after, "limit": EXPORT_BATCH_SIZE})
+        return cursor.fetchall()
+
+def _llm_requests_batch(shard: Optional[str], where: str, params: dict[str, Any], after: int) -> list[tuple]:
+    with shard_connect(shard) as conn:
+        cursor = conn.execute(f"""
+            SELECT llm_requests.rowid, llm_requests.id, {", ".join(f"llm_requests.{c}" for c in LLM_REQUEST_COLUMNS)},
+                llm_requests.archived, user_requests.conv_id, llm_requests.archive_offset, llm_requests.archive_length, {BODY_COLUMNS}
+            FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE llm_requests.rowid > :after AND {where}
+            ORDER BY llm_requests.rowid
+            LIMIT :limit
+        """, {**params, "after": after, "limit": EXPORT_BATCH_SIZE})
+        rows = cursor.fetchall()
+    columns = len(LLM_REQUEST_COLUMNS)
+    archived = archived_bodies([(row[1], *row[3 + columns:6 + columns]) for row in rows if row[2 + columns]])
+    records = []
+    for row in rows:
+        if row[2 + columns]:
+            request_body, response_body = archived.get(row[1], (None, None))
+        else:
+            request_body, response_body = bodies_from_row(row[6 + columns:])
+        records.append((row[0], {
+            "type": "llm_request",
+            "id": row[1],
+            **dict(zip(LLM_REQUEST_COLUMNS, row[2:2 + columns])),
+            "request_body": request_body,
+            "response_body": response_body
+        }))
+    return records
+
+async def export_lines(conv_ids: Optional[list[str]] = None, since: Optional[float] = None, until: Optional[float] = None) -> AsyncIterator[bytes]:
+    user_requests_where, llm_requests_where, params = _filters(conv_ids, since, until)
+    yield (json.dumps({
+        "type": "header",
+        "version": EXPORT_VERSION,
+        "exported_at": time(),
+        "conv_ids": conv_ids,
+        "since": since,
+        "until": until
+    }) + "\n").encode("utf-8")
+    # With sharded storage, only the shards of the conversations asked for; rowids are per shard.
+    selected = await asyncio.to_thread(shards, conv_ids or None)
+    for shard in selected:
+        after = 0
+        while rows := await asyncio.to_thread(_user_requests_batch, shard, user_requests_where, params, after):
+            after = rows[-1][0]
+            yield b"".join(dumps({
+                "type": "user_request",
+                "id": row[1],
+                **dict(zip(USER_REQUEST_COLUMNS, row[2:]))
+            }) + b"\n" for row in rows)
+    # Every user_request line comes first, so an import knows each turn's conversation before its calls.
+    for shard in selected:
+        after = 0
+        while records := await asyncio.to_thread(_llm_requests_batch, shard, llm_requests_where, params, after):
+            after = records[-1][0]
+            yield b"".join(dumps(record) + b"\n" for _, record in records)
+
+async def export_stream(conv_ids: Optional[list[str]] = None, since: Optional[float] = None, until: Optional[float] = None, compress: bool = False) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = bytearray()
+    async for lines in export_lines(conv_ids, since, until):
+        buffer += compressor.compress(lines) if compressor is not None else lines
+        if len(buffer) >= EXPORT_CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    if compressor is not None:
+        buffer += compressor.flush()
+    if buffer:
+        yield bytes(buffer)
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    decompressor = None
+    pending = b""
+    first = True
+    async for chunk in chunks:
+        if first and chunk:
+            first = False
+            # Accept gzip bodies whether or not the client said so.
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(wbits=47)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if decompressor is not None:
+        pending += decompressor.flush()
+    for line in pending.split(b"\n"):
+        yield line
+
+async def import_stream(chunks: AsyncIterator[bytes]) -> dict[str, int]:
+    # Not the /proxy capture queue: a large import would hold up every live turn's flush.
+    writer = CaptureWriter()
+    try:
+        return await _import_lines(writer, _lines(chunks))
+    finally:
+        await writer.close()
+
+async def _import_lines(writer: CaptureWriter, lines: AsyncIterator[bytes]) -> dict[str, int]:
+    counts = {"user_requests": 0, "llm_requests": 0}
+    batch: list[CaptureRecord] = []
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = loads(line)
+        except ValueError:
+            raise Exception(f"Invalid JSON on import line {line_number}")
+        match record.get("type"):
+            case "header":
+                if record.get("version") != EXPORT_VERSION:
+                    raise Exception(f"Unsupported export version {record.get('version')}")
+            case "user_request":
+                fields = {c: record.get(c) for c in USER_REQUEST_COLUMNS}
+                batch.append(CaptureRecord(table="user_requests", id=record["id"], fields=fields))
+                counts["user_requests"] += 1
+            case "llm_request":
+                fields = {c: record.get(c) for c in LLM_REQUEST_COLUMNS + ["request_body", "response_body"]}
+                # Bodies arrive inline, so an archived row being overwritten is hot again.
+                fields["archived"] = None
+                fields["search_indexed"] = None
+                batch.append(CaptureRecord(table="llm_requests", id=record["id"], fields=fields))
+                counts["llm_requests"] += 1
+            case other:
+                raise Exception(f"Unknown record type {other!r} on import line {line_number}")
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            await writer.write(batch)
+            batch = []
+    if batch:
+        await writer.write(batch)
+    return counts
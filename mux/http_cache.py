@@ -0,0 +1,101 @@
+"""Conditional GETs and response compression for the read endpoints.
+
+An ETag is a hash of what a response is computed from, read from SQLite
+before any Letta or differ work: for a conversation, its user_requests and the
+llm_requests correlated with them; for an LLM request, its status and its
+precomputed llm_request_parsed row. A client that sends the ETag back in
+If-None-Match gets a 304 for the price of that one query. Changes made to a
+Letta agent outside the mux do not change the ETag.
+"""
+import hashlib
+import os
+from sqlite3 import Connection
+from typing import Optional
+from fastapi import Request, Response
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+# Bump when the JSON of these endpoints changes shape, so cached copies are not reused.
+ETAG_FORMAT = 1
+# Clients may keep a copy but must revalidate it on every use.
+CACHE_CONTROL = "no-cache"
+COMPRESS_MIN_BYTES = int(os.environ.get("MUX_COMPRESS_MIN_BYTES", "1024"))
+COMPRESSED_PATH_PREFIXES = ("/api/conv", "/api/seq", "/api/llm_request", "/api/search", "/api/usage", "/api/trace")
+
+def conversation_version(conn: Connection, conv_id: str) -> str:
+    cursor = conn.execute("""
+        SELECT COUNT(*), MAX(rowid), COUNT(assistant_message_id),
+            (SELECT COUNT(*) || '.' || IFNULL(MAX(llm_requests.rowid), '') || '.' || COUNT(llm_requests.response_status)
+                FROM llm_requests JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+                WHERE user_requests.conv_id = :conv_id)
+        FROM user_requests WHERE conv_id = :conv_id
+    """, {"conv_id": conv_id})
+    return ".".join(str(value) for value in cursor.fetchone())
+
+def llm_request_version(conn: Connection, llm_request_id: str) -> Optional[str]:
+    """None when there is no such LLM request."""
+    cursor = conn.execute("""
+        SELECT llm_requests.response_status, llm_requests.archived, llm_request_parsed.computed_at, user_requests.conv_id
+        FROM llm_requests
+        LEFT JOIN llm_request_parsed ON llm_request_parsed.id = llm_requests.id
+        LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+        WHERE llm_requests.id = ?
+    """, (llm_request_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    response_status, archived, computed_at, conv_id = row
+    if computed_at is not None:
+        return f"{response_status}.{computed_at}"
+    # Without a parsed row the flags are classified against the conversation as it is now.
+    return f"{response_status}.{archived}.{conversation_version(conn, conv_id) if conv_id is not None else ''}"
+
+def make_etag(*parts: object) -> str:
+    digest = hashlib.sha256("\0".join(str(part) for part in (ETAG_FORMAT, *parts)).encode("utf-8"))
+    # Weak: CompressionMiddleware serves the same tag on compressed and identity bodies, which
+    # a strong validator may not do.
+    return f'W/"{digest.hexdigest()[:32]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison.
+    return etag.removeprefix("W/") in (candidate.strip().removeprefix("W/") for candidate in header.split(","))
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+def not_modified(etag: str) -> Response:
+    response = Response(status_code=304)
+    set_etag(response, etag)
+    return response
+
+class CompressionMiddleware:
+    """Brotli (with gzip fallback) when brotli-asgi is installed, else gzip, for the JSON read endpoints only.
+
+    Streams are left alone: the compressor would hold back NDJSON lines until it had a block's worth.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed = BrotliMiddleware(app, minimum_size=COMPRESS_MIN_BYTES, gzip_fallback=True)
+        else:
+            self.compressed = GZipMiddleware(app, minimum_size=COMPRESS_MIN_BYTES)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and _compressible(scope["path"]):
+            await self.compressed(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+def _compressible(path: str) -> bool:
+    return path.startswith(COMPRESSED_PATH_PREFIXES) and not path.endswith("/stream")
@@ -0,0 +1,84 @@
+"""JSON encoding and decoding for the hot paths, through orjson or msgspec when installed.
+
+MUX_JSON=auto (the default) uses orjson, else msgspec, else the standard
+library; MUX_JSON=orjson|msgspec|stdlib forces one. Every backend decodes str
+or bytes and raises ValueError on invalid JSON. Input the fast backends reject
+but the standard library accepts, such as NaN or integers beyond 64 bits, falls
+back to the standard library, so the backend only changes speed and whitespace.
+"""
+import importlib
+import json
+import os
+from typing import Any, Callable
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+JSON_BACKEND = os.environ.get("MUX_JSON", "auto")
+JSON_BACKENDS = ("orjson", "msgspec")
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _stdlib_dumps(obj: Any, indent: bool = False) -> bytes:
+    return json.dumps(obj, default=_default, indent=2 if indent else None).encode("utf-8")
+
+def _select_backend() -> tuple[str, Callable[[str | bytes], Any], Callable[..., bytes]]:
+    if JSON_BACKEND not in ("auto", "stdlib", *JSON_BACKENDS):
+        raise Exception(f"Unknown MUX_JSON backend {JSON_BACKEND!r}")
+    candidates = JSON_BACKENDS if JSON_BACKEND == "auto" else (JSON_BACKEND,)
+    for name in candidates:
+        if name == "stdlib":
+            break
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            if JSON_BACKEND != "auto":
+                print(f"MUX_JSON={name} is not installed, using the standard library json")
+            continue
+        match name:
+            case "orjson":
+                def orjson_dumps(obj: Any, indent: bool = False) -> bytes:
+                    return module.dumps(obj, default=_default, option=module.OPT_INDENT_2 if indent else 0)
+                return name, module.loads, orjson_dumps
+            case "msgspec":
+                encoder = module.json.Encoder(enc_hook=_default)
+                decoder = module.json.Decoder()
+                def msgspec_loads(data: str | bytes) -> Any:
+                    try:
+                        return decoder.decode(data)
+                    except module.DecodeError as e:
+                        raise ValueError(str(e)) from e
+                def msgspec_dumps(obj: Any, indent: bool = False) -> bytes:
+                    data = encoder.encode(obj)
+                    return module.json.format(data, indent=2) if indent else data
+                return name, msgspec_loads, msgspec_dumps
+    return "stdlib", json.loads, _stdlib_dumps
+
+backend, _loads, _dumps = _select_backend()
+
+def loads(data: str | bytes) -> Any:
+    try:
+        return _loads(data)
+    except ValueError:
+        if backend == "stdlib":
+            raise
+        return json.loads(data)
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    try:
+        return _dumps(obj, indent)
+    except (TypeError, OverflowError):
+        if backend == "stdlib":
+            raise
+        return _stdlib_dumps(obj, indent)
+
+def dumps_text(obj: Any, indent: bool = False) -> str:
+    return dumps(obj, indent).decode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered by the selected backend. Returning one directly from a route
+    also skips FastAPI's jsonable_encoder pass; Pydantic models in it are dumped as they are met."""
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
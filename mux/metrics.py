@@ -0,0 +1,250 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
+import threading
+from time import perf_counter, thread_time
+from typing import Iterable, TypeVar
+
+# Prometheus text exposition, kept dependency-free so it ships with the image as is.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class _Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels: str):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    @contextmanager
+    def time_cpu(self, **labels: str):
+        # thread_time only counts the calling thread, so concurrent requests
+        # on other threads do not leak into the measurement.
+        start = thread_time()
+        try:
+            yield
+        finally:
+            self.observe(thread_time() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key in sorted(self._counts):
+                cumulative = 0
+                for bound, count in zip(self.buckets, self._counts[key]):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(self._sums[key])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+M = TypeVar("M", bound=_Metric)
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+CORRELATOR_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "mux_correlator_lock_wait_seconds", "Time spent waiting to acquire the ProxyCorrelator lock."))
+CORRELATOR_HOLD_SECONDS = REGISTRY.register(Histogram(
+    "mux_correlator_lock_hold_seconds", "Time the ProxyCorrelator lock was held for one user turn."))
+CORRELATOR_WAITING = REGISTRY.register(Gauge(
+    "mux_correlator_waiting", "User turns currently waiting for the ProxyCorrelator lock."))
+CORRELATOR_ACTIVE = REGISTRY.register(Gauge(
+    "mux_correlator_active", "User turns currently holding the ProxyCorrelator lock."))
+
+DB_SECONDS = REGISTRY.register(Histogram(
+    "mux_db_seconds", "Time spent in SQLite work, by operation.", ["op"]))
+
+UPSTREAM_SECONDS = REGISTRY.register(Histogram(
+    "mux_upstream_seconds", "Latency of proxied upstream LLM calls.", ["path", "model", "status"]))
+UPSTREAM_RESPONSES = REGISTRY.register(Counter(
+    "mux_upstream_responses_total", "Proxied upstream LLM responses.", ["path", "model", "status"]))
+UPSTREAM_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mux_upstream_in_flight", "Upstream LLM calls currently in flight."))
+PROMPT_REWRITE_LINES = REGISTRY.register(Counter(
+    "mux_prompt_rewrite_lines_total", "System prompt lines moved to the trailing message by prompt rewriting, by rule.", ["rule"]))
+PROXY_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mux_proxy_in_flight", "Requests to /proxy currently being handled."))
+
+CAPTURE_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "mux_capture_queue_depth", "Captured /proxy records waiting for the background writer."))
+CAPTURE_SPILLED = REGISTRY.register(Counter(
+    "mux_capture_spilled_total", "Captured /proxy records spilled to the append-only file because the queue was full or a write failed."))
+CAPTURE_BATCH_SIZE = REGISTRY.register(Histogram(
+    "mux_capture_batch_size", "Records committed per background writer transaction.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+
+LETTA_SECONDS = REGISTRY.register(Histogram(
+    "mux_letta_seconds", "Latency of Letta API calls made by LettaClient.", ["method", "outcome"]))
+LETTA_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mux_letta_in_flight", "Letta API calls currently in flight.", ["method"]))
+
+DIFFER_CPU_SECONDS = REGISTRY.register(Histogram(
+    "mux_differ_cpu_seconds", "CPU time spent in the differ.", ["function"]))
+
+TURNS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mux_turns_in_flight", "User turns (posts to a conversation) currently in flight."))
+TURN_SECONDS = REGISTRY.register(Histogram(
+    "mux_turn_seconds", "End-to-end latency of a user turn.", ["outcome"]))
+
+def timed_letta_call(method: str):
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            LETTA_IN_FLIGHT.inc(method=method)
+            start = perf_counter()
+            outcome = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                LETTA_SECONDS.observe(perf_counter() - start, method=method, outcome=outcome)
+                LETTA_IN_FLIGHT.dec(method=method)
+        return wrapper
+    return decorator
+
+@asynccontextmanager
+async def timed_lock(lock):
+    CORRELATOR_WAITING.inc()
+    start = perf_counter()
+    try:
+        await lock.acquire()
+    finally:
+        CORRELATOR_WAITING.dec()
+    acquired = perf_counter()
+    CORRELATOR_WAIT_SECONDS.observe(acquired - start)
+    CORRELATOR_ACTIVE.inc()
+    try:
+        yield
+    finally:
+        CORRELATOR_ACTIVE.dec()
+        CORRELATOR_HOLD_SECONDS.observe(perf_counter() - acquired)
+        lock.release()
@@ -0,0 +1,71 @@
+"""Parsed LLM calls with their injected flags, computed once per turn.
+
+Classifying which messages of an LLM call were injected needs the visible
+conversation from Letta. Instead of fetching it on every /api/llm_request read,
+the turn schedules one background pass when it completes. The pass classifies
+every call of the conversation that has no llm_request_parsed row yet and
+stores the result through the capture writer. The flags are a snapshot of the
+conversation as it was after that turn.
+"""
+import asyncio
+from sqlite3 import Connection
+from time import time
+from typing import Any, Optional
+
+from capture import capture_writer
+from client_interface import Message
+from db import db_connect
+from differ import LLMRequestMessage, diff_llm_request
+from jsoncodec import dumps_text, loads
+from retention import read_bodies
+
+def unparsed_llm_request_ids(conv_id: str) -> list[str]:
+    with db_connect(conv_id) as conn:
+        cursor = conn.execute("""
+            SELECT llm_requests.id
+            FROM llm_requests JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE user_requests.conv_id = ? AND llm_requests.response_status = 200 AND llm_requests.archived IS NULL
+                AND NOT EXISTS (SELECT 1 FROM llm_request_parsed WHERE llm_request_parsed.id = llm_requests.id)
+            ORDER BY llm_requests.timestamp
+        """, (conv_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+def parsed_fields(conv_id: str, messages: list[LLMRequestMessage], available_tools: str) -> dict[str, Any]:
+    return {
+        "conv_id": conv_id,
+        "messages": dumps_text(messages),
+        "available_tools": available_tools,
+        "computed_at": time()
+    }
+
+def _classify(conv_id: str, llm_request_ids: list[str], visible_messages: list[Message]) -> dict[str, dict[str, Any]]:
+    with db_connect(conv_id) as conn:
+        bodies = read_bodies(conn, llm_request_ids)
+    parsed = {}
+    for llm_request_id, (request_body, response_body) in bodies.items():
+        if request_body is None or response_body is None:
+            continue
+        try:
+            messages, available_tools = diff_llm_request(request_body, response_body, visible_messages)
+            parsed[llm_request_id] = parsed_fields(conv_id, messages, available_tools)
+        except Exception as e:
+            print(f"Classifying LLM request {llm_request_id} failed: {e}")
+    return parsed
+
+async def store_parsed(conv_id: str, llm_request_ids: list[str], visible_messages: list[Message]) -> int:
+    parsed = await asyncio.to_thread(_classify, conv_id, llm_request_ids, visible_messages)
+    for llm_request_id, fields in parsed.items():
+        await capture_writer.submit("llm_request_parsed", llm_request_id, fields)
+    return len(parsed)
+
+def read_parsed(conn: Connection, llm_request_id: str) -> Optional[dict[str, Any]]:
+    cursor = conn.execute("SELECT conv_id, messages, available_tools FROM llm_request_parsed WHERE id = ?", (llm_request_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {
+        "id": llm_request_id,
+        "conv_id": row[0],
+        "messages": loads(row[1]),
+        "available_tools": row[2]
+    }
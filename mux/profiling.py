@@ -0,0 +1,154 @@
+import asyncio
+import cProfile
+from contextvars import ContextVar
+import io
+import os
+import pstats
+from typing import Callable, TypeVar
+from urllib.parse import parse_qs
+import uuid
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Opt-in per-request profiling: with MUX_PROFILE_ALLOW=1, add ?profile=1 (cProfile)
+# or ?profile=pyinstrument to any request; or set MUX_PROFILE=1 to profile every
+# request. The report is saved under storage/profiles, which keeps the newest
+# MUX_PROFILE_KEEP reports, and its id returned in the X-Profile-Id header.
+
+PROFILE_ALL = os.environ.get("MUX_PROFILE", "0") in ("1", "cprofile", "pyinstrument")
+PROFILE_DEFAULT = "pyinstrument" if os.environ.get("MUX_PROFILE") == "pyinstrument" else "cprofile"
+# A profiler on the event loop slows every request in the worker, so clients may only ask for one when allowed.
+PROFILE_ALLOW = os.environ.get("MUX_PROFILE_ALLOW", "0") == "1"
+PROFILE_KEEP = int(os.environ.get("MUX_PROFILE_KEEP", "100"))
+PROFILE_DIR = "storage/profiles"
+PROFILE_TOP = 60
+
+# Only one profiler can be attached to the interpreter at a time, so concurrent
+# profiled requests are served unprofiled rather than failing.
+_profiling = asyncio.Lock()
+
+T = TypeVar("T")
+
+def _requested_profiler(scope: Scope) -> str | None:
+    flag = None
+    if PROFILE_ALLOW and b"profile=" in scope["query_string"]:
+        flag = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [None])[-1]
+    match flag:
+        case "1" | "cprofile":
+            return "cprofile"
+        case "pyinstrument":
+            return "pyinstrument"
+        case None if PROFILE_ALL:
+            return PROFILE_DEFAULT
+        case _:
+            return None
+
+class _Profile:
+    """One profiled request: a profiler on the event loop thread, plus a cProfile per call
+    made through `profiled` on a worker thread while the request is running."""
+    def __init__(self, kind: str):
+        self.threads: list[cProfile.Profile] = []
+        self.pyinstrument = None
+        self.cprofile: cProfile.Profile | None = None
+        if kind == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+                self.pyinstrument = Profiler(async_mode="enabled")
+            except ImportError:
+                pass
+        if self.pyinstrument is not None:
+            self.pyinstrument.start()
+        else:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self) -> str:
+        output = io.StringIO()
+        profilers = list(self.threads)
+        if self.pyinstrument is not None:
+            self.pyinstrument.stop()
+            output.write(self.pyinstrument.output_text(unicode=True, color=False))
+            if len(profilers) > 0:
+                output.write("\nWorker threads (cProfile):\n")
+        else:
+            assert self.cprofile is not None
+            self.cprofile.disable()
+            profilers.insert(0, self.cprofile)
+        if len(profilers) > 0:
+            pstats.Stats(*profilers, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return output.getvalue()
+
+_current: ContextVar[_Profile | None] = ContextVar("profile", default=None)
+
+def profiled(fn: Callable[..., T], *args) -> T:
+    """Call fn, counting it in the current request's profile if it has one. For work a profiled
+    request hands to a worker thread (asyncio.to_thread copies the context), which the
+    event loop's profiler does not see."""
+    profile = _current.get()
+    if profile is None:
+        return fn(*args)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # From Python 3.12 cProfile runs on sys.monitoring, so the request's own cProfile already sees this thread.
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        profile.threads.append(profiler)
+
+class ProfileMiddleware:
+    """Profiles the requests that ask for it, including a streamed body until its last chunk.
+    Every other request goes straight through to the app."""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not (PROFILE_ALL or PROFILE_ALLOW):
+            await self.app(scope, receive, send)
+            return
+        kind = _requested_profiler(scope)
+        if kind is None or _profiling.locked():
+            await self.app(scope, receive, send)
+            return
+        await _profiling.acquire()
+        profile_id = str(uuid.uuid4())
+
+        async def send_with_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        profile = _Profile(kind)
+        token = _current.set(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current.reset(token)
+            report = profile.stop()
+            _profiling.release()
+            _save_profile(profile_id, f"{scope['method']} {scope['path']}\n\n{report}")
+
+def _save_profile(profile_id: str, report: str):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.txt"), "w") as f:
+        f.write(report)
+    paths = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".txt"))
+    for _, path in paths[:max(len(paths) - PROFILE_KEEP, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def read_profile(profile_id: str) -> str | None:
+    try:
+        uuid.UUID(profile_id)
+    except ValueError:
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.txt")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
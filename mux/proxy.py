@@ -1,34 +1,81 @@
-import json
 import os
+from time import perf_counter
 from fastapi import Request, Response
 from fastapi.datastructures import Headers
 import httpx
 
+from dummy_openai import DummyOpenAI
+from jsoncodec import dumps, loads
+from metrics import UPSTREAM_IN_FLIGHT, UPSTREAM_RESPONSES, UPSTREAM_SECONDS
+from tracing import tracer
+from usage import request_model
+
+# "openai" forwards to api.openai.com, "dummy" answers in-process from DummyOpenAI
+# (configured through MUX_DUMMY_* variables) for load tests.
+UPSTREAM = os.environ.get("MUX_UPSTREAM", "openai")
+
+_dummy_transport: httpx.ASGITransport | None = None
+
+def _upstream_transport() -> httpx.AsyncBaseTransport | None:
+    global _dummy_transport
+    match UPSTREAM:
+        case "dummy":
+            if _dummy_transport is None:
+                _dummy_transport = httpx.ASGITransport(app=DummyOpenAI.from_env())
+            return _dummy_transport
+        case _:
+            return None
+
+_upstream_client: httpx.AsyncClient | None = None
+
+def upstream_client() -> httpx.AsyncClient:
+    """One keep-alive connection pool for every upstream call, opened on first use."""
+    global _upstream_client
+    if _upstream_client is None:
+        _upstream_client = httpx.AsyncClient(transport=_upstream_transport())
+    return _upstream_client
+
+async def close_upstream_client():
+    global _upstream_client
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+        _upstream_client = None
 
 class ProxyOpenAI:
-    async def handle(self, request: Request, path: str) -> Response:
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self.transport = transport
+
+    async def handle(self, request: Request, path: str, model: str | None = None, body: bytes | None = None) -> Response:
+        """Forward the request, or `body` in place of its own body when given."""
+        if self.transport is not None:
+            async with httpx.AsyncClient(transport=self.transport) as client:
+                return await self.forward(client, request, path, model, body)
+        return await self.forward(upstream_client(), request, path, model, body)
+
+    async def forward(self, client: httpx.AsyncClient, request: Request, path: str, model: str | None, body: bytes | None) -> Response:
         target_url = self.translate_path(path)
 
         try:
-            async with httpx.AsyncClient() as client:
-                req = client.build_request(
-                    request.method,
-                    target_url,
-                    headers=self.forward_headers(request.headers),
-                    content=await request.body()
-                )
-                
-                resp = await client.send(req)
-                content = self.hack_content(path, resp.content)
+            if body is None:
+                body = await request.body()
+            req = client.build_request(
+                request.method,
+                target_url,
+                headers=self.forward_headers(request.headers),
+                content=body
+            )
+            
+            resp = await self.send_timed(client, req, path, model if model is not None else request_model(body))
+            content = self.hack_content(path, resp.content)
 
-                return Response(
-                    content=content,
-                    status_code=resp.status_code,
-                    headers=self.backward_headers(resp.headers)
-                )
+            return Response(
+                content=content,
+                status_code=resp.status_code,
+                headers=self.backward_headers(resp.headers)
+            )
         except NotImplementedError as e:
             return Response(
-                content=json.dumps({
+                content=dumps({
                     "error": {
                         "message": str(e),
                         "type": "not_implemented_error",
@@ -40,6 +87,19 @@ class ProxyOpenAI:
                 media_type="application/json"
             )
 
+    async def send_timed(self, client: httpx.AsyncClient, req: httpx.Request, path: str, model: str) -> httpx.Response:
+        status = "error"
+        start = perf_counter()
+        try:
+            with tracer.span("upstream", **{"http.url": str(req.url), "gen_ai.request.model": model}) as span, UPSTREAM_IN_FLIGHT.track():
+                resp = await client.send(req)
+                span.set_attribute("http.status_code", resp.status_code)
+            status = str(resp.status_code)
+            return resp
+        finally:
+            UPSTREAM_SECONDS.observe(perf_counter() - start, path=path, model=model, status=status)
+            UPSTREAM_RESPONSES.inc(path=path, model=model, status=status)
+
     def forward_headers(self, headers: Headers) -> dict[str, str]:
         forward_headers = {}
         for key, value in headers.items():
@@ -62,11 +122,11 @@ class ProxyOpenAI:
             case "api/v0/models":
                 # Hack to convert OpenAI models response to expected format
                 # for compatibility with letta's lmstudio client
-                data = json.loads(content)
+                data = loads(content)
                 for model in data["data"]:
                     model["type"] = "llm"  
                     model["compatibility_type"] = "gguf"
-                return json.dumps(data).encode("utf-8")
+                return dumps(data)
             case _:
                 return content
     
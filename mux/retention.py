@@ -0,0 +1,370 @@
+"""Retention and archival for captured llm_requests.
+
+Rows older than the hot window (MUX_RETENTION_HOT_DAYS) have their bodies moved
+to a gzip file per conversation under storage/archive and cleared from the
+database; their metadata and usage columns stay, and read_bodies loads archived
+bodies back on demand. Rows older than MUX_RETENTION_MAX_AGE_DAYS are deleted.
+If the bodies still held in the database exceed MUX_RETENTION_MAX_BYTES, the
+oldest are archived until they fit. Spans older than MUX_TRACE_MAX_AGE_DAYS
+(by default MUX_RETENTION_MAX_AGE_DAYS) are deleted from the trace store. Each
+pass ends with an incremental vacuum.
+
+    uv run retention.py            # one retention pass with the configured policy
+"""
+import argparse
+import gzip
+import io
+import os
+import re
+from sqlite3 import Connection
+from time import time
+from typing import BinaryIO, Optional
+import zlib
+
+from db import db_connect, each_shard, forget_conversation, forget_llm_requests, shard_connect, shards, sharded
+from jsoncodec import dumps, loads
+from segments import BODY_COLUMNS, bodies_from_row, compact
+from tracing import tracer
+from workers import FileLock
+
+def _days(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) * 86400 if value else None
+
+RETENTION_HOT_SECONDS = _days("MUX_RETENTION_HOT_DAYS")
+RETENTION_MAX_AGE_SECONDS = _days("MUX_RETENTION_MAX_AGE_DAYS")
+# Spans are kept as long as the rows they describe unless set separately.
+TRACE_MAX_AGE_SECONDS = _days("MUX_TRACE_MAX_AGE_DAYS") if os.environ.get("MUX_TRACE_MAX_AGE_DAYS") else RETENTION_MAX_AGE_SECONDS
+RETENTION_MAX_BYTES = int(os.environ["MUX_RETENTION_MAX_BYTES"]) if os.environ.get("MUX_RETENTION_MAX_BYTES") else None
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("MUX_RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_PURGE_ON_DELETE = os.environ.get("MUX_RETENTION_PURGE_ON_DELETE", "1") != "0"
+RETENTION_BATCH_SIZE = 500
+ARCHIVE_DIR = "storage/archive"
+RETENTION_LOCK_PATH = "storage/retention.lock"
+ARCHIVE_MEMBER_ROWS = 50
+# Rows no conversation claimed are archived together.
+UNCORRELATED = "_uncorrelated"
+
+def retention_enabled() -> bool:
+    return (RETENTION_HOT_SECONDS is not None or RETENTION_MAX_AGE_SECONDS is not None or RETENTION_MAX_BYTES is not None
+            or TRACE_MAX_AGE_SECONDS is not None)
+
+def archive_path(conv_id: Optional[str]) -> str:
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", conv_id or UNCORRELATED)
+    return os.path.join(ARCHIVE_DIR, f"{name}.jsonl.gz")
+
+# An archive is a series of gzip members of at most ARCHIVE_MEMBER_ROWS rows each. Every archived
+# row records the offset and length of its member, so reading a row decompresses only that member.
+def _scan(f: BinaryIO, wanted: set[str], bodies: dict[str, tuple[Optional[str], Optional[str]]]):
+    with gzip.GzipFile(fileobj=f, mode="rb") as lines:
+        for line in lines:
+            record = loads(line)
+            if record["id"] in wanted:
+                bodies[record["id"]] = (record["request_body"], record["response_body"])
+
+def read_archived(conv_id: Optional[str], members: dict[str, tuple[Optional[int], Optional[int]]]) -> dict[str, tuple[Optional[str], Optional[str]]]:
+    """The bodies of a conversation's archived rows, given each id's (archive_offset, archive_length)."""
+    by_member: dict[tuple[int, int], set[str]] = {}
+    for llm_request_id, (offset, length) in members.items():
+        if offset is not None:
+            by_member.setdefault((offset, length), set()).add(llm_request_id)
+    bodies: dict[str, tuple[Optional[str], Optional[str]]] = {}
+    try:
+        with open(archive_path(conv_id), "rb") as f:
+            for (offset, length), wanted in by_member.items():
+                f.seek(offset)
+                try:
+                    _scan(io.BytesIO(f.read(length)), wanted, bodies)
+                except (OSError, EOFError, ValueError, zlib.error):
+                    pass
+            # Rows archived before the index existed, or whose index a crash mid-rewrite left stale.
+            missing = set(members) - set(bodies)
+            if len(missing) > 0:
+                f.seek(0)
+                _scan(f, missing, bodies)
+    except FileNotFoundError:
+        pass
+    return bodies
+
+def archived_bodies(rows: list[tuple]) -> dict[str, tuple[Optional[str], Optional[str]]]:
+    """Bodies of archived rows given as (id, conv_id, archive_offset, archive_length)."""
+    by_conv: dict[Optional[str], dict[str, tuple[Optional[int], Optional[int]]]] = {}
+    for llm_request_id, conv_id, offset, length in rows:
+        by_conv.setdefault(conv_id, {})[llm_request_id] = (offset, length)
+    bodies: dict[str, tuple[Optional[str], Optional[str]]] = {}
+    for conv_id, members in by_conv.items():
+        bodies.update(read_archived(conv_id, members))
+    return bodies
+
+def read_bodies(conn: Connection, llm_request_ids: list[str]) -> dict[str, tuple[Optional[str], Optional[str]]]:
+    """(request_body, response_body) for each id, from the database, a segment or the archive."""
+    bodies: dict[str, tuple[Optional[str], Optional[str]]] = {}
+    for start in range(0, len(llm_request_ids), RETENTION_BATCH_SIZE):
+        chunk = llm_request_ids[start:start + RETENTION_BATCH_SIZE]
+        cursor = conn.execute(f"""
+            SELECT llm_requests.id, llm_requests.archived, user_requests.conv_id,
+                llm_requests.archive_offset, llm_requests.archive_length, {BODY_COLUMNS}
+            FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE llm_requests.id IN ({", ".join("?" for _ in chunk)})
+        """, chunk)
+        archived = []
+        for row in cursor.fetchall():
+            if row[1]:
+                archived.append((row[0], *row[2:5]))
+            else:
+                bodies[row[0]] = bodies_from_row(row[5:])
+        found = archived_bodies(archived)
+        for row in archived:
+            bodies[row[0]] = found.get(row[0], (None, None))
+    return bodies
+
+def _write_members(f: BinaryIO, records: list[tuple[str, bytes]]) -> dict[str, tuple[int, int]]:
+    """Append `records` as gzip members; the (offset, length) of each id's member."""
+    index = {}
+    for start in range(0, len(records), ARCHIVE_MEMBER_ROWS):
+        chunk = records[start:start + ARCHIVE_MEMBER_ROWS]
+        member = gzip.compress(b"".join(line for _, line in chunk))
+        offset = f.tell()
+        f.write(member)
+        index.update((llm_request_id, (offset, len(member))) for llm_request_id, _ in chunk)
+    return index
+
+def _archive_rows(conn: Connection, rows: list[tuple]) -> int:
+    by_conv: dict[Optional[str], list[tuple]] = {}
+    for row in rows:
+        by_conv.setdefault(row[1], []).append(row)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    updates = []
+    for conv_id, conv_rows in by_conv.items():
+        records = []
+        sizes = {}
+        for row in conv_rows:
+            request_body, response_body = bodies_from_row(row[2:])
+            records.append((row[0], dumps({"id": row[0], "request_body": request_body, "response_body": response_body}) + b"\n"))
+            sizes[row[0]] = len((request_body or "").encode("utf-8")) + len((response_body or "").encode("utf-8"))
+        # Write and sync the archive before clearing the bodies; a crash in between
+        # only leaves unreferenced members, which the next rewrite drops.
+        with open(archive_path(conv_id), "ab") as f:
+            index = _write_members(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        updates.extend((*index[llm_request_id], size, llm_request_id) for llm_request_id, size in sizes.items())
+    conn.executemany("""
+        UPDATE llm_requests SET archived = 1, archive_offset = ?, archive_length = ?, archive_bytes = ?,
+            request_body = NULL, request_segment = NULL, request_offset = NULL, request_length = NULL,
+            response_body = NULL, response_segment = NULL, response_offset = NULL, response_length = NULL,
+            upstream_request_body = NULL
+        WHERE id = ?
+    """, updates)
+    # The parsed copy holds the same text; archived rows are parsed again on read.
+    conn.executemany("DELETE FROM llm_request_parsed WHERE id = ?", [(row[0],) for row in rows])
+    conn.commit()
+    return len(rows)
+
+def _hot_rows(conn: Connection, before: Optional[float], limit: int) -> list[tuple]:
+    cursor = conn.execute(f"""
+        SELECT llm_requests.id, user_requests.conv_id, {BODY_COLUMNS}
+        FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+        WHERE llm_requests.archived IS NULL AND llm_requests.response_status IS NOT NULL
+            AND (:before IS NULL OR llm_requests.timestamp < :before)
+        ORDER BY llm_requests.timestamp
+        LIMIT :limit
+    """, {"before": before, "limit": limit})
+    return cursor.fetchall()
+
+def archive_before(cutoff: float) -> int:
+    archived = 0
+    for conn in each_shard():
+        while rows := _hot_rows(conn, cutoff, RETENTION_BATCH_SIZE):
+            archived += _archive_rows(conn, rows)
+    return archived
+
+def hot_body_bytes(conn: Connection) -> int:
+    cursor = conn.execute("""
+        SELECT TOTAL(COALESCE(length(CAST(request_body AS BLOB)), request_length, 0) + COALESCE(length(CAST(response_body AS BLOB)), response_length, 0))
+        FROM llm_requests WHERE archived IS NULL
+    """)
+    return int(cursor.fetchone()[0])
+
+def _oldest_hot_timestamp(conn: Connection) -> Optional[float]:
+    return conn.execute("""
+        SELECT MIN(timestamp) FROM llm_requests WHERE archived IS NULL AND response_status IS NOT NULL
+    """).fetchone()[0]
+
+def archive_to_size(max_bytes: int) -> int:
+    """Archive the oldest rows until the bodies left in the database (every shard together) fit in max_bytes."""
+    archived = 0
+    conns = [shard_connect(shard) for shard in shards()]
+    try:
+        excess = sum(hot_body_bytes(conn) for conn in conns) - max_bytes
+        while excess > 0:
+            oldest = sorted((timestamp, index) for index, conn in enumerate(conns) if (timestamp := _oldest_hot_timestamp(conn)) is not None)
+            if len(oldest) == 0:
+                break
+            conn = conns[oldest[0][1]]
+            # Oldest first across shards: this shard's rows up to where the next shard's begin.
+            rows = _hot_rows(conn, oldest[1][0] if len(oldest) > 1 else None, RETENTION_BATCH_SIZE) or _hot_rows(conn, None, 1)
+            selected = []
+            for row in rows:
+                selected.append(row)
+                excess -= (row[5] or len((row[2] or "").encode("utf-8"))) + (row[9] or len((row[6] or "").encode("utf-8")))
+                if excess <= 0:
+                    break
+            archived += _archive_rows(conn, selected)
+    finally:
+        for conn in conns:
+            conn.close()
+    return archived
+
+def _rewrite_archive(conv_id: Optional[str]):
+    """Rewrite a conversation's archive with only the rows still archived, so deleted rows' bodies go with them."""
+    path = archive_path(conv_id)
+    if not os.path.exists(path):
+        return
+    conns = [shard_connect(shard) for shard in shards()] if conv_id is None else [db_connect(conv_id)]
+    try:
+        keep: dict[str, Connection] = {}
+        for conn in conns:
+            cursor = conn.execute("""
+                SELECT llm_requests.id
+                FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+                WHERE llm_requests.archived = 1 AND user_requests.conv_id IS ?
+            """, (conv_id,))
+            keep.update((row[0], conn) for row in cursor.fetchall())
+        if len(keep) == 0:
+            os.remove(path)
+            return
+        index: dict[str, tuple[int, int]] = {}
+        with open(path, "rb") as src, open(path + ".tmp", "wb") as dst:
+            records = []
+            seen = set()
+            with gzip.GzipFile(fileobj=src, mode="rb") as lines:
+                for line in lines:
+                    llm_request_id = loads(line)["id"]
+                    # Crash leftovers can hold a row twice; the first copy is kept.
+                    if llm_request_id in keep and llm_request_id not in seen:
+                        seen.add(llm_request_id)
+                        records.append((llm_request_id, line))
+                    if len(records) == ARCHIVE_MEMBER_ROWS:
+                        index.update(_write_members(dst, records))
+                        records = []
+            index.update(_write_members(dst, records))
+            dst.flush()
+            os.fsync(dst.fileno())
+        for conn in conns:
+            conn.executemany("UPDATE llm_requests SET archive_offset = ?, archive_length = ? WHERE id = ?",
+                             [(*member, llm_request_id) for llm_request_id, member in index.items() if keep[llm_request_id] is conn])
+        # Readers whose offsets no longer match the file fall back to a scan until the commit lands.
+        os.replace(path + ".tmp", path)
+        for conn in conns:
+            conn.commit()
+    finally:
+        for conn in conns:
+            conn.close()
+
+def _remove_unreferenced_archives():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    referenced = set()
+    for conn in each_shard():
+        cursor = conn.execute("""
+            SELECT DISTINCT user_requests.conv_id
+            FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE llm_requests.archived = 1
+        """)
+        referenced.update(archive_path(row[0]) for row in cursor.fetchall())
+    for name in os.listdir(ARCHIVE_DIR):
+        path = os.path.join(ARCHIVE_DIR, name)
+        if path not in referenced:
+            os.remove(path)
+
+def delete_before(cutoff: float) -> int:
+    deleted = 0
+    rewrite = set()
+    for conn in each_shard():
+        # Found before the delete, which drops the user_requests the conversation comes from.
+        cursor = conn.execute("""
+            SELECT DISTINCT user_requests.conv_id
+            FROM llm_requests LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE llm_requests.timestamp < ? AND llm_requests.archived = 1
+        """, (cutoff,))
+        rewrite.update(row[0] for row in cursor.fetchall())
+        # user_requests has no timestamp; drop those whose llm_requests all expire.
+        cursor = conn.execute("""
+            DELETE FROM user_requests
+            WHERE id IN (SELECT correlated_request_id FROM llm_requests WHERE timestamp < :cutoff)
+                AND id NOT IN (SELECT correlated_request_id FROM llm_requests WHERE timestamp >= :cutoff AND correlated_request_id IS NOT NULL)
+            RETURNING id
+        """, {"cutoff": cutoff})
+        expired = [row[0] for row in cursor.fetchall()]
+        cursor = conn.execute("DELETE FROM llm_requests WHERE timestamp < ? RETURNING id", (cutoff,))
+        deleted_ids = [row[0] for row in cursor.fetchall()]
+        deleted += len(deleted_ids)
+        conn.commit()
+        forget_llm_requests(deleted_ids)
+        if sharded() and len(expired) > 0:
+            with db_connect() as catalog:
+                catalog.executemany("DELETE FROM request_conversations WHERE id = ?", [(request_id,) for request_id in expired])
+                catalog.commit()
+    for conv_id in rewrite:
+        _rewrite_archive(conv_id)
+    _remove_unreferenced_archives()
+    return deleted
+
+def purge_conversation(conv_id: str) -> int:
+    """Delete everything captured for a conversation, including its archive."""
+    with db_connect(conv_id) as conn:
+        cursor = conn.execute("""
+            DELETE FROM llm_requests WHERE correlated_request_id IN (SELECT id FROM user_requests WHERE conv_id = ?)
+            RETURNING id
+        """, (conv_id,))
+        deleted_ids = [row[0] for row in cursor.fetchall()]
+        conn.execute("DELETE FROM user_requests WHERE conv_id = ?", (conv_id,))
+        conn.commit()
+    try:
+        os.remove(archive_path(conv_id))
+    except FileNotFoundError:
+        pass
+    forget_llm_requests(deleted_ids)
+    forget_conversation(conv_id)
+    return len(deleted_ids)
+
+def incremental_vacuum(conn: Connection):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Databases created before auto_vacuum was enabled need one full VACUUM to switch.
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    conn.execute("PRAGMA incremental_vacuum")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def run_retention() -> dict[str, int]:
+    # Every worker runs the retention loop; one pass at a time does the work.
+    lock = FileLock(RETENTION_LOCK_PATH)
+    try:
+        if not lock.try_acquire():
+            return {"skipped": 1}
+        return _run_retention()
+    finally:
+        lock.close()
+
+def _run_retention() -> dict[str, int]:
+    now = time()
+    result = {"deleted": 0, "archived": 0}
+    if RETENTION_MAX_AGE_SECONDS is not None:
+        result["deleted"] = delete_before(now - RETENTION_MAX_AGE_SECONDS)
+    if RETENTION_HOT_SECONDS is not None:
+        result["archived"] += archive_before(now - RETENTION_HOT_SECONDS)
+    if RETENTION_MAX_BYTES is not None:
+        result["archived"] += archive_to_size(RETENTION_MAX_BYTES)
+    if TRACE_MAX_AGE_SECONDS is not None:
+        result["spans_deleted"] = tracer.prune(now - TRACE_MAX_AGE_SECONDS)
+    # Archived and deleted rows leave dead bodies behind in body segments.
+    result["segments_compacted"], _ = compact()
+    for conn in each_shard():
+        incremental_vacuum(conn)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    print(run_retention())
@@ -0,0 +1,96 @@
+"""Prompt-prefix stabilization for /proxy.
+
+OpenAI caches prompts by exact prefix, and Letta's system message, the first
+message of every request, contains lines that change from step to step: when
+memory was last modified and how many messages are in recall memory. With
+MUX_PROMPT_REWRITE=1, lines of the system message that match a rule are moved
+out of it into a trailing system message, so everything before the newest
+turn stays byte-identical between steps. Letta never sees the rewritten
+request; /proxy captures both bodies.
+
+Rules are regular expressions matched against each line of the system message,
+overridable with MUX_PROMPT_REWRITE_RULES='{"name": "regex", ...}'.
+"""
+import json
+import os
+import re
+from typing import Optional
+from pydantic import BaseModel
+
+from jsoncodec import dumps, loads
+from metrics import PROMPT_REWRITE_LINES
+
+PROMPT_REWRITE = os.environ.get("MUX_PROMPT_REWRITE", "0") == "1"
+PROMPT_REWRITE_PATHS = {"api/v0/chat/completions"}
+DEFAULT_REWRITE_RULES = {
+    "memory_modified": r"^- Memory blocks were last modified: ",
+    "recall_size": r"^- \d+ previous messages between you and the user are stored in recall memory",
+}
+TRAILER_HEADER = "Current values of metadata moved out of the system prompt above:"
+# For estimates where no tokenizer count is available.
+BYTES_PER_TOKEN = 4
+
+def cacheable_prompt(body: bytes) -> Optional[bytes]:
+    """The part of a chat completion request that prefix caching sees, tools first as upstream renders them."""
+    try:
+        return request_prompt(loads(body))
+    except (ValueError, AttributeError):
+        return None
+
+def request_prompt(request: dict) -> bytes:
+    return dumps([request.get("tools"), request.get("messages")])
+
+def common_prefix_length(a: bytes, b: bytes) -> int:
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class RewriteRule(BaseModel):
+    name: str
+    pattern: str
+
+def rewrite_rules() -> list[RewriteRule]:
+    rules = DEFAULT_REWRITE_RULES
+    if os.environ.get("MUX_PROMPT_REWRITE_RULES"):
+        rules = json.loads(os.environ["MUX_PROMPT_REWRITE_RULES"])
+    return [RewriteRule(name=name, pattern=pattern) for name, pattern in rules.items()]
+
+class PromptRewriter:
+    def __init__(self, rules: list[RewriteRule]):
+        self.rules = [(rule.name, re.compile(rule.pattern)) for rule in rules]
+
+    def rewrite(self, body: bytes) -> Optional[tuple[bytes, int]]:
+        """The body to send upstream and the number of lines moved, or None when no rule matched."""
+        try:
+            data = loads(body)
+        except ValueError:
+            return None
+        messages = data.get("messages") if isinstance(data, dict) else None
+        if not messages or messages[0].get("role") != "system" or not isinstance(messages[0].get("content"), str):
+            return None
+        kept = []
+        moved = []
+        for line in messages[0]["content"].split("\n"):
+            name = next((name for name, pattern in self.rules if pattern.search(line)), None)
+            if name is None:
+                kept.append(line)
+            else:
+                moved.append(line)
+                PROMPT_REWRITE_LINES.inc(rule=name)
+        if len(moved) == 0:
+            return None
+        messages[0] = {**messages[0], "content": "\n".join(kept)}
+        messages.append({"role": "system", "content": "\n".join([TRAILER_HEADER, *moved])})
+        return dumps(data), len(moved)
+
+prompt_rewriter = PromptRewriter(rewrite_rules())
+
+def rewrite_request(path: str, body: bytes) -> Optional[tuple[bytes, int]]:
+    if not PROMPT_REWRITE or path not in PROMPT_REWRITE_PATHS:
+        return None
+    return prompt_rewriter.rewrite(body)
@@ -0,0 +1,132 @@
+"""Full-text search over captured LLM calls.
+
+Each llm_requests row gets one row in the llm_request_search FTS5 table, with
+the same rowid. It holds what the call added to the conversation: the messages
+after the last assistant message of the request (the new user message or tool
+results) and the response, including tool-call names and arguments. The full
+history and system prompt repeat in every request of a conversation, so they
+are left out. The capture writer indexes rows as their bodies are committed.
+
+    uv run search.py rebuild     # index rows captured before the index existed
+"""
+import argparse
+import json
+from sqlite3 import Connection
+from typing import Literal, Optional
+from pydantic import BaseModel
+
+from db import each_shard
+from differ import LLMRequestMessage, parse_llm_request
+from segments import BODY_COLUMNS, bodies_from_row
+
+SEARCH_BATCH_SIZE = 500
+SEARCH_SNIPPET_TOKENS = 16
+# bm25 column weights: text, tool_names, tool_arguments, roles.
+SEARCH_WEIGHTS = (1.0, 4.0, 1.5, 0.2)
+
+class SearchHit(BaseModel):
+    llm_request_id: str
+    conv_id: Optional[str]
+    timestamp: Optional[float]
+    model: Optional[str]
+    score: float
+    snippet: str
+
+def search_document(request_body: str, response_body: str) -> tuple[str, str, str, str]:
+    """(text, tool_names, tool_arguments, roles) for one captured call."""
+    messages, _ = parse_llm_request(request_body, response_body, "letta")
+    request = [m for m in messages if m.part == "request"]
+    last_assistant = max((i for i, m in enumerate(request) if m.role == "assistant"), default=-1)
+    new_messages: list[LLMRequestMessage] = request[last_assistant + 1:] if last_assistant >= 0 else [m for m in request if m.role != "system"]
+    new_messages += [m for m in messages if m.part == "response"]
+    text = []
+    tool_names = []
+    tool_arguments = []
+    for message in new_messages:
+        text.extend(f"[{message.role}] {c.text}" for c in message.content)
+        for tool_call in message.tool_calls or []:
+            tool_names.append(tool_call.function.name)
+            tool_arguments.append(json.dumps(tool_call.function.arguments, ensure_ascii=False))
+    return "\n".join(text), " ".join(tool_names), "\n".join(tool_arguments), " ".join(sorted({m.role for m in new_messages}))
+
+def index_llm_request(conn: Connection, llm_request_id: str):
+    """Index one row once both of its bodies are in; called by the capture writer inside its transaction."""
+    cursor = conn.execute(f"SELECT rowid, search_indexed, {BODY_COLUMNS} FROM llm_requests WHERE id = ?", (llm_request_id,))
+    row = cursor.fetchone()
+    if row is None or row[1] is not None:
+        return
+    request_body, response_body = bodies_from_row(row[2:])
+    if request_body is None or response_body is None:
+        return
+    try:
+        document = search_document(request_body, response_body)
+    except Exception:
+        # Not a chat completion, or an error response; nothing to index.
+        document = None
+    if document is not None:
+        conn.execute("""
+            INSERT OR REPLACE INTO llm_request_search (rowid, text, tool_names, tool_arguments, roles) VALUES (?, ?, ?, ?, ?)
+        """, (row[0], *document))
+    conn.execute("UPDATE llm_requests SET search_indexed = 1 WHERE rowid = ?", (row[0],))
+
+def rebuild(batch_size: int = SEARCH_BATCH_SIZE) -> int:
+    indexed = 0
+    for conn in each_shard():
+        while True:
+            cursor = conn.execute("""
+                SELECT id FROM llm_requests
+                WHERE search_indexed IS NULL AND (response_body IS NOT NULL OR response_segment IS NOT NULL)
+                LIMIT ?
+            """, (batch_size,))
+            ids = [row[0] for row in cursor.fetchall()]
+            if len(ids) == 0:
+                break
+            for llm_request_id in ids:
+                index_llm_request(conn, llm_request_id)
+                # Rows still missing a request body would be selected again forever.
+                conn.execute("UPDATE llm_requests SET search_indexed = 1 WHERE id = ?", (llm_request_id,))
+            conn.commit()
+            indexed += len(ids)
+    return indexed
+
+def fts_query(q: str) -> str:
+    """Each whitespace-separated term as a quoted FTS5 string, so user input cannot be a syntax error."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in q.split())
+
+def search(q: str, syntax: Literal["plain", "fts"] = "plain", conv_id: Optional[str] = None, limit: int = 20) -> list[SearchHit]:
+    query = fts_query(q) if syntax == "plain" else q
+    if not query:
+        return []
+    hits: list[SearchHit] = []
+    # Each shard ranks against its own index statistics, so merged scores only roughly compare.
+    for conn in each_shard([conv_id] if conv_id is not None else None):
+        cursor = conn.execute(f"""
+            SELECT llm_requests.id, user_requests.conv_id, llm_requests.timestamp, llm_requests.model,
+                bm25(llm_request_search, {", ".join(str(w) for w in SEARCH_WEIGHTS)}) AS score,
+                snippet(llm_request_search, -1, '[', ']', '...', {SEARCH_SNIPPET_TOKENS})
+            FROM llm_request_search
+            JOIN llm_requests ON llm_requests.rowid = llm_request_search.rowid
+            LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+            WHERE llm_request_search MATCH :query AND (:conv_id IS NULL OR user_requests.conv_id = :conv_id)
+            ORDER BY score
+            LIMIT :limit
+        """, {"query": query, "conv_id": conv_id, "limit": limit})
+        hits.extend(SearchHit(
+            llm_request_id=row[0],
+            conv_id=row[1],
+            timestamp=row[2],
+            model=row[3],
+            score=row[4],
+            snippet=row[5]
+        ) for row in cursor.fetchall())
+    return sorted(hits, key=lambda hit: hit.score)[:limit]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="index rows that are not indexed yet")
+    args = parser.parse_args()
+
+    match args.command:
+        case "rebuild":
+            print(f"Indexed {rebuild()} llm_requests rows")
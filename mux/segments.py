@@ -0,0 +1,279 @@
+"""Append-only segment files for captured request/response bodies.
+
+With MUX_BODY_STORE=segments the capture writer appends each body to the
+current segment file under storage/segments and stores only its
+(segment, offset, length) in llm_requests. Segments rotate at
+MUX_SEGMENT_MAX_BYTES and are read back through mmap, so loading a body is a
+single slice of a mapped file. Rows captured inline (the default store, or
+before switching) keep working; both are read through bodies_from_row.
+
+    uv run segments.py migrate            # move inline bodies into segments
+    uv run segments.py compact            # rewrite mostly-dead segments
+    uv run segments.py retain --days 30   # drop bodies in segments older than 30 days
+"""
+import argparse
+import mmap
+import os
+from sqlite3 import Connection
+import threading
+from time import time
+from typing import Any, NamedTuple, Optional
+
+from db import db_connect, sharded
+
+BODY_STORE = os.environ.get("MUX_BODY_STORE", "sqlite")
+if BODY_STORE == "segments" and sharded():
+    # body_segments lives in the main database, the rows pointing into it in the shards.
+    raise Exception("MUX_BODY_STORE=segments is not supported together with MUX_DB_SHARDS")
+SEGMENT_DIR = "storage/segments"
+SEGMENT_MAX_BYTES = int(os.environ.get("MUX_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+# An unsealed segment nobody has written to for this long belongs to a process
+# that exited without rotating; maintenance treats it as sealed.
+SEGMENT_STALE_SECONDS = 3600
+
+BODY_COLUMNS = """
+    llm_requests.request_body, llm_requests.request_segment, llm_requests.request_offset, llm_requests.request_length,
+    llm_requests.response_body, llm_requests.response_segment, llm_requests.response_offset, llm_requests.response_length
+"""
+
+class BodyRef(NamedTuple):
+    segment: int
+    offset: int
+    length: int
+
+def segment_path(segment: int) -> str:
+    return os.path.join(SEGMENT_DIR, f"{segment:08d}.seg")
+
+class SegmentStore:
+    def __init__(self, max_segment_bytes: int = SEGMENT_MAX_BYTES):
+        self.max_segment_bytes = max_segment_bytes
+        self.lock = threading.Lock()
+        self.active_id: Optional[int] = None
+        self.active_file = None
+        self.active_size = 0
+        self.last_write_at = 0.0
+        self.maps: dict[int, mmap.mmap] = {}
+
+    def append(self, conn: Connection, data: bytes) -> BodyRef:
+        """Called by the capture writer inside its transaction."""
+        with self.lock:
+            full = self.active_size > 0 and self.active_size + len(data) > self.max_segment_bytes
+            # Maintenance in any process treats a segment idle for SEGMENT_STALE_SECONDS as
+            # abandoned, so never append to one that is getting close.
+            idle = time() - self.last_write_at > SEGMENT_STALE_SECONDS / 2
+            if self.active_file is None or full or idle:
+                self._rotate(conn)
+            assert self.active_id is not None and self.active_file is not None
+            offset = self.active_size
+            self.active_file.write(data)
+            self.active_size += len(data)
+            self.last_write_at = time()
+            return BodyRef(self.active_id, offset, len(data))
+
+    def flush(self, conn: Connection):
+        """Make appended bodies visible to readers before the rows pointing at them commit."""
+        with self.lock:
+            if self.active_file is None:
+                return
+            self.active_file.flush()
+            conn.execute("UPDATE body_segments SET bytes = ?, last_write_at = ? WHERE id = ?", (self.active_size, time(), self.active_id))
+
+    def seal(self, conn: Connection):
+        with self.lock:
+            self._seal(conn)
+
+    def _seal(self, conn: Connection):
+        if self.active_file is None:
+            return
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_file.close()
+        conn.execute("UPDATE body_segments SET bytes = ?, last_write_at = ?, sealed = 1 WHERE id = ?", (self.active_size, time(), self.active_id))
+        self.active_file = None
+        self.active_id = None
+        self.active_size = 0
+
+    def _rotate(self, conn: Connection):
+        self._seal(conn)
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        now = time()
+        cursor = conn.execute("INSERT INTO body_segments (created_at, last_write_at, bytes, sealed) VALUES (?, ?, 0, 0)", (now, now))
+        assert cursor.lastrowid is not None
+        self.active_id = cursor.lastrowid
+        self.active_file = open(segment_path(self.active_id), "xb")
+        self.active_size = 0
+
+    def view(self, ref: BodyRef) -> memoryview:
+        end = ref.offset + ref.length
+        with self.lock:
+            mapped = self.maps.get(ref.segment)
+            if mapped is None or len(mapped) < end:
+                # The active segment grows, so remap when a body lies past the old mapping.
+                if mapped is not None:
+                    mapped.close()
+                with open(segment_path(ref.segment), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[ref.segment] = mapped
+        return memoryview(mapped)[ref.offset:end]
+
+    def read(self, ref: BodyRef) -> bytes:
+        return bytes(self.view(ref))
+
+    def forget(self, segment: int):
+        with self.lock:
+            mapped = self.maps.pop(segment, None)
+        if mapped is not None:
+            try:
+                mapped.close()
+            except BufferError:
+                # Still exported as a memoryview somewhere; the GC unmaps it later.
+                pass
+
+segment_store = SegmentStore()
+
+def externalize_bodies(conn: Connection, fields: dict[str, Any]) -> dict[str, Any]:
+    """Swap request_body/response_body for segment references, if segments are enabled."""
+    if BODY_STORE != "segments":
+        return fields
+    result = dict(fields)
+    for part in ("request", "response"):
+        body = result.pop(f"{part}_body", None)
+        if body is None:
+            continue
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        ref = segment_store.append(conn, data)
+        result[f"{part}_body"] = None
+        result[f"{part}_segment"] = ref.segment
+        result[f"{part}_offset"] = ref.offset
+        result[f"{part}_length"] = ref.length
+    return result
+
+def _body(inline: Optional[str | bytes], segment: Optional[int], offset: Optional[int], length: Optional[int]) -> Optional[str]:
+    if inline is not None:
+        return inline.decode("utf-8") if isinstance(inline, bytes) else inline
+    if segment is None or offset is None or length is None:
+        return None
+    return segment_store.read(BodyRef(segment, offset, length)).decode("utf-8")
+
+def bodies_from_row(row: tuple) -> tuple[Optional[str], Optional[str]]:
+    """(request_body, response_body) from the BODY_COLUMNS part of a row."""
+    return _body(*row[0:4]), _body(*row[4:8])
+
+def _maintainable_segments(conn: Connection) -> list[tuple[int, int, float]]:
+    cursor = conn.execute("""
+        SELECT id, bytes, last_write_at FROM body_segments
+        WHERE sealed = 1 OR last_write_at < ?
+        ORDER BY id
+    """, (time() - SEGMENT_STALE_SECONDS,))
+    return cursor.fetchall()
+
+def _live_bytes(conn: Connection, segment: int) -> int:
+    cursor = conn.execute("""
+        SELECT
+            (SELECT TOTAL(request_length) FROM llm_requests WHERE request_segment = :segment) +
+            (SELECT TOTAL(response_length) FROM llm_requests WHERE response_segment = :segment)
+    """, {"segment": segment})
+    return int(cursor.fetchone()[0])
+
+def _drop_segment(conn: Connection, segment: int):
+    conn.execute("DELETE FROM body_segments WHERE id = ?", (segment,))
+    conn.commit()
+    segment_store.forget(segment)
+    try:
+        os.remove(segment_path(segment))
+    except FileNotFoundError:
+        pass
+
+def compact(min_live_ratio: float = 0.5) -> tuple[int, int]:
+    """Copy the live bodies of sealed segments that are mostly garbage into new
+    segments and delete the old files. Returns (segments compacted, bytes freed)."""
+    store = SegmentStore()
+    compacted = 0
+    freed = 0
+    with db_connect() as conn:
+        for segment, size, _ in _maintainable_segments(conn):
+            live = _live_bytes(conn, segment)
+            if size > 0 and live / size >= min_live_ratio:
+                continue
+            for part in ("request", "response"):
+                rows = conn.execute(f"""
+                    SELECT id, {part}_offset, {part}_length FROM llm_requests WHERE {part}_segment = ?
+                """, (segment,)).fetchall()
+                for llm_request_id, offset, length in rows:
+                    ref = store.append(conn, segment_store.read(BodyRef(segment, offset, length)))
+                    conn.execute(f"""
+                        UPDATE llm_requests SET {part}_segment = ?, {part}_offset = ?, {part}_length = ? WHERE id = ?
+                    """, (ref.segment, ref.offset, ref.length, llm_request_id))
+            store.flush(conn)
+            conn.commit()
+            _drop_segment(conn, segment)
+            compacted += 1
+            freed += size - live
+        store.seal(conn)
+        conn.commit()
+    return compacted, freed
+
+def retain(max_age_seconds: float) -> int:
+    """Drop whole sealed segments last written before the cutoff. Their rows keep
+    their metadata and usage columns but lose their bodies. Returns segments dropped."""
+    cutoff = time() - max_age_seconds
+    dropped = 0
+    with db_connect() as conn:
+        for segment, _, last_write_at in _maintainable_segments(conn):
+            if last_write_at >= cutoff:
+                continue
+            for part in ("request", "response"):
+                conn.execute(f"""
+                    UPDATE llm_requests SET {part}_segment = NULL, {part}_offset = NULL, {part}_length = NULL
+                    WHERE {part}_segment = ?
+                """, (segment,))
+            _drop_segment(conn, segment)
+            dropped += 1
+    return dropped
+
+def migrate_inline(batch_size: int = 500) -> int:
+    """Move bodies stored inline in llm_requests into segments."""
+    store = SegmentStore()
+    moved = 0
+    with db_connect() as conn:
+        while True:
+            rows = conn.execute("""
+                SELECT id, request_body, response_body FROM llm_requests
+                WHERE request_body IS NOT NULL OR response_body IS NOT NULL
+                LIMIT ?
+            """, (batch_size,)).fetchall()
+            if len(rows) == 0:
+                break
+            for llm_request_id, request_body, response_body in rows:
+                for part, body in (("request", request_body), ("response", response_body)):
+                    if body is None:
+                        continue
+                    ref = store.append(conn, body.encode("utf-8") if isinstance(body, str) else body)
+                    conn.execute(f"""
+                        UPDATE llm_requests SET {part}_body = NULL, {part}_segment = ?, {part}_offset = ?, {part}_length = ? WHERE id = ?
+                    """, (ref.segment, ref.offset, ref.length, llm_request_id))
+            store.flush(conn)
+            conn.commit()
+            moved += len(rows)
+        store.seal(conn)
+        conn.commit()
+    return moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="move inline bodies into segments")
+    compact_parser = subparsers.add_parser("compact", help="rewrite sealed segments with little live data")
+    compact_parser.add_argument("--min-live-ratio", type=float, default=0.5)
+    retain_parser = subparsers.add_parser("retain", help="drop sealed segments older than the cutoff")
+    retain_parser.add_argument("--days", type=float, required=True)
+    args = parser.parse_args()
+
+    match args.command:
+        case "migrate":
+            print(f"Moved bodies of {migrate_inline()} llm_requests rows into segments")
+        case "compact":
+            compacted, freed = compact(args.min_live_ratio)
+            print(f"Compacted {compacted} segments, freed {freed} bytes")
+        case "retain":
+            print(f"Dropped {retain(args.days * 86400)} segments")
@@ -0,0 +1,202 @@
+"""Sequence events computed as each LLM call is captured.
+
+/api/seq returns, for each LLM call of a conversation, the events of diffing it
+against the call before it. Those depend on the two calls only, so a background
+pipeline diffs each call as /proxy captures it, against the previous call it
+saw for the same conversation, and stores the events in llm_request_events
+along with the id of that previous call. A reader uses a stored row only when
+its previous call is the one it diffs against, and computes (and stores) the
+rest as before, so the result is the same either way.
+"""
+import asyncio
+from collections import OrderedDict, defaultdict
+import os
+from sqlite3 import Connection
+from time import time
+from typing import Any, Optional
+
+from capture import capture_writer
+from db import db_connect, request_conversation
+from differ import LLMContext
+from jsoncodec import dumps, dumps_text
+from metrics import DIFFER_CPU_SECONDS
+from retention import read_bodies
+
+# Conversations whose latest LLMContext is kept, so each call is parsed once.
+SEQUENCE_CONTEXTS = int(os.environ.get("MUX_SEQUENCE_CONTEXTS", "64"))
+# Captured bodies and events a sequence read holds at once, and the pipeline's kept contexts in total.
+SEQUENCE_MEMORY_BYTES = int(os.environ.get("MUX_SEQUENCE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+SEQUENCE_BATCH_STEPS = 32
+
+def _events_fields(conv_id: Optional[str], previous_id: Optional[str], events: list) -> dict[str, Any]:
+    return {
+        "conv_id": conv_id,
+        "previous_id": previous_id,
+        "events": dumps_text(events),
+        "computed_at": time()
+    }
+
+def _context_after(conn: Connection, llm_request_id: Optional[str]) -> LLMContext:
+    """The context the next call is diffed against; empty when there is no previous call or it has no bodies."""
+    context = LLMContext()
+    if llm_request_id is not None:
+        request_body, response_body = read_bodies(conn, [llm_request_id]).get(llm_request_id, (None, None))
+        if request_body is not None and response_body is not None:
+            context.update_and_push_response(request_body, response_body)
+    return context
+
+class SequencePipeline:
+    def __init__(self, contexts: int = SEQUENCE_CONTEXTS):
+        self.queue: asyncio.Queue[tuple[str, str, float, bytes, bytes, asyncio.Future]] = asyncio.Queue()
+        self.pending: defaultdict[str, set[asyncio.Future]] = defaultdict(set)
+        # conv_id -> (id of the last call diffed, context after it). Only the pipeline task's thread touches it.
+        self.contexts: OrderedDict[str, tuple[str, LLMContext]] = OrderedDict()
+        self.max_contexts = contexts
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+
+    def submit(self, request_id: str, llm_request_id: str, timestamp: float, request_body: bytes, response_body: bytes):
+        done = asyncio.get_running_loop().create_future()
+        self.pending[request_id].add(done)
+        done.add_done_callback(lambda _: self._discard(request_id, done))
+        self.queue.put_nowait((request_id, llm_request_id, timestamp, request_body, response_body, done))
+
+    def _discard(self, request_id: str, done: asyncio.Future):
+        self.pending[request_id].discard(done)
+        if len(self.pending[request_id]) == 0:
+            del self.pending[request_id]
+
+    async def wait(self, request_id: str):
+        """Until every call of the turn submitted so far has its events queued for the capture writer."""
+        await asyncio.gather(*self.pending.get(request_id, ()))
+
+    async def _run(self):
+        while True:
+            request_id, llm_request_id, timestamp, request_body, response_body, done = await self.queue.get()
+            try:
+                fields = await asyncio.to_thread(self._compute, request_id, llm_request_id, timestamp, request_body, response_body)
+                if fields is not None:
+                    await capture_writer.submit("llm_request_events", llm_request_id, fields)
+            except Exception as e:
+                print(f"Computing the sequence events of {llm_request_id} failed: {e}")
+            finally:
+                done.set_result(None)
+                self.queue.task_done()
+
+    def _compute(self, request_id: str, llm_request_id: str, timestamp: float, request_body: bytes, response_body: bytes) -> Optional[dict[str, Any]]:
+        conv_id = request_conversation(request_id)
+        if conv_id is None:
+            return None
+        with db_connect(conv_id) as conn:
+            cached = self.contexts.pop(conv_id, None)
+            if cached is not None:
+                previous_id, context = cached
+            else:
+                previous_id = _previous_llm_request_id(conn, conv_id, timestamp)
+                context = _context_after(conn, previous_id)
+        with DIFFER_CPU_SECONDS.time_cpu(function="sequence_events"):
+            events = context.update_and_push_response(request_body.decode("utf-8"), response_body.decode("utf-8"))
+        self.contexts[conv_id] = (llm_request_id, context)
+        while len(self.contexts) > self.max_contexts or sum(c.size() for _, c in self.contexts.values()) > SEQUENCE_MEMORY_BYTES:
+            self.contexts.popitem(last=False)
+        return _events_fields(conv_id, previous_id, events)
+
+def _previous_llm_request_id(conn: Connection, conv_id: str, timestamp: float) -> Optional[str]:
+    row = conn.execute("""
+        SELECT llm_requests.id
+        FROM llm_requests JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id
+        WHERE user_requests.conv_id = ? AND llm_requests.response_status = 200 AND llm_requests.timestamp < ?
+        ORDER BY llm_requests.timestamp DESC LIMIT 1
+    """, (conv_id, timestamp)).fetchone()
+    return row[0] if row is not None else None
+
+def body_sizes(conn: Connection, llm_request_ids: list[str]) -> dict[str, int]:
+    """Bytes of each call's request and response bodies, measured in SQLite without loading them."""
+    cursor = conn.execute("""
+        SELECT id, CASE WHEN archived THEN COALESCE(archive_bytes, 0)
+            ELSE COALESCE(length(CAST(request_body AS BLOB)), request_length, 0) + COALESCE(length(CAST(response_body AS BLOB)), response_length, 0) END
+        FROM llm_requests WHERE id IN (SELECT value FROM json_each(?))
+    """, (dumps_text(llm_request_ids),))
+    return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+class SequenceReader:
+    """The events of `llm_request_ids`, each call diffed against the one before it (the first against
+    `initial`), read a batch at a time. Between batches only the context after the last call is kept."""
+    def __init__(self, conv_id: str, llm_request_ids: list[str], initial: Optional[str] = None,
+                 memory_bytes: int = SEQUENCE_MEMORY_BYTES, batch_steps: int = SEQUENCE_BATCH_STEPS):
+        self.conv_id = conv_id
+        self.llm_request_ids = llm_request_ids
+        self.position = 0
+        self.previous = initial
+        self.context: Optional[LLMContext] = None
+        # Set after a skipped call: the next call is diffed against an empty context, so its events are not stored.
+        self.detached = False
+        self.memory_bytes = memory_bytes
+        self.batch_steps = batch_steps
+
+    def done(self) -> bool:
+        return self.position >= len(self.llm_request_ids)
+
+    def next_batch(self) -> tuple[list[bytes], dict[str, dict[str, Any]]]:
+        """JSON fragments of the next calls' events, and the rows computed here because none was stored.
+        Holds at most `memory_bytes` of bodies and events at a time. A call needing more gets a "skipped"
+        event instead, and the call after it is diffed against an empty context rather than across the gap."""
+        ids = self.llm_request_ids[self.position:self.position + self.batch_steps]
+        fragments: list[bytes] = []
+        computed: dict[str, dict[str, Any]] = {}
+        held = 0
+        with db_connect(self.conv_id) as conn:
+            stored = {
+                row[0]: (row[1], row[2]) for row in conn.execute(
+                    "SELECT id, previous_id, events FROM llm_request_events WHERE id IN (SELECT value FROM json_each(?))",
+                    (dumps_text(ids),)
+                )
+            }
+            sizes = body_sizes(conn, ids if self.previous is None else [self.previous, *ids])
+            for llm_request_id in ids:
+                if len(fragments) > 0 and held >= self.memory_bytes:
+                    break
+                self.position += 1
+                row = stored.pop(llm_request_id, None)
+                if row is not None and row[0] == self.previous:
+                    fragments.append(row[1].encode("utf-8")[1:-1])
+                    held += len(fragments[-1])
+                    self.previous = llm_request_id
+                    self.context = None
+                    self.detached = False
+                    continue
+                needed = sizes.get(llm_request_id, 0) + (self.context.size() if self.context is not None else sizes.get(self.previous or "", 0))
+                if needed > self.memory_bytes:
+                    print(f"Skipping the sequence events of {llm_request_id}: diffing it needs {needed} bytes, over MUX_SEQUENCE_MEMORY_BYTES")
+                    fragments.append(dumps({"type": "skipped", "llm_request_id": llm_request_id}))
+                    held += len(fragments[-1])
+                    # A stored row diffed against the skipped call is still right for the next one.
+                    self.previous = llm_request_id
+                    self.context = LLMContext()
+                    self.detached = True
+                    continue
+                request_body, response_body = read_bodies(conn, [llm_request_id]).get(llm_request_id, (None, None))
+                if request_body is None or response_body is None:
+                    continue
+                if self.context is None:
+                    self.context = _context_after(conn, self.previous)
+                with DIFFER_CPU_SECONDS.time_cpu(function="diff_sequence"):
+                    events = self.context.update_and_push_response(request_body, response_body)
+                fragments.append(dumps(events)[1:-1])
+                held += len(fragments[-1])
+                if not self.detached:
+                    computed[llm_request_id] = _events_fields(self.conv_id, self.previous, events)
+                self.previous = llm_request_id
+                self.detached = False
+        return [fragment for fragment in fragments if fragment.strip()], computed
+
+sequence_pipeline = SequencePipeline()
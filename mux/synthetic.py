@@ -0,0 +1,146 @@
+import json
+from datetime import datetime, timezone
+import uuid
+
+# Builders for Letta-shaped chat completion traffic, so benchmarks exercise the
+# same message layout (memory-block system prompt, send_message tool calls, tool
+# results) that the differ sees in production.
+
+SYSTEM_PREAMBLE = (
+    "You are Letta, the latest version of Limnal Corporation's digital companion, developed in 2025.\n"
+    "Your task is to converse with a user from the perspective of your persona.\n"
+    "Basic functions:\n"
+    "When you write a response, you express your inner monologue (private to you only) before taking any action.\n"
+    "To send a visible message to the user, use the send_message function.\n"
+)
+
+def letta_tools(count: int) -> list[dict]:
+    tools = [{
+        "type": "function",
+        "function": {
+            "name": "send_message",
+            "description": "Sends a message to the human user.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "message": {"type": "string", "description": "Message contents. All unicode (including emojis) are supported."},
+                    "thinking": {"type": "string", "description": "Deep inner monologue private to you only."}
+                },
+                "required": ["message", "thinking"]
+            }
+        }
+    }]
+    for i in range(max(count - 1, 0)):
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": f"synthetic_tool_{i}",
+                "description": f"Synthetic tool number {i}, used to size the tool list.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "label": {"type": "string", "description": "Section of the memory to be edited."},
+                        "content": {"type": "string", "description": "Content to write to the memory."}
+                    },
+                    "required": ["label", "content"]
+                }
+            }
+        })
+    return tools
+
+def letta_system_message(memory: dict[str, str], history_size: int, modified_at: datetime | None = None) -> dict:
+    modified_at = modified_at or datetime.now(timezone.utc)
+    blocks = "".join(
+        f"<{label}>\n<metadata>\n- chars_current={len(value)}\n- chars_limit=5000\n</metadata>\n<value>\n{value}\n</value>\n</{label}>\n"
+        for label, value in memory.items()
+    )
+    content = (
+        SYSTEM_PREAMBLE
+        + f"<memory_blocks>\n{blocks}</memory_blocks>\n"
+        + "<memory_metadata>\n"
+        + f"- Memory blocks were last modified: {modified_at.strftime('%Y-%m-%d %I:%M:%S %p UTC+0000')}\n"
+        + f"- {history_size} previous messages between you and the user are stored in recall memory (use tools to access them)\n"
+        + "</memory_metadata>"
+    )
+    return {"role": "system", "content": content}
+
+def letta_user_message(text: str) -> dict:
+    return {
+        "role": "user",
+        "content": json.dumps({"type": "user_message", "message": text, "time": datetime.now(timezone.utc).isoformat()})
+    }
+
+def letta_send_message_call(message: str, thinking: str) -> tuple[dict, dict]:
+    """An assistant send_message tool call and the tool result Letta appends after it."""
+    call_id = f"call_{uuid.uuid4().hex[:24]}"
+    assistant = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{
+            "id": call_id,
+            "type": "function",
+            "function": {"name": "send_message", "arguments": json.dumps({"message": message, "thinking": thinking})}
+        }]
+    }
+    tool = {
+        "role": "tool",
+        "tool_call_id": call_id,
+        "content": json.dumps({"status": "OK", "message": "None", "time": datetime.now(timezone.utc).isoformat()})
+    }
+    return assistant, tool
+
+def letta_request(model: str, memory: dict[str, str], history: list[dict], tools: list[dict]) -> dict:
+    return {
+        "model": model,
+        "messages": [letta_system_message(memory, len(history))] + history,
+        "tools": tools,
+        "tool_choice": "required",
+        "temperature": 0.7
+    }
+
+def default_memory() -> dict[str, str]:
+    return {
+        "human": "You know nothing about the human yet.",
+        "persona": "You are a helpful and friendly AI assistant."
+    }
+
+def letta_completion(message: str, thinking: str, model: str = "dummy-model", tool_name: str = "send_message") -> dict:
+    assistant, _ = letta_send_message_call(message, thinking)
+    assistant["tool_calls"][0]["function"]["name"] = tool_name
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "model": model,
+        "choices": [{"index": 0, "message": assistant, "finish_reason": "tool_calls"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+def letta_sequence(steps: int, history_size: int = 0, tool_count: int = 8, message_chars: int = 200, model: str = "dummy-model") -> list[tuple[str, str]]:
+    """Request/response bodies for `steps` consecutive Letta steps of one agent,
+    starting from `history_size` earlier messages. Every other step is a memory
+    edit, so the system prompt changes the way it does in production."""
+    memory = default_memory()
+    tools = letta_tools(tool_count)
+    filler = ("lorem ipsum dolor sit amet " * (message_chars // 27 + 1))[:message_chars]
+    history: list[dict] = []
+    for i in range(history_size // 3):
+        history.append(letta_user_message(f"Earlier turn {i}: {filler}"))
+        history.extend(letta_send_message_call(f"Earlier reply {i}: {filler}", f"Thinking {i}"))
+    sequence = []
+    for step in range(steps):
+        if step % 2 == 0:
+            history.append(letta_user_message(f"Turn {step}: {filler}"))
+        request = letta_request(model, memory, history, tools)
+        if step % 2 == 0:
+            response = letta_completion(f"Noted turn {step}", f"Should remember turn {step}", model, tool_name="core_memory_append")
+            memory["human"] += f"\nTurn {step}: {filler[:40]}"
+        else:
+            response = letta_completion(f"Reply {step}: {filler}", f"Thinking about step {step}", model)
+        sequence.append((json.dumps(request), json.dumps(response)))
+        history.append(response["choices"][0]["message"])
+        history.append({
+            "role": "tool",
+            "tool_call_id": response["choices"][0]["message"]["tool_calls"][0]["id"],
+            "content": json.dumps({"status": "OK", "message": "None"})
+        })
+    return sequence
@@ -0,0 +1,435 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import json
+import os
+import queue
+import secrets
+from sqlite3 import Connection, connect
+import threading
+from time import time_ns
+from typing import Any, Literal, Optional
+from pydantic import BaseModel
+
+# Spans follow the OpenTelemetry data model (W3C trace/span ids, unix-nano
+# timestamps, OTLP field names on export) but are exported in-process to
+# SQLite or a JSONL file, so nothing external has to run.
+
+TRACE_EXPORTER = os.environ.get("MUX_TRACE_EXPORTER", "sqlite")
+TRACE_DB_PATH = os.environ.get("MUX_TRACE_DB", "storage/traces.db")
+TRACE_FILE_PATH = os.environ.get("MUX_TRACE_FILE", "storage/traces.jsonl")
+
+class SpanContext(BaseModel):
+    trace_id: str
+    span_id: str
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+class Span(BaseModel):
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str] = None
+    name: str
+    start_time_unix_nano: int
+    end_time_unix_nano: Optional[int] = None
+    attributes: dict[str, Any] = {}
+    status: Literal["UNSET", "OK", "ERROR"] = "UNSET"
+    status_message: Optional[str] = None
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(trace_id=self.trace_id, span_id=self.span_id)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "startTimeUnixNano": str(self.start_time_unix_nano),
+            "endTimeUnixNano": str(self.end_time_unix_nano),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": f"STATUS_CODE_{self.status}", "message": self.status_message or ""},
+        }
+
+def _otlp_value(value: Any) -> dict:
+    match value:
+        case bool():
+            return {"boolValue": value}
+        case int():
+            return {"intValue": str(value)}
+        case float():
+            return {"doubleValue": value}
+        case _:
+            return {"stringValue": str(value)}
+
+class SpanExporter:
+    def export(self, spans: list[Span]):
+        ...
+
+    def read_trace(self, request_id: str) -> list[Span]:
+        return []
+
+    def close(self):
+        """Called on the exporter thread after its last export."""
+
+    def prune(self, before_unix_nano: int) -> int:
+        """Delete traces that ended before the cutoff; the number of spans deleted."""
+        return 0
+
+class SQLiteSpanExporter(SpanExporter):
+    """Spans in a SQLite file. Export runs on the exporter thread, which keeps one connection
+    for it; readers open their own."""
+    def __init__(self, path: str):
+        self.path = path
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+        self.writer: Optional[Connection] = None
+
+    def _connect(self) -> Connection:
+        conn = connect(self.path)
+        if not self.schema_ready:
+            with self.schema_lock:
+                if not self.schema_ready:
+                    self._create_schema(conn)
+                    self.schema_ready = True
+        return conn
+
+    def _create_schema(self, conn: Connection):
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS spans (
+                trace_id TEXT,
+                span_id TEXT PRIMARY KEY,
+                parent_span_id TEXT,
+                name TEXT,
+                start_time_unix_nano INTEGER,
+                end_time_unix_nano INTEGER,
+                attributes TEXT,
+                status TEXT,
+                status_message TEXT,
+                request_id TEXT
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS spans_trace_id ON spans (trace_id, start_time_unix_nano)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS spans_request_id ON spans (request_id)")
+        conn.commit()
+
+    def export(self, spans: list[Span]):
+        if self.writer is None:
+            self.writer = self._connect()
+        with self.writer as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO spans (trace_id, span_id, parent_span_id, name, start_time_unix_nano, end_time_unix_nano, attributes, status, status_message, request_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(
+                span.trace_id,
+                span.span_id,
+                span.parent_span_id,
+                span.name,
+                span.start_time_unix_nano,
+                span.end_time_unix_nano,
+                json.dumps(span.attributes),
+                span.status,
+                span.status_message,
+                span.attributes.get("mux.request_id")
+            ) for span in spans])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def prune(self, before_unix_nano: int) -> int:
+        conn = self._connect()
+        try:
+            # Whole traces only, so a turn running across the cutoff keeps all its spans.
+            cursor = conn.execute("""
+                DELETE FROM spans WHERE trace_id IN (
+                    SELECT trace_id FROM spans GROUP BY trace_id HAVING MAX(start_time_unix_nano) < ?
+                )
+            """, (before_unix_nano,))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def read_trace(self, request_id: str) -> list[Span]:
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT trace_id, span_id, parent_span_id, name, start_time_unix_nano, end_time_unix_nano, attributes, status, status_message
+                FROM spans
+                WHERE trace_id IN (SELECT trace_id FROM spans WHERE request_id = ?)
+                ORDER BY start_time_unix_nano
+            """, (request_id,))
+            return [Span(
+                trace_id=row[0],
+                span_id=row[1],
+                parent_span_id=row[2],
+                name=row[3],
+                start_time_unix_nano=row[4],
+                end_time_unix_nano=row[5],
+                attributes=json.loads(row[6]),
+                status=row[7],
+                status_message=row[8]
+            ) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+class FileSpanExporter(SpanExporter):
+    """Appends OTLP/JSON resource spans, one export batch per line."""
+    def __init__(self, path: str):
+        self.path = path
+        # Pruning rewrites the file, which must not drop a batch appended meanwhile.
+        self.lock = threading.Lock()
+
+    def export(self, spans: list[Span]):
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "mux"}}]},
+            "scopeSpans": [{"scope": {"name": "mux"}, "spans": [span.to_otlp() for span in spans]}]
+        }]})
+        with self.lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def prune(self, before_unix_nano: int) -> int:
+        """Drop the export batches whose spans all started before the cutoff."""
+        deleted = 0
+        with self.lock:
+            try:
+                with open(self.path) as src, open(self.path + ".tmp", "w") as dst:
+                    for line in src:
+                        starts = [int(s["startTimeUnixNano"]) for resource in json.loads(line)["resourceSpans"]
+                                  for scope in resource["scopeSpans"] for s in scope["spans"]]
+                        if len(starts) > 0 and max(starts) < before_unix_nano:
+                            deleted += len(starts)
+                        else:
+                            dst.write(line)
+            except FileNotFoundError:
+                return 0
+            os.replace(self.path + ".tmp", self.path)
+        return deleted
+
+    def read_trace(self, request_id: str) -> list[Span]:
+        spans: list[Span] = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    for resource in json.loads(line)["resourceSpans"]:
+                        for scope in resource["scopeSpans"]:
+                            spans.extend(_span_from_otlp(s) for s in scope["spans"])
+        except FileNotFoundError:
+            return []
+        trace_ids = {s.trace_id for s in spans if s.attributes.get("mux.request_id") == request_id}
+        return sorted((s for s in spans if s.trace_id in trace_ids), key=lambda s: s.start_time_unix_nano)
+
+def _span_from_otlp(data: dict) -> Span:
+    attributes = {}
+    for attribute in data["attributes"]:
+        value = attribute["value"]
+        if "intValue" in value:
+            attributes[attribute["key"]] = int(value["intValue"])
+        else:
+            attributes[attribute["key"]] = next(iter(value.values()))
+    return Span(
+        trace_id=data["traceId"],
+        span_id=data["spanId"],
+        parent_span_id=data["parentSpanId"] or None,
+        name=data["name"],
+        start_time_unix_nano=int(data["startTimeUnixNano"]),
+        end_time_unix_nano=int(data["endTimeUnixNano"]),
+        attributes=attributes,
+        status=data["status"]["code"].removeprefix("STATUS_CODE_"),
+        status_message=data["status"]["message"] or None
+    )
+
+class BatchSpanProcessor:
+    """Exports finished spans from a daemon thread, off the request path."""
+    def __init__(self, exporter: SpanExporter, max_batch: int = 256):
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.queue: queue.Queue[Span | None] = queue.Queue()
+        # Once set, the exporter thread is gone: nothing is queued and flushing has nothing to wait for.
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self.thread.start()
+
+    def on_end(self, span: Span):
+        with self.lock:
+            if not self.closed:
+                self.queue.put(span)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            spans = [s for s in batch if s is not None]
+            try:
+                if spans:
+                    self.exporter.export(spans)
+            except Exception as e:
+                print(f"Failed to export {len(spans)} spans: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if None in batch:
+                self.exporter.close()
+                return
+
+    def force_flush(self):
+        if self.closed:
+            return
+        self.queue.join()
+
+    def shutdown(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class Tracer:
+    def __init__(self, exporter: SpanExporter):
+        self.exporter = exporter
+        self.processor = BatchSpanProcessor(exporter)
+
+    @contextmanager
+    def span(self, name: str, parent: SpanContext | None = None, **attributes: Any):
+        if parent is None:
+            current = _current_span.get()
+            parent = current.context if current is not None else None
+        span = Span(
+            trace_id=parent.trace_id if parent is not None else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_span_id=parent.span_id if parent is not None else None,
+            name=name,
+            start_time_unix_nano=time_ns(),
+            attributes=attributes
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+            if span.status == "UNSET":
+                span.status = "OK"
+        except BaseException as e:
+            span.status = "ERROR"
+            span.status_message = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_time_unix_nano = time_ns()
+            self.processor.on_end(span)
+
+    def record(self, name: str, start_time_unix_nano: int, end_time_unix_nano: int, **attributes: Any):
+        """Record an already finished span under the current one, e.g. a lock wait."""
+        current = _current_span.get()
+        self.processor.on_end(Span(
+            trace_id=current.trace_id if current is not None else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_span_id=current.span_id if current is not None else None,
+            name=name,
+            start_time_unix_nano=start_time_unix_nano,
+            end_time_unix_nano=end_time_unix_nano,
+            attributes=attributes,
+            status="OK"
+        ))
+
+    def current_context(self) -> SpanContext | None:
+        current = _current_span.get()
+        return current.context if current is not None else None
+
+    def read_trace(self, request_id: str) -> list[Span]:
+        self.processor.force_flush()
+        return self.exporter.read_trace(request_id)
+
+    def prune(self, before: float) -> int:
+        return self.exporter.prune(int(before * 1e9))
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+def _make_exporter() -> SpanExporter:
+    match TRACE_EXPORTER:
+        case "sqlite":
+            return SQLiteSpanExporter(TRACE_DB_PATH)
+        case "file":
+            return FileSpanExporter(TRACE_FILE_PATH)
+        case _:
+            return SpanExporter()
+
+tracer = Tracer(_make_exporter())
+
+def traced(name: str):
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class WaterfallSpan(BaseModel):
+    span_id: str
+    parent_span_id: Optional[str]
+    name: str
+    depth: int
+    offset_ms: float
+    duration_ms: float
+    status: str
+    attributes: dict[str, Any]
+
+def waterfall(spans: list[Span]) -> list[WaterfallSpan]:
+    if len(spans) == 0:
+        return []
+    trace_start = min(s.start_time_unix_nano for s in spans)
+    by_parent: dict[str | None, list[Span]] = {}
+    span_ids = {s.span_id for s in spans}
+    for span in spans:
+        parent = span.parent_span_id if span.parent_span_id in span_ids else None
+        by_parent.setdefault(parent, []).append(span)
+    result: list[WaterfallSpan] = []
+
+    def visit(parent: str | None, depth: int):
+        for span in sorted(by_parent.get(parent, []), key=lambda s: s.start_time_unix_nano):
+            end = span.end_time_unix_nano or span.start_time_unix_nano
+            result.append(WaterfallSpan(
+                span_id=span.span_id,
+                parent_span_id=span.parent_span_id,
+                name=span.name,
+                depth=depth,
+                offset_ms=(span.start_time_unix_nano - trace_start) / 1e6,
+                duration_ms=(end - span.start_time_unix_nano) / 1e6,
+                status=span.status,
+                attributes=span.attributes
+            ))
+            visit(span.span_id, depth + 1)
+    visit(None, 0)
+    return result
+
+def render_waterfall(rows: list[WaterfallSpan], width: int = 60) -> str:
+    if len(rows) == 0:
+        return ""
+    total = max(r.offset_ms + r.duration_ms for r in rows) or 1.0
+    lines = []
+    for r in rows:
+        start = int(r.offset_ms / total * width)
+        length = max(int(r.duration_ms / total * width), 1)
+        bar = " " * start + "#" * min(length, width - start)
+        label = "  " * r.depth + r.name
+        lines.append(f"{label:<40} {r.offset_ms:>9.1f}ms {r.duration_ms:>9.1f}ms |{bar:<{width}}|")
+    return "\n".join(lines) + "\n"
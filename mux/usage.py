@@ -0,0 +1,248 @@
+import json
+import os
+from sqlite3 import Connection
+from typing import Literal, Optional
+from pydantic import BaseModel
+
+from corpus import percentile_rank
+from db import each_shard, shard_connect, shards
+from jsoncodec import loads
+from segments import BODY_COLUMNS, bodies_from_row
+
+# USD per million tokens: (prompt, cached prompt, completion). Matched by longest
+# model-name prefix, so dated snapshots ("gpt-4o-mini-2024-07-18") resolve too.
+MODEL_PRICES: dict[str, tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-5.1": (1.25, 0.125, 10.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+    "gpt-5": (1.25, 0.125, 10.00),
+    "dummy-model": (0.0, 0.0, 0.0),
+}
+MODEL_PRICES.update({
+    model: tuple(prices) for model, prices in json.loads(os.environ.get("MUX_MODEL_PRICES", "{}")).items()
+})
+
+BACKFILL_BATCH_SIZE = 500
+PERCENTILES = (50, 95, 99)
+
+class LLMUsage(BaseModel):
+    model: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    finish_reason: Optional[str] = None
+
+def request_model(body: bytes | str | None) -> str:
+    if not body:
+        return ""
+    try:
+        model = loads(body).get("model")
+    except (ValueError, AttributeError):
+        return ""
+    return model if isinstance(model, str) else ""
+
+def _usage_from_chunk(data: dict, usage: LLMUsage):
+    if isinstance(data.get("model"), str):
+        usage.model = data["model"]
+    for choice in data.get("choices") or []:
+        if choice.get("finish_reason") is not None:
+            usage.finish_reason = choice["finish_reason"]
+    tokens = data.get("usage")
+    if isinstance(tokens, dict):
+        usage.prompt_tokens = tokens.get("prompt_tokens")
+        usage.completion_tokens = tokens.get("completion_tokens")
+        usage.cached_tokens = (tokens.get("prompt_tokens_details") or {}).get("cached_tokens")
+
+def extract_usage(response_body: bytes | str | None, model: str | None = None) -> LLMUsage:
+    usage = LLMUsage(model=model or None)
+    if not response_body:
+        return usage
+    stripped = response_body.lstrip()
+    if stripped.startswith(b"data:" if isinstance(stripped, bytes) else "data:"):
+        if isinstance(stripped, bytes):
+            stripped = stripped.decode("utf-8", errors="replace")
+        # Server-sent events from a streamed completion; usage rides on the last chunk.
+        for line in stripped.splitlines():
+            payload = line.removeprefix("data:").strip()
+            if not line.startswith("data:") or payload == "[DONE]":
+                continue
+            try:
+                _usage_from_chunk(loads(payload), usage)
+            except (ValueError, AttributeError):
+                continue
+        return usage
+    try:
+        data = loads(stripped)
+    except ValueError:
+        return usage
+    if isinstance(data, dict):
+        _usage_from_chunk(data, usage)
+    return usage
+
+def price_for(model: str | None) -> tuple[float, float, float] | None:
+    if not model:
+        return None
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.removeprefix("openai/").startswith(name):
+            return MODEL_PRICES[name]
+    return None
+
+def cost_usd(model: str | None, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> float | None:
+    prices = price_for(model)
+    if prices is None:
+        return None
+    prompt_price, cached_price, completion_price = prices
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * prompt_price + cached_tokens * cached_price + completion_tokens * completion_price) / 1_000_000
+
+def backfill_usage(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Fill the usage columns of rows captured before they existed, in batches."""
+    updated = 0
+    for conn in each_shard():
+        cursor = conn.cursor()
+        while True:
+            cursor.execute(f"""
+                SELECT id, {BODY_COLUMNS} FROM llm_requests
+                WHERE usage_extracted IS NULL AND (response_body IS NOT NULL OR response_segment IS NOT NULL)
+                LIMIT ?
+            """, (batch_size,))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                llm_request_id = row[0]
+                request_body, response_body = bodies_from_row(row[1:])
+                usage = extract_usage(response_body)
+                if usage.model is None:
+                    usage.model = request_model(request_body) or None
+                cursor.execute("""
+                    UPDATE llm_requests
+                    SET model = ?, prompt_tokens = ?, completion_tokens = ?, cached_tokens = ?, finish_reason = ?, usage_extracted = 1
+                    WHERE id = ?
+                """, (
+                    usage.model,
+                    usage.prompt_tokens,
+                    usage.completion_tokens,
+                    usage.cached_tokens,
+                    usage.finish_reason,
+                    llm_request_id
+                ))
+            conn.commit()
+            updated += len(rows)
+    return updated
+
+class UsageGroup(BaseModel):
+    key: str | float | None
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cached_ratio: float | None = None
+    cost_usd: float | None = 0.0
+    latency_ms: dict[str, int | None] = {}
+
+UsageGroupBy = Literal["conversation", "model", "time", "rewrite"]
+
+def _shard_percentile(conn: Connection, source: str, params: dict, rank: int) -> int:
+    # Read off the latency index in order, without sorting or loading the other rows.
+    return conn.execute(f"""
+        SELECT llm_requests.duration_ms {source}
+        ORDER BY llm_requests.duration_ms LIMIT 1 OFFSET :rank
+    """, {**params, "rank": rank}).fetchone()[0]
+
+def _merged_percentile(conns: list[Connection], source: str, params: dict, rank: int) -> int:
+    """The value at `rank` across several shards: the smallest duration with more than `rank` rows at or below it."""
+    bounds = [conn.execute(f"SELECT MIN(llm_requests.duration_ms), MAX(llm_requests.duration_ms) {source}", params).fetchone() for conn in conns]
+    low, high = min(b[0] for b in bounds), max(b[1] for b in bounds)
+    while low < high:
+        middle = (low + high) // 2
+        at_or_below = sum(conn.execute(f"SELECT COUNT(*) {source} AND llm_requests.duration_ms <= :value", {**params, "value": middle}).fetchone()[0] for conn in conns)
+        if at_or_below > rank:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def _latency_percentiles(timed: dict[int, int], conns: list[Connection], source: str, params: dict) -> dict[str, int | None]:
+    total = sum(timed.values())
+    if total == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    shard_conns = [conns[index] for index in timed]
+    if len(shard_conns) == 1:
+        return {f"p{p}": _shard_percentile(shard_conns[0], source, params, percentile_rank(total, p)) for p in PERCENTILES}
+    return {f"p{p}": _merged_percentile(shard_conns, source, params, percentile_rank(total, p)) for p in PERCENTILES}
+
+def aggregate_usage(group_by: UsageGroupBy, since: float | None = None, until: float | None = None, bucket_seconds: int = 3600, conv_id: str | None = None) -> list[UsageGroup]:
+    match group_by:
+        case "conversation":
+            key_expr = "user_requests.conv_id"
+            group_condition = "user_requests.conv_id IS :key"
+        case "model":
+            key_expr = "llm_requests.model"
+            group_condition = "llm_requests.model IS :key"
+        case "time":
+            key_expr = "CAST(llm_requests.timestamp / :bucket AS INTEGER) * :bucket"
+            group_condition = "llm_requests.timestamp >= :key AND llm_requests.timestamp < :key + :bucket"
+        case "rewrite":
+            key_expr = "CASE WHEN llm_requests.prompt_rewrites > 0 THEN 'rewritten' ELSE 'original' END"
+            group_condition = f"{key_expr} = :key"
+    conditions: list[str] = []
+    if since is not None:
+        conditions.append("llm_requests.timestamp >= :since")
+    if until is not None:
+        conditions.append("llm_requests.timestamp < :until")
+    if conv_id is not None:
+        conditions.append("user_requests.conv_id = :conv_id")
+    join = "LEFT JOIN user_requests ON llm_requests.correlated_request_id = user_requests.id" if group_by == "conversation" or conv_id is not None else ""
+    params = {"since": since, "until": until, "bucket": bucket_seconds, "conv_id": conv_id}
+    where = " AND ".join(conditions) or "1"
+
+    groups: dict[str | float | None, UsageGroup] = {}
+    # Per group, the rows with a duration in each shard (by index into conns).
+    timed: dict[str | float | None, dict[int, int]] = {}
+    # Only the conversation's own shard when there is one; merged across shards otherwise.
+    conns = [shard_connect(shard) for shard in shards([conv_id] if conv_id is not None else None)]
+    try:
+        for index, conn in enumerate(conns):
+            cursor = conn.cursor()
+            # Tokens are summed per (group, model) so each model is priced on its own.
+            cursor.execute(f"""
+                SELECT {key_expr} AS key, llm_requests.model, COUNT(*), COUNT(llm_requests.duration_ms),
+                    TOTAL(llm_requests.prompt_tokens), TOTAL(llm_requests.completion_tokens), TOTAL(llm_requests.cached_tokens)
+                FROM llm_requests {join}
+                WHERE {where}
+                GROUP BY key, llm_requests.model
+            """, params)
+            for key, model, count, timed_count, prompt_tokens, completion_tokens, cached_tokens in cursor.fetchall():
+                group = groups.setdefault(key, UsageGroup(key=key))
+                group.requests += count
+                group.prompt_tokens += int(prompt_tokens)
+                group.completion_tokens += int(completion_tokens)
+                group.cached_tokens += int(cached_tokens)
+                cost = cost_usd(model, int(prompt_tokens), int(completion_tokens), int(cached_tokens))
+                if cost is None or group.cost_usd is None:
+                    group.cost_usd = None
+                else:
+                    group.cost_usd += cost
+                if timed_count > 0:
+                    shard_counts = timed.setdefault(key, {})
+                    shard_counts[index] = shard_counts.get(index, 0) + timed_count
+        for key, group in groups.items():
+            source = f"""
+                FROM llm_requests {join}
+                WHERE {where} AND {group_condition} AND llm_requests.duration_ms IS NOT NULL
+            """
+            group.latency_ms = _latency_percentiles(timed.get(key, {}), conns, source, {**params, "key": key})
+            group.cached_ratio = round(group.cached_tokens / group.prompt_tokens, 4) if group.prompt_tokens > 0 else None
+    finally:
+        for conn in conns:
+            conn.close()
+    return sorted(groups.values(), key=lambda g: (g.key is None, str(g.key)))
+
+if __name__ == "__main__":
+    print(f"Backfilled usage for {backfill_usage()} llm_requests rows")
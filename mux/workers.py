@@ -0,0 +1,114 @@
+"""Coordination between uvicorn worker processes sharing one storage directory.
+
+Letta's calls back into /proxy carry nothing that identifies the turn, so the
+mux runs one client call at a time and attributes every /proxy call to it. With
+several workers the turn and its /proxy calls can land in different processes:
+the correlator lock is an flock on storage/correlator.lock, and the turn
+holding it is recorded in the correlator_state table for the other workers.
+"""
+import asyncio
+import fcntl
+import os
+from time import time
+from typing import Optional
+
+from db import db_connect
+from tracing import SpanContext
+
+WORKERS = int(os.environ.get("MUX_WORKERS", "1"))
+CORRELATOR_LOCK_PATH = "storage/correlator.lock"
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class FileLock:
+    """An exclusive flock; other processes and other FileLocks on the same path exclude each other."""
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    def _open(self) -> int:
+        if self.fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self.fd
+
+    def acquire_blocking(self):
+        fcntl.flock(self._open(), fcntl.LOCK_EX)
+
+    def try_acquire(self) -> bool:
+        try:
+            fcntl.flock(self._open(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        assert self.fd is not None
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class SharedLock:
+    """An asyncio.Lock within the process, then a FileLock across processes.
+
+    Same acquire/release shape as asyncio.Lock, so metrics.timed_lock measures it
+    the same way. Only the one coroutine holding the local lock parks a thread on
+    the flock.
+    """
+    def __init__(self, path: str):
+        self.local = asyncio.Lock()
+        self.file = FileLock(path)
+
+    async def acquire(self):
+        await self.local.acquire()
+        waiter = asyncio.ensure_future(asyncio.to_thread(self.file.acquire_blocking))
+        try:
+            await asyncio.shield(waiter)
+        except BaseException:
+            # The thread cannot be interrupted; give the flock back once it has it.
+            waiter.add_done_callback(self._abandon)
+            raise
+
+    def _abandon(self, waiter: asyncio.Future):
+        if not waiter.cancelled() and waiter.exception() is None:
+            self.file.release()
+        self.local.release()
+
+    def release(self):
+        self.file.release()
+        self.local.release()
+
+def write_correlation(request_id: Optional[str], span_context: Optional[SpanContext]):
+    with db_connect() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO correlator_state (id, request_id, trace_id, span_id, pid, acquired_at)
+            VALUES (1, ?, ?, ?, ?, ?)
+        """, (
+            request_id,
+            span_context.trace_id if span_context is not None else None,
+            span_context.span_id if span_context is not None else None,
+            os.getpid(),
+            time()
+        ))
+        conn.commit()
+
+def read_correlation() -> tuple[Optional[str], Optional[SpanContext]]:
+    """The turn holding the correlator in whichever worker holds it."""
+    with db_connect() as conn:
+        cursor = conn.execute("SELECT request_id, trace_id, span_id, pid FROM correlator_state WHERE id = 1")
+        row = cursor.fetchone()
+    if row is None or row[0] is None or not process_alive(row[3]):
+        # A worker that died holding the lock released the flock but left its row.
+        return None, None
+    span_context = SpanContext(trace_id=row[1], span_id=row[2]) if row[1] is not None else None
+    return row[0], span_context